@@ -1,12 +1,16 @@
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash
+from flask import Blueprint, Response, render_template, request, redirect, url_for, session, flash, stream_with_context
 from CTFd.utils.decorators import admins_only, authed_only
 
-from CTFd.utils.user import get_current_user, get_current_team
+from CTFd.utils.user import get_current_user, get_current_team, is_admin
 from CTFd.utils import config as ctfd_config
 from CTFd.models import db, Challenges, Solves, Fails, Flags, Tags, Files, ChallengeFiles, Hints, Awards # Import necessary models
 from CTFd.plugins.challenges import BaseChallenge, CHALLENGE_CLASSES
 from CTFd.plugins.flags import get_flag_class
+from sqlalchemy.exc import IntegrityError
+import atexit
 import datetime
+import json
+import threading
 
 # Import the docker utility functions
 from . import docker_utils
@@ -18,31 +22,452 @@ log = logging.getLogger(__name__)
 PLUGIN_NAME = "Docker Container Manager"
 PLUGIN_FOLDER = "docker_challenges" # Should match the directory name
 
-# --- Database Models (Optional, if needed for storing container info) ---
-# Example:
-# class DockerChallengeContainers(db.Model):
-#     id = db.Column(db.Integer, primary_key=True)
-#     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-#     team_id = db.Column(db.Integer, db.ForeignKey('teams.id'))
-#     challenge_id = db.Column(db.Integer, db.ForeignKey('challenges.id'))
-#     container_id = db.Column(db.String(128), unique=True)
-#     ip_address = db.Column(db.String(128))
-#     port = db.Column(db.Integer)
-#     created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
-#     expires = db.Column(db.DateTime) # For timeout
-#
-#     user = db.relationship('Users', foreign_keys="DockerChallengeContainers.user_id", lazy='select')
-#     team = db.relationship('Teams', foreign_keys="DockerChallengeContainers.team_id", lazy='select')
-#     challenge = db.relationship('Challenges', foreign_keys="DockerChallengeContainers.challenge_id", lazy='select')
-#
-#     def __init__(self, user_id, team_id, challenge_id, container_id, ip_address, port, expires):
-#         self.user_id = user_id
-#         self.team_id = team_id
-#         self.challenge_id = challenge_id
-#         self.container_id = container_id
-#         self.ip_address = ip_address
-#         self.port = port
-#         self.expires = expires
+# Start progress streams (server-sent events); each open stream holds a worker
+# thread (or a whole sync worker), so streams are kept short like the long-poll
+EVENT_STREAM_KEEPALIVE = 10 # Seconds between keepalive comments
+EVENT_STREAM_MAX_DURATION = 25 # Seconds before the server ends a stream; the browser reconnects
+
+# Settings from the admin page that bound how many instances may start/run
+ADMISSION_SETTINGS = (
+    'max_concurrent_creates',
+    'max_instances_per_user',
+    'max_instances_per_team',
+    'max_instances_per_challenge',
+    'host_memory_budget',
+)
+
+# Settings from the admin page for pausing idle instances
+IDLE_SETTINGS = (
+    'idle_pause_after',
+)
+
+# Settings from the admin page for pinning instances to cores
+CPU_SETTINGS = (
+    'cpu_pinning',
+    'numa_nodes',
+)
+
+# Settings from the admin page for choosing host ports
+PORT_SETTINGS = (
+    'host_port_range',
+)
+
+# Settings from the admin page for evicting unused images
+IMAGE_SETTINGS = (
+    'image_cache_budget',
+)
+
+# Settings from the admin page for probing started instances
+READY_SETTINGS = (
+    'ready_probe_address',
+)
+
+# --- Database Models ---
+class DockerChallengeContainers(db.Model):
+    """One row per running challenge instance.
+
+    This is the source of truth for "who owns which container", so lookups,
+    admin listings and expiry scans are indexed queries instead of Docker
+    daemon calls.
+    """
+    __tablename__ = 'docker_challenge_containers'
+    __table_args__ = (
+        db.Index('ix_docker_containers_user_challenge', 'user_id', 'challenge_id'),
+        db.Index('ix_docker_containers_team_challenge', 'team_id', 'challenge_id'),
+        db.Index('ix_docker_containers_expires', 'expires'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
+    team_id = db.Column(db.Integer, db.ForeignKey('teams.id', ondelete='CASCADE'))
+    challenge_id = db.Column(db.Integer, db.ForeignKey('challenges.id', ondelete='CASCADE'))
+    container_id = db.Column(db.String(128), unique=True)
+    container_name = db.Column(db.String(128))
+    docker_host = db.Column(db.String(256)) # Daemon URL; NULL means the default daemon
+    ip_address = db.Column(db.String(128))
+    port = db.Column(db.Integer)
+    connection_info = db.Column(db.JSON)
+    created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    expires = db.Column(db.DateTime) # For timeout
+
+    user = db.relationship('Users', foreign_keys="DockerChallengeContainers.user_id", lazy='select')
+    team = db.relationship('Teams', foreign_keys="DockerChallengeContainers.team_id", lazy='select')
+    challenge = db.relationship('Challenges', foreign_keys="DockerChallengeContainers.challenge_id", lazy='select')
+
+    def __init__(self, user_id, team_id, challenge_id, container_id, container_name, docker_host, ip_address, port, connection_info, expires):
+        self.user_id = user_id
+        self.team_id = team_id
+        self.challenge_id = challenge_id
+        self.container_id = container_id
+        self.container_name = container_name
+        self.docker_host = docker_host
+        self.ip_address = ip_address
+        self.port = port
+        self.connection_info = connection_info
+        self.expires = expires
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'user_id': self.user_id,
+            'team_id': self.team_id,
+            'challenge_id': self.challenge_id,
+            'container_id': self.container_id,
+            'container_name': self.container_name,
+            'docker_host': self.docker_host,
+            'ip_address': self.ip_address,
+            'port': self.port,
+            'connection_info': self.connection_info or {},
+            'created': self.created.isoformat() if self.created else None,
+            'expires': self.expires.isoformat() if self.expires else None,
+        }
+
+
+class DockerChallengeLeases(db.Model):
+    """Named leases that single out one worker process (see docker_utils.LeaderElection)."""
+    __tablename__ = 'docker_challenge_leases'
+
+    name = db.Column(db.String(64), primary_key=True)
+    holder = db.Column(db.String(128)) # "hostname:pid" of the holding worker
+    expires = db.Column(db.DateTime)
+
+    def __init__(self, name, holder, expires):
+        self.name = name
+        self.holder = holder
+        self.expires = expires
+
+
+def _acquire_lease(name, holder, ttl):
+    """Takes or renews a lease for `holder` unless another holder's lease is still valid.
+
+    Must run inside an app context.
+
+    Returns:
+        bool: True if `holder` holds the lease for the next `ttl` seconds.
+    """
+    now = datetime.datetime.utcnow()
+    expires = now + datetime.timedelta(seconds=ttl)
+    try:
+        renewed = DockerChallengeLeases.query.filter(
+            DockerChallengeLeases.name == name,
+            db.or_(DockerChallengeLeases.holder == holder, DockerChallengeLeases.expires < now),
+        ).update({'holder': holder, 'expires': expires}, synchronize_session=False)
+        if not renewed:
+            db.session.add(DockerChallengeLeases(name, holder, expires))
+        db.session.commit()
+        return True
+    except IntegrityError:
+        # Another worker holds the lease (or took it first)
+        db.session.rollback()
+        return False
+
+
+def _get_int_setting(key, default=0):
+    """Reads an integer plugin setting, falling back to `default` when unset or invalid."""
+    try:
+        return int(ctfd_config.get_config(f'docker_manager:{key}') or default)
+    except (TypeError, ValueError):
+        return default
+
+
+def _load_settings():
+    """Applies the plugin settings to docker_utils (cheap when unchanged)."""
+    docker_utils.configure_docker_hosts(
+        docker_utils.parse_docker_hosts(ctfd_config.get_config('docker_manager:docker_hosts'))
+    )
+    docker_utils.state_index.start(docker_utils.get_docker_hosts())
+    docker_utils.admission.configure(_get_int_setting('max_concurrent_creates', docker_utils.MAX_CONCURRENT_CREATES))
+    try:
+        docker_utils.configure_memory_budget(
+            docker_utils.parse_mem_limit(ctfd_config.get_config('docker_manager:host_memory_budget'))
+        )
+    except ValueError:
+        log.error("Invalid host memory budget setting; ignoring it.")
+        docker_utils.configure_memory_budget(0)
+    docker_utils.idle.configure(_get_int_setting('idle_pause_after'))
+    docker_utils.cores.configure(_get_int_setting('cpu_pinning'), _get_int_setting('numa_nodes', 1))
+    try:
+        docker_utils.host_ports.configure(
+            docker_utils.parse_port_range(ctfd_config.get_config('docker_manager:host_port_range'))
+        )
+    except ValueError:
+        log.error("Invalid host port range setting; leaving ports to Docker.")
+        docker_utils.host_ports.configure(None)
+    try:
+        docker_utils.image_gc.configure(
+            docker_utils.parse_mem_limit(ctfd_config.get_config('docker_manager:image_cache_budget'))
+        )
+    except ValueError:
+        log.error("Invalid image cache budget setting; not evicting images.")
+        docker_utils.image_gc.configure(0)
+    docker_utils.readiness.configure(ctfd_config.get_config('docker_manager:ready_probe_address'))
+
+
+def _teardown_instances(instances):
+    """Tears down instances concurrently and deletes their rows (caller commits)."""
+    for instance in instances:
+        docker_utils.reaper.cancel(instance.container_id)
+    docker_utils.teardown_containers((instance.docker_host, instance.container_id) for instance in instances)
+    for instance in instances:
+        db.session.delete(instance)
+
+
+def _reconcile_instances():
+    """Rebuilds instance state from the daemons after a restart.
+
+    Lists managed containers on every configured host in one pass, then:
+    removes containers whose challenge is gone or whose deadline passed,
+    removes warm pool containers whose challenge no longer has a pool,
+    re-creates rows for live containers the table lost, drops rows whose
+    container vanished, and re-arms every remaining deadline.
+
+    Runs in the leader only; other workers just call _restore_worker_state().
+    """
+    now = datetime.datetime.utcnow()
+    challenge_ids = {c.id for c in Challenges.query.filter_by(type=DockerChallengeType.id).all()}
+    rows = {row.container_id: row for row in DockerChallengeContainers.query.all()}
+    listed_hosts = set()
+    seen = set()
+    doomed = []
+
+    for host in docker_utils.get_docker_hosts():
+        try:
+            summaries = list(docker_utils.iter_managed_containers(None, docker_host=host.url, strict=True))
+        except Exception as e:
+            log.error(f"Reconciliation skipped Docker host '{host.name}': {e}")
+            continue
+        listed_hosts.add(host.url)
+        entry_stacks = {summary["labels"].get(docker_utils.STACK_LABEL) for summary in summaries
+                        if not summary["labels"].get(docker_utils.SERVICE_LABEL)}
+        for summary in summaries:
+            docker_utils.state_index.put(summary)
+            if summary["labels"].get(docker_utils.SERVICE_LABEL):
+                # Stack services go with their entry container; remove any left without one
+                if summary["labels"].get(docker_utils.STACK_LABEL) not in entry_stacks:
+                    doomed.append((host.url, summary["id"]))
+                continue
+            name_match = docker_utils.INSTANCE_NAME_RE.match(summary["name"])
+            if not name_match:
+                # Idle warm pool containers are managed by the pool, as long as it still exists
+                if summary["labels"].get("ctfd_pool") == "true" and summary["name"].startswith("ctfd-pool-"):
+                    try:
+                        pool_challenge_id = int(summary["labels"].get("challenge_id"))
+                        pool_spec = _get_launch_spec(pool_challenge_id) if pool_challenge_id in challenge_ids else None
+                    except (TypeError, ValueError):
+                        pool_spec = None
+                    if pool_spec is None or not pool_spec.pool_size:
+                        doomed.append((host.url, summary["id"]))
+                continue
+            try:
+                challenge_id = int(summary["labels"].get("challenge_id") or name_match.group(3))
+            except ValueError:
+                continue
+            row = rows.get(summary["id"])
+            if challenge_id not in challenge_ids:
+                doomed.append((host.url, summary["id"]))
+                continue
+            if row is None:
+                try:
+                    spec = _get_launch_spec(challenge_id)
+                except ValueError:
+                    spec = None
+                timeout = spec.timeout if spec else 3600
+                created = datetime.datetime.utcfromtimestamp(summary["created"]) if summary["created"] else now
+                public_host = host.public_address
+                connection_info = {
+                    port.split('/')[0]: f"{public_host}:{host_port}" for port, host_port in summary["ports"].items()
+                } if public_host else {}
+                # Claimed pool containers only carry the owner in their name
+                user_id = summary["labels"].get("user_id") or name_match.group(1)
+                team_id = summary["labels"].get("team_id") or name_match.group(2)
+                row = DockerChallengeContainers(
+                    user_id=int(user_id) if user_id else None,
+                    team_id=int(team_id) if team_id else None,
+                    challenge_id=challenge_id,
+                    container_id=summary["id"],
+                    container_name=summary["name"],
+                    docker_host=host.url,
+                    ip_address=public_host,
+                    port=int(next(iter(summary["ports"].values()), 0)) or None,
+                    connection_info=connection_info,
+                    expires=created + datetime.timedelta(seconds=timeout)
+                )
+                try:
+                    # Savepoint: a start job may record the same container meanwhile
+                    with db.session.begin_nested():
+                        db.session.add(row)
+                except IntegrityError:
+                    continue
+                rows[summary["id"]] = row
+                log.info(f"Re-adopted orphaned instance '{summary['name']}' on '{host.name}'.")
+            seen.add(summary["id"])
+            if row.expires and row.expires <= now:
+                doomed.append((host.url, summary["id"]))
+
+    doomed_ids = {container_id for _, container_id in doomed}
+    for container_id, row in rows.items():
+        if container_id in doomed_ids or (row.docker_host in listed_hosts and container_id not in seen):
+            db.session.delete(row)
+        elif row.expires:
+            docker_utils.reaper.schedule(container_id, _expiry_timestamp(row.expires))
+    db.session.commit()
+
+    if doomed:
+        docker_utils.teardown_containers(doomed)
+    # Stack networks left behind by removed instances or a previous run
+    for host in docker_utils.get_docker_hosts():
+        if host.url in listed_hosts:
+            try:
+                docker_utils.networks.prune(docker_utils.get_docker_client(host.url))
+            except Exception as e:
+                log.error(f"Could not prune networks on Docker host '{host.name}': {e}")
+    log.info(f"Reconciled {len(seen)} instance(s); removed {len(doomed)} expired or orphaned container(s).")
+
+
+def _restore_worker_state():
+    """Restores this worker's in-memory state after a restart.
+
+    Rebuilds the host port allocator from each daemon and re-arms the
+    reaper with every recorded deadline. Runs in every worker; the daemon
+    sweep itself is left to the leader (see _reconcile_instances()), and
+    reap_instance() makes sure only one worker stops each expired instance.
+    """
+    for host in docker_utils.get_docker_hosts():
+        try:
+            docker_utils.host_ports.rebuild(docker_utils.get_docker_client(host.url))
+        except Exception as e:
+            log.error(f"Could not rebuild host ports of Docker host '{host.name}': {e}")
+    for row in DockerChallengeContainers.query.filter(DockerChallengeContainers.expires.isnot(None)).all():
+        docker_utils.reaper.schedule(row.container_id, _expiry_timestamp(row.expires))
+
+
+def _expiry_timestamp(expires):
+    """Converts a naive UTC expiry datetime into epoch seconds for the reaper."""
+    return expires.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def _render_connection_html(connection_info):
+    """Builds the HTML snippet shown under the start button."""
+    if not connection_info:
+        return "Instance started, but no mapped ports found to display connection info."
+    parts = ''.join(f"<li>Port {port}: <code>{value}</code></li>" for port, value in connection_info.items())
+    return f"Instance started successfully. Connect using:<ul>{parts}</ul>"
+
+
+def _refresh_launch_spec(challenge):
+    """Rebuilds the cached launch spec (and warm pool, tracked images) for a docker challenge."""
+    docker_utils.invalidate_launch_spec(challenge.id)
+    type_data = challenge.type_data if isinstance(challenge.type_data, dict) else {}
+    try:
+        spec = docker_utils.LaunchSpec.from_type_data(challenge.id, type_data)
+    except ValueError as e:
+        log.error(f"Invalid docker configuration for challenge {challenge.id}: {e}")
+        docker_utils.warm_pool.remove(challenge.id)
+        docker_utils.image_gc.untrack(challenge.id)
+        return None
+    docker_utils.cache_launch_spec(spec)
+    docker_utils.image_gc.track(spec)
+    if spec.pool_size:
+        docker_utils.warm_pool.configure(spec)
+    else:
+        docker_utils.warm_pool.remove(challenge.id)
+    return spec
+
+
+def _prefetch_images(spec, type_data, refresh=False):
+    """Pulls every image a challenge runs (all stack services) in the background."""
+    images = {spec.image_name, *(service.image_name for service in spec.services)} if spec else {type_data.get('docker_image')}
+    for image in filter(None, images):
+        if refresh:
+            docker_utils.invalidate_image(image)
+        docker_utils.prefetch_image(image)
+
+
+def _running_instance_response(instance, spec):
+    """Status payload for an instance that is up; wakes it if it was paused while idle."""
+    docker_utils.idle.wake(instance.container_id, instance.docker_host)
+    return {
+        "success": True,
+        "status": docker_utils.JOB_READY,
+        "message": "Challenge instance is running.",
+        "connection_info": instance.connection_info or {},
+        "display_html": _render_connection_html(instance.connection_info),
+        "expires": instance.expires.isoformat() if instance.expires else None,
+        "scope": spec.scope if spec else docker_utils.SCOPE_USER,
+    }
+
+
+def _get_launch_spec(challenge_id):
+    """Returns the launch spec for a docker challenge, building it on a cache miss.
+
+    Returns:
+        docker_utils.LaunchSpec: The spec, or None if there is no such docker challenge.
+
+    Raises:
+        ValueError: If the challenge's docker configuration is invalid.
+    """
+    spec = docker_utils.get_cached_launch_spec(challenge_id)
+    if spec:
+        return spec
+    challenge = Challenges.query.filter_by(id=challenge_id, type=DockerChallengeType.id).first()
+    if not challenge:
+        return None
+    type_data = challenge.type_data if isinstance(challenge.type_data, dict) else {}
+    spec = docker_utils.LaunchSpec.from_type_data(challenge.id, type_data)
+    docker_utils.cache_launch_spec(spec)
+    docker_utils.image_gc.track(spec)
+    return spec
+
+
+def _instance_owner(spec, user_id, team_id):
+    """(scope, owner ID) of the instance a player uses; per-user when the spec is unavailable."""
+    return spec.owner(user_id, team_id) if spec else (docker_utils.SCOPE_USER, user_id)
+
+
+def _instance_criteria(challenge_id, user_id, team_id, spec):
+    """Filter criteria selecting the instance row a player uses, per the challenge's instance scope."""
+    scope, owner_id = _instance_owner(spec, user_id, team_id)
+    criteria = [DockerChallengeContainers.challenge_id == challenge_id]
+    if scope == docker_utils.SCOPE_TEAM:
+        criteria.append(DockerChallengeContainers.team_id == owner_id)
+    elif scope == docker_utils.SCOPE_USER:
+        criteria.append(DockerChallengeContainers.user_id == owner_id)
+    return criteria
+
+
+def _instance_query(challenge_id, user_id, team_id, spec):
+    return DockerChallengeContainers.query.filter(*_instance_criteria(challenge_id, user_id, team_id, spec))
+
+
+def _start_job_key(challenge_id, user_id, team_id, spec):
+    """Key a start is tracked under; everyone sharing the instance shares the job."""
+    return _instance_owner(spec, user_id, team_id), challenge_id
+
+
+def _get_launch_spec_or_none(challenge_id):
+    try:
+        return _get_launch_spec(challenge_id)
+    except ValueError:
+        return None
+
+
+def _release_on_solve(user, team, challenge):
+    """Expires a solved challenge's instance now, if it is set to stop on solve.
+
+    Only the row is touched here; the expiry reaper tears the container down
+    on its own workers, so the submission request does not wait on Docker.
+    """
+    spec = _get_launch_spec_or_none(challenge.id)
+    if not spec or not spec.stop_on_solve or spec.scope == docker_utils.SCOPE_GLOBAL:
+        return # A shared global instance stays up for everyone else
+    instance = _instance_query(challenge.id, user.id, team.id if team else None, spec).first()
+    if not instance:
+        return
+    instance.expires = datetime.datetime.utcnow()
+    db.session.commit()
+    docker_utils.reaper.schedule(instance.container_id, _expiry_timestamp(instance.expires))
+    docker_utils.metrics.inc("solve_releases_total")
+    log.info(f"Challenge {challenge.id} solved; releasing instance {instance.container_id}.")
 
 
 # --- Custom Challenge Type (Recommended Approach) ---
@@ -83,11 +508,16 @@ class DockerChallengeType(BaseChallenge):
         type_data['docker_cpu_limit'] = data.get('docker_cpu_limit')
         type_data['docker_mem_limit'] = data.get('docker_mem_limit')
         type_data['docker_timeout'] = data.get('docker_timeout', 3600)
+        type_data['docker_pool_size'] = data.get('docker_pool_size', 0)
+        type_data['docker_scope'] = data.get('docker_scope') or docker_utils.SCOPE_USER
+        type_data['docker_stop_on_solve'] = data.get('docker_stop_on_solve') or 'false'
+        type_data['docker_stack'] = data.get('docker_stack') or ''
         challenge.type_data = type_data
         challenge.type = DockerChallengeType.id # Ensure type is set
 
         db.session.add(challenge)
         db.session.commit()
+        _prefetch_images(_refresh_launch_spec(challenge), type_data)
         return challenge
 
     @staticmethod
@@ -115,7 +545,11 @@ class DockerChallengeType(BaseChallenge):
             'docker_env': type_data.get('docker_env', ''), # e.g., "VAR1=val1,VAR2=val2"
             'docker_cpu_limit': type_data.get('docker_cpu_limit', ''),
             'docker_mem_limit': type_data.get('docker_mem_limit', ''),
-            'docker_timeout': type_data.get('docker_timeout', 3600) # Default 1 hour
+            'docker_timeout': type_data.get('docker_timeout', 3600), # Default 1 hour
+            'docker_pool_size': type_data.get('docker_pool_size', 0), # Pre-started idle instances
+            'docker_scope': type_data.get('docker_scope') or docker_utils.SCOPE_USER, # user, team or global
+            'docker_stop_on_solve': type_data.get('docker_stop_on_solve') or 'false', # Release the instance once solved
+            'docker_stack': type_data.get('docker_stack') or '' # JSON services definition for multi-container challenges
         }
         return data
 
@@ -139,9 +573,15 @@ class DockerChallengeType(BaseChallenge):
         type_data['docker_cpu_limit'] = data.get('docker_cpu_limit')
         type_data['docker_mem_limit'] = data.get('docker_mem_limit')
         type_data['docker_timeout'] = data.get('docker_timeout')
+        type_data['docker_pool_size'] = data.get('docker_pool_size', 0)
+        type_data['docker_scope'] = data.get('docker_scope') or docker_utils.SCOPE_USER
+        type_data['docker_stop_on_solve'] = data.get('docker_stop_on_solve') or 'false'
+        type_data['docker_stack'] = data.get('docker_stack') or ''
         challenge.type_data = type_data # Make sure this is updated
 
         db.session.commit()
+        # The tags may point at new images now; drop the cached digests and re-pull
+        _prefetch_images(_refresh_launch_spec(challenge), type_data, refresh=True)
         return challenge
 
     @staticmethod
@@ -150,6 +590,10 @@ class DockerChallengeType(BaseChallenge):
         This method is used to delete the resources used by a challenge.
         Includes standard CTFd cleanup.
         """
+        docker_utils.warm_pool.remove(challenge.id)
+        docker_utils.invalidate_launch_spec(challenge.id)
+        docker_utils.image_gc.untrack(challenge.id)
+        _teardown_instances(DockerChallengeContainers.query.filter_by(challenge_id=challenge.id).all())
         Fails.query.filter_by(challenge_id=challenge.id).delete()
         Solves.query.filter_by(challenge_id=challenge.id).delete()
         Flags.query.filter_by(challenge_id=challenge.id).delete()
@@ -177,8 +621,7 @@ class DockerChallengeType(BaseChallenge):
 
         for flag in flags:
             if get_flag_class(flag.type).compare(flag, submission):
-                # Potentially stop container on correct solve?
-                # stop_user_container(user.id, challenge.id) # Implement this function later
+                # The instance is released in solve(), once the solve is recorded
                 return True, "Correct"
 
         return False, "Incorrect"
@@ -190,8 +633,12 @@ class DockerChallengeType(BaseChallenge):
         Standard solve processing.
         """
         super(DockerChallengeType, DockerChallengeType).solve(user, team, challenge, request)
-        # Optionally stop container on solve
-        # stop_user_container(user.id, challenge.id) # Implement this function later
+        # Stop on solve (per challenge); never let cleanup break the solve itself
+        try:
+            _release_on_solve(user, team, challenge)
+        except Exception as e:
+            db.session.rollback()
+            log.exception(f"Failed to release instance after solving challenge {challenge.id}: {e}")
 
     @staticmethod
     def fail(user, team, challenge, request):
@@ -226,22 +673,49 @@ def load(app):
     def admin_config_page_func(): # Renamed function slightly for clarity
         if request.method == 'POST':
             # Save settings logic here (using CTFd.utils.config.set_config)
-            # Example:
-            # ctfd_config.set_config('docker_manager:docker_host', request.form.get('docker_host'))
-            # ctfd_config.set_config('docker_manager:default_timeout', request.form.get('default_timeout'))
+            ctfd_config.set_config('docker_manager:docker_hosts', request.form.get('docker_hosts', '').strip())
+            for key in ADMISSION_SETTINGS + IDLE_SETTINGS + CPU_SETTINGS + PORT_SETTINGS + IMAGE_SETTINGS + READY_SETTINGS:
+                ctfd_config.set_config(f'docker_manager:{key}', request.form.get(key, '').strip())
+            _load_settings()
             flash(f'{PLUGIN_NAME} settings updated successfully!', 'success')
             # Use the correct endpoint name for url_for
             return redirect(url_for(f'{PLUGIN_FOLDER}_admin_config.admin_config_page_view'))
 
         # Load settings for display (using CTFd.utils.config.get_config)
-        # Example:
-        # config = {
-        #     'docker_host': ctfd_config.get_config('docker_manager:docker_host'),
-        #     'default_timeout': ctfd_config.get_config('docker_manager:default_timeout')
-        # }
-        config = {} # Placeholder
+        config = {
+            'docker_hosts': ctfd_config.get_config('docker_manager:docker_hosts') or '',
+        }
+        for key in ADMISSION_SETTINGS + IDLE_SETTINGS + CPU_SETTINGS + PORT_SETTINGS + IMAGE_SETTINGS + READY_SETTINGS:
+            config[key] = ctfd_config.get_config(f'docker_manager:{key}') or ''
         return render_template("docker_manager_config.html", config=config)
 
+    # --- Admin API: Instance Listing ---
+    @admins_only
+    def admin_instances_func():
+        query = DockerChallengeContainers.query
+        challenge_id = request.args.get('challenge_id', type=int)
+        if challenge_id:
+            query = query.filter_by(challenge_id=challenge_id)
+        instances = query.order_by(DockerChallengeContainers.expires).all()
+        return {"success": True, "data": [instance.to_dict() for instance in instances]}
+
+    # --- Admin API: Bulk Stop --- (All instances, or all of one challenge)
+    @admins_only
+    def admin_stop_instances_func():
+        query = DockerChallengeContainers.query
+        challenge_id = request.args.get('challenge_id', type=int)
+        if challenge_id:
+            query = query.filter_by(challenge_id=challenge_id)
+        instances = query.all()
+        _teardown_instances(instances)
+        db.session.commit()
+        return {"success": True, "message": f"Stopped {len(instances)} instance(s)."}
+
+    # --- Admin API: Metrics --- (Prometheus text format; values are per worker process)
+    @admins_only
+    def admin_metrics_func():
+        return docker_utils.metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
     # Create and register the blueprint for admin configuration routes
     admin_bp = Blueprint(
         f'{PLUGIN_FOLDER}_admin_config', # More specific blueprint name
@@ -250,6 +724,9 @@ def load(app):
         url_prefix=f'/admin/plugins/{PLUGIN_FOLDER}'
     )
     admin_bp.add_url_rule('', 'admin_config_page_view', admin_config_page_func, methods=['GET', 'POST'])
+    admin_bp.add_url_rule('/instances', 'admin_instances', admin_instances_func, methods=['GET'])
+    admin_bp.add_url_rule('/instances/stop', 'admin_stop_instances', admin_stop_instances_func, methods=['POST'])
+    admin_bp.add_url_rule('/metrics', 'admin_metrics', admin_metrics_func, methods=['GET'])
     app.register_blueprint(admin_bp)   # Register assets (No longer needed explicitly for challenge types with blueprints)
     # register_plugin_assets_directory(app, base_path=f'/plugins/{PLUGIN_FOLDER}/assets/')
 
@@ -259,136 +736,401 @@ def load(app):
 
 
 
+    # --- Background Start Job (runs on docker_utils.start_jobs workers) ---
+    def run_start_job(job, user_id, team_id, spec, display_host):
+        challenge_id = spec.challenge_id
+        with app.app_context():
+            job.update(docker_utils.JOB_STARTING, "Preparing instance...")
+
+            # --- Settings --- (Admins may have changed them from another worker)
+            _load_settings()
+
+            def report_position(position):
+                job.update(docker_utils.JOB_QUEUED, f"Queued, position {position}...", position=position)
+
+            def report_progress(stage, message, **detail):
+                job.update(docker_utils.JOB_STARTING, message, progress=dict(detail, stage=stage))
+
+            log.info(f"User {user_id} starting instance for challenge {challenge_id} with image {spec.image_name}")
+            container = None
+
+            # --- Reuse Previous Instance --- (Healthy: returned as is; stopped: restarted; changed spec: recreated)
+            # For team/global scope this is how teammates attach to the instance already running
+            previous = _instance_query(challenge_id, user_id, team_id, spec).first()
+            if previous:
+                client = docker_utils.get_docker_client(previous.docker_host)
+                if client:
+                    job.update(docker_utils.JOB_STARTING, "Checking existing instance...")
+                    # A running instance is handed back right away; only a restart or recreate waits for a slot
+                    container = docker_utils.find_running_instance(client, spec, user_id, team_id)
+                if client and not container:
+                    with docker_utils.admission.slot(previous.docker_host, on_wait=report_position) as admitted:
+                        if admitted:
+                            container = docker_utils.start_challenge_container(
+                                client=client,
+                                image_name=spec.image_name,
+                                user_id=user_id,
+                                challenge_id=challenge_id,
+                                docker_host=previous.docker_host,
+                                launch_spec=spec,
+                                team_id=team_id,
+                                progress=report_progress
+                            )
+                if not container or container.id != previous.container_id:
+                    docker_utils.reaper.cancel(previous.container_id)
+
+            # --- Start Container --- (Using docker_utils)
+            # Prefer an already-running container from the warm pool
+            if not container:
+                container = docker_utils.warm_pool.claim(spec, spec.instance_name(user_id, team_id))
+            if not container:
+                # --- Placement & Admission --- (Wait for a create slot on the chosen daemon)
+                host, client = docker_utils.choose_docker_host(spec.image_name, spec.total_mem_bytes)
+                if not client:
+                    log.error(f"No Docker host available for user {user_id}, challenge {challenge_id}")
+                    job.update(docker_utils.JOB_FAILED, "No Docker host has capacity for a new instance right now. Please try again shortly.")
+                    return
+
+                with docker_utils.admission.slot(host.url, on_wait=report_position) as admitted:
+                    if not admitted:
+                        job.update(docker_utils.JOB_FAILED, "Timed out waiting for a free slot. Please try again shortly.")
+                        return
+                    job.update(docker_utils.JOB_STARTING, "Starting container...")
+                    container = docker_utils.start_challenge_container(
+                        client=client,
+                        image_name=spec.image_name,
+                        user_id=user_id,
+                        challenge_id=challenge_id,
+                        docker_host=host.url,
+                        launch_spec=spec,
+                        team_id=team_id,
+                        progress=report_progress
+                    )
+
+            if not container:
+                log.error(f"Failed to start container for user {user_id}, challenge {challenge_id}")
+                job.update(docker_utils.JOB_FAILED, "Failed to start challenge instance. Please try again or contact an admin.")
+                return
+
+            host = docker_utils.get_docker_host(container.labels.get(docker_utils.HOST_LABEL))
+            client = docker_utils.get_docker_client(host.url)
+            # Players reach the container through its host's public address, if configured
+            public_host = host.public_address or display_host
+
+            # --- Get Connection Info --- (Improved logic)
+            try:
+                # start_challenge_container()/claim() return fresh inspect data; index it instead of reloading again
+                summary = docker_utils.state_index.put_attrs(container.attrs, host.url)
+                connection_info = {}
+                first_port = None
+
+                # Extract mapped ports
+                for container_port_proto in spec.ports_config:
+                    host_port = summary["ports"].get(container_port_proto)
+                    if host_port:
+                        connection_key = container_port_proto.split('/')[0] # Just the port number for display key
+                        connection_info[connection_key] = f"{public_host}:{host_port}"
+                        first_port = first_port or int(host_port)
+                    else:
+                        log.warning(f"Could not find host port mapping for {container_port_proto} in container {container.id}")
+
+                # --- Record Instance --- (Replaces any previous row for this user/challenge)
+                expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=spec.timeout)
+                _instance_query(challenge_id, user_id, team_id, spec).delete()
+                DockerChallengeContainers.query.filter_by(container_id=container.id).delete()
+                db.session.add(DockerChallengeContainers(
+                    user_id=user_id,
+                    team_id=team_id,
+                    challenge_id=challenge_id,
+                    container_id=container.id,
+                    container_name=container.name,
+                    docker_host=host.url,
+                    ip_address=public_host,
+                    port=first_port,
+                    connection_info=connection_info,
+                    expires=expires
+                ))
+                db.session.commit()
+                docker_utils.reaper.schedule(container.id, _expiry_timestamp(expires))
+
+                def report_ready(service_ready):
+                    if service_ready is False:
+                        log.warning(f"Instance {container.id} is running but its ports did not accept connections in time")
+                    job.update(docker_utils.JOB_READY, "Challenge instance started successfully!" if service_ready is not False else
+                               "Challenge instance started, but the service is still starting up. Give it a moment.", result={
+                        "scope": spec.scope,
+                        "service_ready": service_ready, # None when not probed
+                        "connection_info": connection_info, # Dict: {'80': 'ctfd.example.com:32768'}
+                        "display_html": _render_connection_html(connection_info) # HTML formatted string for display
+                    })
+
+                # --- Readiness --- (If enabled, report ready once the service answers; probed off the start pool)
+                tcp_ports = [host_port for port, host_port in summary["ports"].items() if port.endswith('/tcp')]
+                probe_address = docker_utils.readiness.address_for(host.url)
+                if not tcp_ports or not probe_address:
+                    report_ready(None)
+                    return None
+                report_progress("ready", "Waiting for the challenge service to come up...")
+                return docker_utils.readiness.submit(report_ready, probe_address, tcp_ports, on_retry=lambda attempt, pending: report_progress(
+                    "ready", "Waiting for the challenge service to come up...", attempt=attempt, pending=len(pending)
+                ))
+            except Exception as e:
+                log.exception(f"Error retrieving connection info for container {container.id}: {e}")
+                db.session.rollback()
+                if previous and container.id == previous.container_id:
+                    # The player's existing instance; a transient error is no reason to kill it
+                    job.update(docker_utils.JOB_FAILED, "Failed to retrieve connection details. Please try again.")
+                    return
+                # Attempt to stop the container this job created or claimed if we can't get info
+                docker_utils.stop_container(client, container.id)
+                job.update(docker_utils.JOB_FAILED, "Instance started but failed to retrieve connection details. Instance stopped.")
+
     # --- API Endpoint for Starting Container (called from challenge view JS) ---
     @app.route(f'/plugins/{PLUGIN_FOLDER}/api/start_instance/<int:challenge_id>', methods=['POST'])
     @authed_only # Ensure user is logged in
+    @docker_utils.metrics.timer("api_start")
     def start_instance_api(challenge_id):
         user = get_current_user()
-        challenge = Challenges.query.filter_by(id=challenge_id).first_or_404()
-
-        if challenge.type != DockerChallengeType.id:
-            log.warning(f"User {user.id} attempted to start non-docker challenge {challenge_id}")
+        # --- Get Challenge Config --- (Precompiled launch spec; one cached lookup)
+        try:
+            spec = _get_launch_spec(challenge_id)
+        except ValueError as e:
+            log.error(f"Invalid docker configuration for challenge {challenge_id}: {e}")
+            return {"success": False, "message": str(e)}, 500
+        if not spec:
+            log.warning(f"User {user.id} attempted to start missing or non-docker challenge {challenge_id}")
             return {"success": False, "message": "Challenge is not a Docker challenge."}, 400
 
-        # --- Get Docker Client --- (Read host from config later)
-        # docker_host = ctfd_config.get_config('docker_manager:docker_host')
-        docker_host = None # Use default from environment for now
-        client = docker_utils.get_docker_client(docker_host)
-        if not client:
-            log.error("Failed to get Docker client for starting instance.")
-            return {"success": False, "message": "Failed to connect to Docker service. Please contact an admin."}, 500
-
-        # --- Get Challenge Config --- (Using the read method)
-        challenge_data = DockerChallengeType.read(challenge)
-        image_name = challenge_data.get('docker_image')
-        ports_str = challenge_data.get('docker_ports', '') # e.g., "80:8080, 22:2222/udp"
-        env_str = challenge_data.get('docker_env', '') # e.g., "VAR1=val1,VAR2=val2"
-        cpu_limit = challenge_data.get('docker_cpu_limit')
-        mem_limit = challenge_data.get('docker_mem_limit')
-        # timeout = challenge_data.get('docker_timeout', 3600) # Need to handle timeout later
-
-        if not image_name:
-            log.error(f"Docker image not configured for challenge {challenge_id}")
-            return {"success": False, "message": "Docker image not configured for this challenge."}, 500
-
-        # --- Parse Ports --- (Improved parsing)
-        ports_config = {}
-        if ports_str:
+        team = get_current_team()
+        team_id = team.id if team else None
+
+        # --- Running Instance --- (Handed back at once instead of queueing behind creates)
+        instance = _instance_query(challenge_id, user.id, team_id, spec).first()
+        if instance and docker_utils.is_current_instance(instance.docker_host, instance.container_id, spec):
+            docker_utils.metrics.inc("container_starts_total", outcome="reused")
+            return _running_instance_response(instance, spec)
+
+        # --- Admission Limits --- (Cheap indexed counts; restarting this challenge replaces its instance)
+        others = DockerChallengeContainers.query.filter(DockerChallengeContainers.challenge_id != challenge_id)
+        max_per_user = _get_int_setting('max_instances_per_user')
+        if max_per_user and others.filter_by(user_id=user.id).count() >= max_per_user:
+            docker_utils.metrics.inc("start_rejections_total", reason="user_limit")
+            return {"success": False, "message": f"You can run at most {max_per_user} instance(s) at a time. Stop one first."}, 429
+        max_per_team = _get_int_setting('max_instances_per_team')
+        if team_id and max_per_team and others.filter_by(team_id=team_id).count() >= max_per_team:
+            docker_utils.metrics.inc("start_rejections_total", reason="team_limit")
+            return {"success": False, "message": f"Your team can run at most {max_per_team} instance(s) at a time. Stop one first."}, 429
+        max_per_challenge = _get_int_setting('max_instances_per_challenge')
+        if max_per_challenge:
+            # Instances of this challenge other than the one this player uses (and would replace or share)
+            running = DockerChallengeContainers.query.filter(
+                DockerChallengeContainers.challenge_id == challenge_id,
+                db.not_(db.and_(*_instance_criteria(challenge_id, user.id, team_id, spec)))
+            ).count()
+            if running >= max_per_challenge:
+                docker_utils.metrics.inc("start_rejections_total", reason="challenge_limit")
+                return {"success": False, "message": "This challenge is at capacity right now. Please try again shortly."}, 429
+
+        # Using request.host assumes CTFd and Docker containers are accessible via the same domain/IP.
+        display_host = request.host.split(':')[0]
+        job = docker_utils.start_jobs.submit(
+            _start_job_key(challenge_id, user.id, team_id, spec), run_start_job, user.id, team_id, spec, display_host
+        )
+        if not job:
+            log.warning(f"Start queue full, rejecting start for user {user.id}, challenge {challenge_id}")
+            docker_utils.metrics.inc("start_rejections_total", reason="queue_full")
+            return {"success": False, "message": "Too many instances are starting right now. Please try again shortly."}, 503
+        return job.to_dict(), 202
+
+    # --- API Endpoint for Instance Status (polled by challenge view JS) ---
+    @app.route(f'/plugins/{PLUGIN_FOLDER}/api/instance_status/<int:challenge_id>', methods=['GET'])
+    @authed_only
+    def instance_status_api(challenge_id):
+        user = get_current_user()
+        team = get_current_team()
+        team_id = team.id if team else None
+        spec = _get_launch_spec_or_none(challenge_id)
+        job = docker_utils.start_jobs.get(_start_job_key(challenge_id, user.id, team_id, spec))
+        if not job:
+            # Started by another worker process, by a teammate, or before a restart
+            instance = _instance_query(challenge_id, user.id, team_id, spec).first()
+            if instance and docker_utils.state_index.is_live(instance.docker_host):
+                # Served from the event-driven index; no daemon call
+                summary = docker_utils.state_index.get(instance.container_id)
+                # Give another worker's brand-new container time to show up in our event stream
+                settled = instance.created and datetime.datetime.utcnow() - instance.created > datetime.timedelta(seconds=30)
+                if (summary and summary["state"] in ("exited", "dead")) or (not summary and settled):
+                    docker_utils.reaper.cancel(instance.container_id)
+                    db.session.delete(instance)
+                    db.session.commit()
+                    return {"success": True, "status": "none", "message": "Your instance is no longer running."}
+            if instance:
+                return _running_instance_response(instance, spec)
+            return {"success": True, "status": "none", "message": "No instance requested."}
+
+        if job.status == docker_utils.JOB_READY:
+            instance = _instance_query(challenge_id, user.id, team_id, spec).first()
+            if instance:
+                docker_utils.idle.wake(instance.container_id, instance.docker_host)
+
+        # Optional long-poll: ?version=<last seen>&wait=<seconds>
+        wait = min(request.args.get('wait', 0, type=float), 25)
+        if wait > 0:
+            job.wait(request.args.get('version', -1, type=int), wait)
+        return job.to_dict()
+
+    # --- API Endpoint for Start Progress (server-sent events for challenge view JS) ---
+    @app.route(f'/plugins/{PLUGIN_FOLDER}/api/instance_events/<int:challenge_id>', methods=['GET'])
+    @authed_only
+    def instance_events_api(challenge_id):
+        user = get_current_user()
+        team = get_current_team()
+        spec = _get_launch_spec_or_none(challenge_id)
+        job = docker_utils.start_jobs.get(_start_job_key(challenge_id, user.id, team.id if team else None, spec))
+        if job and not job.finished:
+            updates = job.follow(EVENT_STREAM_KEEPALIVE, EVENT_STREAM_MAX_DURATION)
+        else:
+            # Nothing in progress in this worker; send the current state once
+            updates = [instance_status_api(challenge_id)]
+
+        def stream():
+            for data in updates:
+                if data is None:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"id: {data.get('version', 0)}\ndata: {json.dumps(data)}\n\n"
+
+        return Response(stream_with_context(stream()), mimetype="text/event-stream", headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no", # Let nginx pass events through unbuffered
+        })
+
+    # --- API Endpoint for Stopping Container ---
+    @app.route(f'/plugins/{PLUGIN_FOLDER}/api/stop_instance/<int:challenge_id>', methods=['POST'])
+    @authed_only
+    def stop_instance_api(challenge_id):
+        user = get_current_user()
+        team = get_current_team()
+        spec = _get_launch_spec_or_none(challenge_id)
+        if spec and spec.scope == docker_utils.SCOPE_GLOBAL and not is_admin():
+            return {"success": False, "message": "This instance is shared by all players and cannot be stopped."}, 403
+        instance = _instance_query(challenge_id, user.id, team.id if team else None, spec).first()
+        if not instance:
+            return {"success": False, "message": "No running instance found."}, 404
+        docker_utils.reaper.cancel(instance.container_id)
+        docker_utils.stop_container(docker_utils.get_docker_client(instance.docker_host), instance.container_id)
+        db.session.delete(instance)
+        db.session.commit()
+        return {"success": True, "message": "Challenge instance stopped."}
+
+    # --- API Endpoint for Extending an Instance ---
+    @app.route(f'/plugins/{PLUGIN_FOLDER}/api/extend_instance/<int:challenge_id>', methods=['POST'])
+    @authed_only
+    def extend_instance_api(challenge_id):
+        user = get_current_user()
+        team = get_current_team()
+        spec = _get_launch_spec_or_none(challenge_id)
+        instance = _instance_query(challenge_id, user.id, team.id if team else None, spec).first()
+        if not instance:
+            return {"success": False, "message": "No running instance found."}, 404
+        timeout = spec.timeout if spec else 3600
+        # Extending resets the clock to a full timeout from now; it never stacks
+        instance.expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=timeout)
+        db.session.commit()
+        docker_utils.reaper.schedule(instance.container_id, _expiry_timestamp(instance.expires))
+        docker_utils.idle.wake(instance.container_id, instance.docker_host)
+        return {"success": True, "message": "Challenge instance extended.", "expires": instance.expires.isoformat()}
+
+    # --- Expiry Reaper --- (Enforces docker_timeout)
+    def reap_instance(container_id):
+        # Every worker arms the deadlines it learns about (start jobs, extensions, restarts),
+        # so each expiry fires once per worker: the filtered delete below picks one of them
+        with app.app_context():
             try:
-                for port_map in ports_str.split(','):
-                    if not port_map.strip(): continue
-                    parts = port_map.strip().split(':')
-                    container_port_proto = parts[0]
-                    host_port = int(parts[1]) if len(parts) > 1 and parts[1] else None # None for dynamic assignment
-                    if '/' not in container_port_proto:
-                        container_port_proto += '/tcp' # Default to TCP
-                    ports_config[container_port_proto] = host_port
-            except Exception as e:
-                log.error(f"Error parsing ports string '{ports_str}' for challenge {challenge_id}: {e}")
-                return {"success": False, "message": f"Invalid port mapping format: {ports_str}"}, 500
+                instance = DockerChallengeContainers.query.filter_by(container_id=container_id).first()
+                if not instance:
+                    return # Already reaped or stopped elsewhere
+                now = datetime.datetime.utcnow()
+                if instance.expires and instance.expires > now:
+                    # Extended through another worker process; re-arm with the new deadline
+                    docker_utils.reaper.schedule(container_id, _expiry_timestamp(instance.expires))
+                    return
+                docker_host = instance.docker_host
+                deleted = DockerChallengeContainers.query.filter(
+                    DockerChallengeContainers.container_id == container_id,
+                    db.or_(DockerChallengeContainers.expires.is_(None), DockerChallengeContainers.expires <= now),
+                ).delete(synchronize_session=False)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            if not deleted:
+                return # Another worker reaped it first, or it was just extended
+            log.info(f"Instance {container_id} expired, stopping.")
+            docker_utils.stop_container(docker_utils.get_docker_client(docker_host), container_id)
+            # Capacity was freed; let warm pools top up without waiting for the next pass
+            docker_utils.warm_pool.request_refill()
 
-        # --- Parse Environment Variables --- (Improved parsing)
-        env_vars = {}
-        if env_str:
+    docker_utils.reaper.start(reap_instance)
+
+    # --- Settings ---
+    try:
+        _load_settings()
+    except Exception as e:
+        log.error(f"Failed to load {PLUGIN_NAME} settings: {e}")
+
+    # --- Leader Election --- (Pool refills, reconciliation and other background duties run in one worker)
+    def acquire_leader_lease(holder, ttl):
+        with app.app_context():
+            return _acquire_lease('leader', holder, ttl)
+
+    def reconcile_instances():
+        # Called in its own thread each time this worker becomes leader
+        with app.app_context():
             try:
-                for env_pair in env_str.split(','):
-                    if not env_pair.strip(): continue
-                    key, value = env_pair.strip().split('=', 1)
-                    env_vars[key] = value
+                _reconcile_instances()
             except Exception as e:
-                log.error(f"Error parsing environment variables string '{env_str}' for challenge {challenge_id}: {e}")
-                return {"success": False, "message": f"Invalid environment variable format: {env_str}"}, 500
-
-        # --- Start Container --- (Using docker_utils)
-        log.info(f"User {user.id} starting instance for challenge {challenge_id} with image {image_name}")
-        container = docker_utils.start_challenge_container(
-            client=client,
-            image_name=image_name,
-            user_id=user.id,
-            challenge_id=challenge.id,
-            ports_config=ports_config,
-            env_vars=env_vars,
-            cpu_limit=cpu_limit,
-            mem_limit=mem_limit
-        )
+                db.session.rollback()
+                log.exception(f"Instance reconciliation failed: {e}")
 
-        if not container:
-            log.error(f"Failed to start container for user {user.id}, challenge {challenge_id}")
-            return {"success": False, "message": "Failed to start challenge instance. Please try again or contact an admin."}, 500
+    docker_utils.leader.start(acquire_leader_lease, on_elected=reconcile_instances)
 
-        # --- Get Connection Info --- (Improved logic)
-        try:
-            container.reload() # Ensure attributes are up-to-date
-            attrs = container.attrs
-            connection_info = {}
-            display_info_parts = []
-
-            # Extract mapped ports
-            if ports_config:
-                for container_port_proto, _ in ports_config.items():
-                    host_ip, host_port = docker_utils.get_container_ip_port(attrs, container_port_proto)
-                    if host_port:
-                        # Determine the accessible host address
-                        # This is tricky and depends on deployment.
-                        # Using request.host assumes CTFd and Docker containers are accessible via the same domain/IP.
-                        # A configurable public host/IP might be needed for Docker daemon running elsewhere.
-                        display_host = request.host.split(':')[0]
-                        connection_key = container_port_proto.split('/')[0] # Just the port number for display key
-                        connection_value = f"{display_host}:{host_port}"
-                        connection_info[connection_key] = connection_value
-                        display_info_parts.append(f"<li>Port {container_port_proto}: <code>{connection_value}</code></li>")
-                    else:
-                        log.warning(f"Could not find host port mapping for {container_port_proto} in container {container.id}")
+    # --- Launch Specs & Warm Pools --- (Compile existing challenges, then start the refiller)
+    def load_launch_specs():
+        # Lets the leader pick up pool changes saved through other workers
+        with app.app_context():
+            specs = []
+            for docker_challenge in Challenges.query.filter_by(type=DockerChallengeType.id).all():
+                type_data = docker_challenge.type_data if isinstance(docker_challenge.type_data, dict) else {}
+                try:
+                    specs.append(docker_utils.LaunchSpec.from_type_data(docker_challenge.id, type_data))
+                except ValueError:
+                    continue
+            return specs
 
-            # Store container info (e.g., in session or DB if needed for later management/timeout)
-            # session[f'docker_instance_{challenge_id}'] = {'id': container.id, 'info': connection_info, 'expires': ...}
+    try:
+        for docker_challenge in Challenges.query.filter_by(type=DockerChallengeType.id).all():
+            _refresh_launch_spec(docker_challenge)
+    except Exception as e:
+        log.error(f"Failed to register warm pools: {e}")
+    docker_utils.warm_pool.start(load_launch_specs)
 
-            display_html = f"Instance started successfully. Connect using:<ul>{''.join(display_info_parts)}</ul>"
-            if not display_info_parts:
-                display_html = "Instance started, but no mapped ports found to display connection info."
+    # --- Worker State --- (In the background so app startup isn't blocked; the leader reconciles the daemons)
+    def restore_in_background():
+        with app.app_context():
+            try:
+                _restore_worker_state()
+            except Exception as e:
+                log.exception(f"Could not restore worker state: {e}")
 
-            return {
-                "success": True,
-                "message": "Challenge instance started successfully!",
-                "connection_info": connection_info, # Dict: {'80': 'ctfd.example.com:32768'}
-                "display_html": display_html # HTML formatted string for display
-            }
-        except Exception as e:
-            log.exception(f"Error retrieving connection info for container {container.id}: {e}")
-            # Attempt to stop the container if we can't get info
-            docker_utils.stop_container(client, container.id)
-            return {"success": False, "message": "Instance started but failed to retrieve connection details. Instance stopped."}, 500
-
-    # --- API Endpoint for Stopping Container (Optional - Placeholder) ---
-    # @app.route(f'/plugins/{PLUGIN_FOLDER}/api/stop_instance/<int:challenge_id>', methods=['POST'])
-    # @authed_only
-    # def stop_instance_api(challenge_id):
-    #     user = get_current_user()
-    #     # Retrieve container ID associated with user and challenge (from session or DB)
-    #     # container_id = ...
-    #     # client = docker_utils.get_docker_client(...)
-    #     # success = docker_utils.stop_container(client, container_id)
-    #     # return {"success": success}
+    threading.Thread(target=restore_in_background, name="ctfd-docker-restore", daemon=True).start()
+
+    # Release pooled Docker connections when the worker exits
+    # (atexit runs handlers in reverse order: drain pools, stop jobs, then close clients)
+    atexit.register(docker_utils.close_docker_clients)
+    atexit.register(docker_utils.start_jobs.shutdown)
+    atexit.register(docker_utils.readiness.shutdown)
+    atexit.register(docker_utils.warm_pool.drain)
 
     log.info(f"{PLUGIN_NAME} plugin loaded successfully.")
 
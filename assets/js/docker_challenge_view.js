@@ -47,15 +47,102 @@ function displayStatus(message, isError = false, connectionInfoHtml = null) {
     }
 }
 
+const POLL_INTERVAL_MS = 1500;
+
+function progressMessage(data) {
+    const progress = data.progress;
+    if (progress && progress.stage === 'pull' && progress.total) {
+        const percent = Math.floor(100 * progress.current / progress.total);
+        return `${data.message} ${percent}% (${progress.layers_done}/${progress.layers} layers)`;
+    }
+    if (progress && progress.stage === 'ready' && progress.attempt) {
+        return `${data.message} (check ${progress.attempt})`;
+    }
+    return data.message;
+}
+
+function handleInstanceState(data, startButton) {
+    if (!data.success) {
+        displayStatus(data.message, true);
+        startButton.textContent = 'Start Instance'; // Re-enable on error
+        startButton.disabled = false;
+        return false;
+    }
+    if (data.status === 'ready') {
+        displayStatus(data.message, false, data.display_html);
+        startButton.textContent = 'Instance Running';
+        startButton.disabled = true; // Until the instance is stopped
+        // Only admins may stop an instance shared by everyone
+        document.getElementById('stop-instance-btn').style.display = data.scope === 'global' ? 'none' : 'inline-block';
+        document.getElementById('extend-instance-btn').style.display = 'inline-block';
+        return false;
+    }
+    if (data.status === 'queued' || data.status === 'starting') {
+        displayStatus(progressMessage(data), false);
+        startButton.disabled = true;
+        startButton.textContent = 'Starting...';
+        return true; // Keep polling
+    }
+    return false;
+}
+
 document.addEventListener('DOMContentLoaded', () => {
     const startButton = document.getElementById('start-instance-btn');
     const challengeId = startButton.getAttribute('data-challenge-id');
-    const apiUrl = CTFd.config.urlRoot + `/plugins/ctfd_docker_manager/api/start_instance/${challengeId}`;
+    const apiBase = CTFd.config.urlRoot + '/plugins/docker_challenges/api';
+    const apiUrl = `${apiBase}/start_instance/${challengeId}`;
+    const statusUrl = `${apiBase}/instance_status/${challengeId}`;
+    const eventsUrl = `${apiBase}/instance_events/${challengeId}`;
+    const stopUrl = `${apiBase}/stop_instance/${challengeId}`;
+    const stopButton = document.getElementById('stop-instance-btn');
+    const extendUrl = `${apiBase}/extend_instance/${challengeId}`;
+    const extendButton = document.getElementById('extend-instance-btn');
+    let pollTimer = null;
+    let eventSource = null;
+
+    // Stream progress while a start is in flight; fall back to polling without EventSource
+    function follow() {
+        if (!window.EventSource) {
+            pollTimer = setTimeout(pollStatus, POLL_INTERVAL_MS);
+            return;
+        }
+        if (eventSource) {
+            eventSource.close();
+        }
+        eventSource = new EventSource(eventsUrl);
+        eventSource.onmessage = event => {
+            if (!handleInstanceState(JSON.parse(event.data), startButton)) {
+                eventSource.close();
+                eventSource = null;
+            }
+        };
+        eventSource.onerror = () => {
+            // Stream ended or failed; check in again shortly
+            eventSource.close();
+            eventSource = null;
+            pollTimer = setTimeout(pollStatus, POLL_INTERVAL_MS);
+        };
+    }
+
+    function pollStatus() {
+        CTFd.fetch(statusUrl, { method: 'GET' })
+        .then(response => response.json())
+        .then(data => {
+            if (handleInstanceState(data, startButton)) {
+                follow();
+            }
+        })
+        .catch(error => {
+            console.error('Error polling instance status:', error);
+            pollTimer = setTimeout(pollStatus, POLL_INTERVAL_MS * 2);
+        });
+    }
 
     startButton.addEventListener('click', () => {
         startButton.disabled = true;
         startButton.textContent = 'Starting...';
         displayStatus('Requesting instance...', false);
+        clearTimeout(pollTimer);
 
         CTFd.fetch(apiUrl, {
             method: 'POST',
@@ -66,15 +153,8 @@ document.addEventListener('DOMContentLoaded', () => {
         })
         .then(response => response.json())
         .then(data => {
-            if (data.success) {
-                displayStatus(data.message, false, data.display_html);
-                // Optionally disable button after successful start or change text
-                startButton.textContent = 'Instance Running';
-                // Maybe add a stop button dynamically here?
-            } else {
-                displayStatus(data.message, true);
-                startButton.textContent = 'Start Instance'; // Re-enable on error
-                startButton.disabled = false;
+            if (handleInstanceState(data, startButton)) {
+                follow();
             }
         })
         .catch(error => {
@@ -85,7 +165,56 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     });
 
-    // Initial state (maybe check if an instance is already running? Requires backend changes)
-    // displayStatus('Click button to start instance.');
-});
+    stopButton.addEventListener('click', () => {
+        stopButton.disabled = true;
+        CTFd.fetch(stopUrl, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'CSRF-Token': CTFd.config.csrfNonce
+            },
+        })
+        .then(response => response.json())
+        .then(data => {
+            displayStatus(data.message, !data.success);
+            stopButton.disabled = false;
+            if (data.success) {
+                stopButton.style.display = 'none';
+                extendButton.style.display = 'none';
+                // The instance is gone; let the player start a new one
+                startButton.textContent = 'Start Instance';
+                startButton.disabled = false;
+            }
+        })
+        .catch(error => {
+            console.error('Error stopping instance:', error);
+            displayStatus('An unexpected client-side error occurred.', true);
+            stopButton.disabled = false;
+        });
+    });
+
+    extendButton.addEventListener('click', () => {
+        extendButton.disabled = true;
+        CTFd.fetch(extendUrl, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'CSRF-Token': CTFd.config.csrfNonce
+            },
+        })
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) {
+                displayStatus(data.message, true);
+            }
+            extendButton.disabled = false;
+        })
+        .catch(error => {
+            console.error('Error extending instance:', error);
+            extendButton.disabled = false;
+        });
+    });
 
+    // Pick up an instance (or start in progress) from an earlier page load
+    pollStatus();
+});
@@ -0,0 +1,261 @@
+"""Benchmarks the instance start / status / stop hot path.
+
+Drives docker_utils the way the plugin's API does: each simulated player
+submits a start job to a StartJobQueue (reuse check, warm pool claim,
+placement, admission slot, start_challenge_container, state index update),
+polls status, and finally tears the instance down. Runs against the
+in-process fake daemon from fake_docker.py by default, or any daemon given
+with --docker-url.
+
+Only the Docker side is measured: the start job is a copy of the plugin's
+run_start_job without its database rows and without the readiness probe
+(off unless an admin sets a probe address), and "status (index)" times the
+index reads of the status endpoint, not its database query or Flask.
+
+Reports throughput and p50/p95/p99 latency per phase:
+    python benchmarks/bench_hot_path.py --players 200 --concurrency 50 --latency create=0.05,start=0.1
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import docker_utils # noqa: E402
+import fake_docker # noqa: E402
+
+CHALLENGE_ID = 1
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of `samples` (seconds), or None when empty."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+class Phase:
+    """Latency samples and error count for one benchmarked operation."""
+
+    def __init__(self, name):
+        self.name = name
+        self.samples = []
+        self.errors = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self.samples.append(seconds)
+            else:
+                self.errors += 1
+
+    def run(self, fn, items, concurrency):
+        """Calls fn(item) for every item with `concurrency` threads, timing each call."""
+        def _timed(item):
+            start = time.perf_counter()
+            try:
+                ok = fn(item)
+            except Exception:
+                ok = False
+            self.record(time.perf_counter() - start, bool(ok))
+
+        self.started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(_timed, items))
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        elapsed = (self.finished or 0) - (self.started or 0)
+        to_ms = lambda value: None if value is None else round(value * 1000, 2)
+        return {
+            "phase": self.name,
+            "ok": len(self.samples),
+            "errors": self.errors,
+            "throughput": round(len(self.samples) / elapsed, 2) if elapsed > 0 else None,
+            "p50_ms": to_ms(percentile(self.samples, 50)),
+            "p95_ms": to_ms(percentile(self.samples, 95)),
+            "p99_ms": to_ms(percentile(self.samples, 99)),
+        }
+
+
+def run_start_job(job, user_id, spec, previous_host=None):
+    """Docker side of the plugin's start job (see run_start_job in __init__.py).
+
+    `previous_host` stands in for the player's recorded instance row.
+    """
+    container = None
+    if previous_host:
+        # A running instance is handed back without an admission slot
+        container = docker_utils.find_running_instance(docker_utils.get_docker_client(previous_host), spec, user_id)
+    if not container:
+        container = docker_utils.warm_pool.claim(spec, spec.instance_name(user_id))
+    if not container:
+        host, client = docker_utils.choose_docker_host(spec.image_name, spec.total_mem_bytes)
+        if not client:
+            job.update(docker_utils.JOB_FAILED, "No Docker host available.")
+            return
+        on_wait = lambda position: job.update(docker_utils.JOB_QUEUED, "Waiting for a create slot...", position=position)
+        with docker_utils.admission.slot(host.url, on_wait=on_wait) as admitted:
+            if not admitted:
+                job.update(docker_utils.JOB_FAILED, "Timed out waiting for a create slot.")
+                return
+            job.update(docker_utils.JOB_STARTING, "Starting...")
+            container = docker_utils.start_challenge_container(
+                client=client,
+                image_name=spec.image_name,
+                user_id=user_id,
+                challenge_id=spec.challenge_id,
+                docker_host=host.url,
+                launch_spec=spec,
+            )
+    if not container:
+        job.update(docker_utils.JOB_FAILED, "Failed to start challenge instance.")
+        return
+    summary = docker_utils.state_index.put_attrs(container.attrs, container.labels.get(docker_utils.HOST_LABEL))
+    if not summary["ports"]:
+        job.update(docker_utils.JOB_FAILED, "Instance has no published ports.")
+        return
+    job.update(docker_utils.JOB_READY, "Instance ready.", result={"container_id": summary["id"], "ports": summary["ports"]})
+
+
+def status_lookup(docker_host, container_id):
+    """Index reads of the plugin's instance_status_api for a recorded instance."""
+    if docker_utils.state_index.is_live(docker_host):
+        summary = docker_utils.state_index.get(container_id)
+        if summary and summary["state"] in ("exited", "dead"):
+            return False
+    docker_utils.idle.wake(container_id, docker_host)
+    return True
+
+
+def run_benchmark(args, docker_url):
+    docker_utils.configure_docker_hosts([docker_utils.DockerHost(docker_url)])
+    docker_utils.admission.configure(args.max_concurrent_creates)
+    docker_utils.host_ports.configure(docker_utils.parse_port_range(args.port_range))
+    if args.state_index:
+        docker_utils.state_index.start(docker_utils.get_docker_hosts())
+    spec = docker_utils.LaunchSpec(CHALLENGE_ID, args.image, {"80/tcp": None}, {"FLAG": "bench{flag}"}, "0.5", "256m")
+    jobs = docker_utils.StartJobQueue(max_workers=args.start_workers, max_pending=max(args.players, docker_utils.START_QUEUE_LIMIT))
+    users = list(range(1, args.players + 1))
+    container_ids = {}
+    phases = []
+
+    if args.pull:
+        pull = Phase("pull")
+        client = docker_utils.get_docker_client(docker_url)
+        pull.run(lambda _: docker_utils.ensure_image(client, args.image), [None], 1)
+        phases.append(pull)
+
+    def _start(user_id):
+        previous_host = docker_url if user_id in container_ids else None
+        job = jobs.submit((user_id, CHALLENGE_ID), run_start_job, user_id, spec, previous_host)
+        if not job:
+            return False
+        while not job.finished:
+            job.wait(job.version, timeout=args.timeout)
+        if job.status != docker_utils.JOB_READY:
+            return False
+        container_ids[user_id] = job.result["container_id"]
+        return True
+
+    start = Phase("start")
+    start.run(_start, users, args.concurrency)
+    phases.append(start)
+
+    # Starting again with the same spec should find and reuse the running container
+    restart = Phase("start (reuse)")
+    jobs_again = [u for u in users if u in container_ids]
+    restart.run(_start, jobs_again, args.concurrency)
+    phases.append(restart)
+
+    started = [u for u in users if u in container_ids]
+    client = docker_utils.get_docker_client(docker_url)
+    status_index = Phase("status (index)")
+    status_index.run(lambda u: status_lookup(docker_url, container_ids[u]), started * args.status_polls, args.concurrency)
+    phases.append(status_index)
+
+    status_inspect = Phase("status (inspect)")
+    status_inspect.run(lambda u: docker_utils.get_container_details(client, container_ids[u]) is not None, started, args.concurrency)
+    phases.append(status_inspect)
+
+    listing = Phase("list")
+    listing.run(lambda _: docker_utils.list_managed_containers(client, challenge_id=CHALLENGE_ID, docker_host=docker_url) is not None, range(args.list_calls), min(args.concurrency, args.list_calls) or 1)
+    phases.append(listing)
+
+    if args.bulk_stop:
+        stop = Phase("stop (bulk)")
+        targets = [(docker_url, container_ids[u]) for u in started]
+        stop.run(lambda _: all(docker_utils.teardown_containers(targets).values()), [None], 1)
+    else:
+        stop = Phase("stop")
+        stop.run(lambda u: docker_utils.teardown_container(client, container_ids[u]), started, args.concurrency)
+    phases.append(stop)
+
+    jobs.shutdown()
+    return [phase.summary() for phase in phases]
+
+
+def print_table(results, daemon=None):
+    header = f"{'phase':<18}{'ok':>7}{'errors':>8}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header)
+    print("-" * len(header))
+    fmt = lambda value: "-" if value is None else value
+    for row in results:
+        print(f"{row['phase']:<18}{row['ok']:>7}{row['errors']:>8}{fmt(row['throughput']):>10}"
+              f"{fmt(row['p50_ms']):>10}{fmt(row['p95_ms']):>10}{fmt(row['p99_ms']):>10}")
+    if daemon:
+        calls = ", ".join(f"{op}={count}" for op, count in daemon.calls.items() if count)
+        print(f"\nDaemon calls: {calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=100, help="Simulated players, one instance each")
+    parser.add_argument("--concurrency", type=int, default=50, help="Players acting at the same time")
+    parser.add_argument("--start-workers", type=int, default=docker_utils.START_WORKERS)
+    parser.add_argument("--max-concurrent-creates", type=int, default=docker_utils.MAX_CONCURRENT_CREATES)
+    parser.add_argument("--status-polls", type=int, default=5, help="Index status reads per player")
+    parser.add_argument("--list-calls", type=int, default=20)
+    parser.add_argument("--bulk-stop", action="store_true", help="Tear everything down with one teardown_containers() call")
+    parser.add_argument("--state-index", action="store_true", help="Also run the event-stream state index")
+    parser.add_argument("--port-range", default="", help="Host port range for the plugin's port allocator, e.g. 30000-39999")
+    parser.add_argument("--image", default="bench/challenge:latest")
+    parser.add_argument("--pull", action="store_true", help="Time the first image pull separately")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait on a single start job")
+    parser.add_argument("--docker-url", help="Benchmark a real daemon instead of the fake one")
+    parser.add_argument("--latency", default="", help="Fake daemon latency: seconds, or create=0.05,start=0.1")
+    parser.add_argument("--pull-time", type=float, default=0.5, help="Fake daemon image pull time")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Fake daemon create/start/pull failure rate")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep docker_utils INFO logging")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        docker_utils.log.setLevel("WARNING")
+
+    daemon = None
+    docker_url = args.docker_url
+    if not docker_url:
+        daemon = fake_docker.FakeDocker(latency=fake_docker.parse_latency(args.latency), pull_time=args.pull_time, failure_rate=args.failure_rate)
+        _, docker_url = fake_docker.serve(daemon)
+
+    results = run_benchmark(args, docker_url)
+    if args.json:
+        print(json.dumps({"docker_url": docker_url, "results": results}, indent=2))
+    else:
+        print_table(results, daemon)
+    docker_utils.close_docker_clients()
+
+
+if __name__ == "__main__":
+    main()
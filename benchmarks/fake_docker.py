@@ -0,0 +1,601 @@
+"""A small stand-in for the Docker Engine API, for benchmarking the plugin offline.
+
+Implements the subset of endpoints docker_utils uses (ping, version, info,
+images, container create/start/inspect/list/rename/pause/stop/remove, stats
+and the event stream) against in-memory state. Every call can be slowed down
+and made to fail at a configurable rate, so the plugin's hot path can be
+measured without a real daemon.
+
+Run standalone:
+    python benchmarks/fake_docker.py --port 2375 --latency 0.02 --pull-time 2
+
+Then point the plugin (or docker.DockerClient) at tcp://127.0.0.1:2375.
+"""
+import argparse
+import itertools
+import json
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+API_VERSION = "1.41"
+VERSION_PREFIX_RE = re.compile(r'^/v\d+\.\d+')
+
+IMAGE_SIZE = 100 * 1024 ** 2 # Every fake image takes 100 MiB
+
+# Calls that can be slowed down / failed individually (see FakeDocker.latency)
+OPERATIONS = ("ping", "inspect", "list", "create", "start", "stop", "remove", "pull", "stats", "network", "other")
+
+
+class FakeDocker:
+    """In-memory daemon state shared by all request handler threads."""
+
+    def __init__(self, latency=None, pull_time=1.0, failure_rate=0.0, mem_total=64 * 1024 ** 3, ncpu=16, port_base=32768):
+        self.latency = dict.fromkeys(OPERATIONS, 0.0)
+        self.latency.update(latency or {})
+        self.pull_time = pull_time
+        self.failure_rate = failure_rate
+        self.mem_total = mem_total
+        self.ncpu = ncpu
+        self.containers = {} # id -> container dict
+        self.names = {} # name -> id
+        self.images = {} # "repo:tag" -> image id
+        self.image_created = {} # image id -> pull time
+        self.networks = {"bridge": {"Id": "bridge", "Name": "bridge", "Labels": {}, "Containers": {}}} # name -> network
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.ports = itertools.count(port_base)
+        self.calls = dict.fromkeys(OPERATIONS, 0)
+
+    def delay(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency.get(operation):
+            time.sleep(self.latency[operation])
+
+    def should_fail(self, operation):
+        return operation in ("create", "start", "pull") and random.random() < self.failure_rate
+
+    def emit(self, container, action):
+        event = {
+            "Type": "container",
+            "Action": action,
+            "status": action,
+            "id": container["Id"],
+            "from": container["Config"]["Image"],
+            "Actor": {"ID": container["Id"], "Attributes": dict(container["Config"]["Labels"], name=container["Name"][1:])},
+            "time": int(time.time()),
+            "timeNano": time.time_ns(),
+        }
+        for subscriber in list(self.subscribers):
+            subscriber.put(event)
+
+    def find(self, ref):
+        with self.lock:
+            if ref in self.containers:
+                return self.containers[ref]
+            if ref in self.names:
+                return self.containers[self.names[ref]]
+            matches = [c for cid, c in self.containers.items() if cid.startswith(ref)]
+            return matches[0] if len(matches) == 1 else None
+
+
+def _normalize_image(name):
+    name = unquote(name)
+    last = name.rsplit('/', 1)[-1]
+    return name if ':' in last or '@' in name else f"{name}:latest"
+
+
+def _label_matches(labels, label):
+    key, _, value = label.partition('=')
+    return key in labels and (not value or labels[key] == value)
+
+
+def _matches(container, filters):
+    labels = container["Config"]["Labels"]
+    if not all(_label_matches(labels, label) for label in filters.get("label", [])):
+        return False
+    if "status" in filters and container["State"]["Status"] not in filters["status"]:
+        return False
+    if "id" in filters and not any(container["Id"].startswith(i) for i in filters["id"]):
+        return False
+    if "name" in filters and not any(re.search(n, container["Name"]) for n in filters["name"]):
+        return False
+    return True
+
+
+def _parse_filters(raw):
+    if not raw:
+        return {}
+    filters = json.loads(raw)
+    # Both {"label": ["a=b"]} and {"label": {"a=b": true}} are valid encodings
+    return {key: list(value) if isinstance(value, (list, dict)) else [value] for key, value in filters.items()}
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    daemon = None # Set by serve()
+
+    def log_message(self, format, *args):
+        pass
+
+    # --- Response helpers ---
+
+    def _send(self, status, body=None, content_type="application/json"):
+        payload = b"" if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("Api-Version", API_VERSION)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(payload)
+
+    def _error(self, status, message):
+        self._send(status, {"message": message})
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _chunk(self, obj):
+        data = (json.dumps(obj) + "\r\n").encode()
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}") if length else {}
+
+    # --- Routing ---
+
+    def do_HEAD(self):
+        self._dispatch()
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_DELETE(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        path = VERSION_PREFIX_RE.sub('', url.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        routes = (
+            ("GET", r'^/_ping$', self.ping),
+            ("HEAD", r'^/_ping$', self.ping),
+            ("GET", r'^/version$', self.version),
+            ("GET", r'^/info$', self.info),
+            ("GET", r'^/system/df$', self.system_df),
+            ("GET", r'^/events$', self.events),
+            ("POST", r'^/images/create$', self.pull),
+            ("GET", r'^/images/(?P<name>.+)/json$', self.image_inspect),
+            ("DELETE", r'^/images/(?P<name>.+)$', self.image_remove),
+            ("GET", r'^/containers/json$', self.container_list),
+            ("POST", r'^/containers/create$', self.container_create),
+            ("GET", r'^/containers/(?P<ref>[^/]+)/json$', self.container_inspect),
+            ("GET", r'^/containers/(?P<ref>[^/]+)/stats$', self.container_stats),
+            ("POST", r'^/containers/(?P<ref>[^/]+)/(?P<action>start|stop|kill|restart|pause|unpause|rename)$', self.container_action),
+            ("DELETE", r'^/containers/(?P<ref>[^/]+)$', self.container_remove),
+            ("GET", r'^/networks$', self.network_list),
+            ("POST", r'^/networks/create$', self.network_create),
+            ("POST", r'^/networks/prune$', self.network_prune),
+            ("GET", r'^/networks/(?P<ref>[^/]+)$', self.network_inspect),
+            ("DELETE", r'^/networks/(?P<ref>[^/]+)$', self.network_remove),
+        )
+        for method, pattern, handler in routes:
+            match = re.match(pattern, path)
+            if method == self.command and match:
+                try:
+                    handler(query, **match.groupdict())
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                return
+        self._error(404, f"page not found: {self.command} {path}")
+
+    # --- System ---
+
+    def ping(self, query):
+        self.daemon.delay("ping")
+        self._send(200, b"OK", content_type="text/plain")
+
+    def version(self, query):
+        self.daemon.delay("other")
+        self._send(200, {"ApiVersion": API_VERSION, "MinAPIVersion": "1.12", "Version": "fake", "Os": "linux", "Arch": "amd64"})
+
+    def info(self, query):
+        self.daemon.delay("other")
+        with self.daemon.lock:
+            running = sum(1 for c in self.daemon.containers.values() if c["State"]["Running"])
+            total = len(self.daemon.containers)
+        self._send(200, {
+            "MemTotal": self.daemon.mem_total,
+            "NCPU": self.daemon.ncpu,
+            "Containers": total,
+            "ContainersRunning": running,
+            "DockerRootDir": "/var/lib/docker",
+        })
+
+    def events(self, query):
+        filters = _parse_filters(query.get("filters"))
+        subscriber = queue.Queue()
+        self.daemon.subscribers.append(subscriber)
+        self._start_stream()
+        try:
+            while True:
+                try:
+                    event = subscriber.get(timeout=1)
+                except queue.Empty:
+                    continue
+                labels = event["Actor"]["Attributes"]
+                wanted_labels = filters.get("label", [])
+                if any(labels.get(label.partition('=')[0]) != label.partition('=')[2] for label in wanted_labels):
+                    continue
+                self._chunk(event)
+        finally:
+            self.daemon.subscribers.remove(subscriber)
+
+    def system_df(self, query):
+        self.daemon.delay("other")
+        with self.daemon.lock:
+            by_id = {}
+            for ref, image_id in self.daemon.images.items():
+                by_id.setdefault(image_id, []).append(ref)
+            containers = list(self.daemon.containers.values())
+            images = [{
+                "Id": image_id,
+                "RepoTags": refs,
+                "RepoDigests": [],
+                "Created": int(self.daemon.image_created.get(image_id, 0)),
+                "Size": IMAGE_SIZE,
+                "SharedSize": 0,
+                "Containers": sum(1 for c in containers if c.get("Image") == image_id),
+            } for image_id, refs in by_id.items()]
+        self._send(200, {
+            "LayersSize": IMAGE_SIZE * len(images),
+            "Images": images,
+            "Containers": [{"Id": c["Id"], "ImageID": c.get("Image"), "State": c["State"]["Status"]} for c in containers],
+            "Volumes": [],
+            "BuildCache": [],
+        })
+
+    # --- Images ---
+
+    def pull(self, query):
+        self.daemon.delay("pull")
+        name = query.get("fromImage", "")
+        tag = query.get("tag") or "latest"
+        reference = f"{name}:{tag}" if not tag.startswith("sha256:") else f"{name}@{tag}"
+        if self.daemon.should_fail("pull"):
+            return self._error(500, "injected pull failure")
+        self._start_stream()
+        self._chunk({"status": f"Pulling from {name}", "id": tag})
+        layers, steps, size = 3, 5, 10 * 1024 ** 2
+        for layer in range(layers):
+            self._chunk({"status": "Pulling fs layer", "id": f"layer{layer}", "progressDetail": {}})
+        for layer in range(layers):
+            for step in range(steps):
+                time.sleep(self.daemon.pull_time / (layers * steps))
+                self._chunk({"status": "Downloading", "id": f"layer{layer}",
+                             "progressDetail": {"current": size * (step + 1) // steps, "total": size}})
+            self._chunk({"status": "Pull complete", "id": f"layer{layer}", "progressDetail": {}})
+        with self.daemon.lock:
+            image_id = self.daemon.images.setdefault(reference, "sha256:" + uuid.uuid5(uuid.NAMESPACE_URL, reference).hex * 2)
+            self.daemon.image_created.setdefault(image_id, time.time())
+        self._chunk({"status": f"Status: Downloaded newer image for {reference}"})
+        self._end_stream()
+
+    def image_inspect(self, query, name):
+        self.daemon.delay("inspect")
+        reference = _normalize_image(name)
+        with self.daemon.lock:
+            image_id = self.daemon.images.get(reference)
+        if not image_id:
+            return self._error(404, f"No such image: {reference}")
+        self._send(200, {"Id": image_id, "RepoTags": [reference], "Size": IMAGE_SIZE})
+
+    def image_remove(self, query, name):
+        self.daemon.delay("remove")
+        name = unquote(name)
+        with self.daemon.lock:
+            references = [ref for ref, image_id in self.daemon.images.items() if image_id == name]
+            if not references:
+                references = [_normalize_image(name)] if _normalize_image(name) in self.daemon.images else []
+            if not references:
+                return self._error(404, f"No such image: {name}")
+            image_id = self.daemon.images[references[0]]
+            users = [c["Id"][:12] for c in self.daemon.containers.values() if c.get("Image") == image_id]
+            if users:
+                return self._error(409, f"conflict: unable to remove repository reference \"{references[0]}\" (must force) - "
+                                        f"container {users[0]} is using its referenced image {image_id[7:19]}")
+            if len(references) > 1 and name != image_id:
+                references = references[:1] # Untag only; the image keeps its other tags
+            for ref in references:
+                del self.daemon.images[ref]
+            deleted = image_id not in self.daemon.images.values()
+        self._send(200, [{"Untagged": ref} for ref in references] + ([{"Deleted": image_id}] if deleted else []))
+
+    # --- Containers ---
+
+    def container_list(self, query):
+        self.daemon.delay("list")
+        filters = _parse_filters(query.get("filters"))
+        include_all = query.get("all") in ("1", "true", "True")
+        with self.daemon.lock:
+            containers = sorted(self.daemon.containers.values(), key=lambda c: c["Created"], reverse=True)
+        if "before" in filters:
+            before = self.daemon.find(filters["before"][0])
+            if not before:
+                return self._error(404, f"No such container: {filters['before'][0]}")
+            containers = [c for c in containers if (c["Created"], c["Id"]) < (before["Created"], before["Id"])]
+        containers = [c for c in containers if (include_all or c["State"]["Running"]) and _matches(c, filters)]
+        if query.get("limit") and int(query["limit"]) > 0:
+            containers = containers[:int(query["limit"])]
+        self._send(200, [self._summary(c) for c in containers])
+
+    @staticmethod
+    def _summary(container):
+        ports = []
+        for port_proto, bindings in (container["NetworkSettings"]["Ports"] or {}).items():
+            port, proto = port_proto.split('/')
+            for binding in bindings or []:
+                ports.append({"IP": "0.0.0.0", "PrivatePort": int(port), "PublicPort": int(binding["HostPort"]), "Type": proto})
+        return {
+            "Id": container["Id"],
+            "Names": [container["Name"]],
+            "Image": container["Config"]["Image"],
+            "Labels": container["Config"]["Labels"],
+            "State": container["State"]["Status"],
+            "Status": container["State"]["Status"],
+            "Created": container["Created"],
+            "Ports": ports,
+        }
+
+    def container_create(self, query):
+        self.daemon.delay("create")
+        body = self._body()
+        name = query.get("name") or f"fake_{uuid.uuid4().hex[:8]}"
+        reference = _normalize_image(body.get("Image", ""))
+        if self.daemon.should_fail("create"):
+            return self._error(500, "injected create failure")
+        with self.daemon.lock:
+            if reference not in self.daemon.images and body.get("Image") not in self.daemon.images.values():
+                return self._error(404, f"No such image: {reference}")
+            if name in self.daemon.names:
+                return self._error(409, f'Conflict. The container name "/{name}" is already in use')
+            network_mode = (body.get("HostConfig") or {}).get("NetworkMode") or "default"
+            network = self._network("bridge" if network_mode == "default" else network_mode)
+            if not network:
+                return self._error(404, f"network {body['HostConfig']['NetworkMode']} not found")
+            container_id = uuid.uuid4().hex + uuid.uuid4().hex
+            network["Containers"][container_id] = {"Name": name}
+            container = {
+                "Id": container_id,
+                "Name": f"/{name}",
+                "Created": time.time(),
+                "Image": self.daemon.images.get(reference) or body.get("Image"),
+                "Config": {"Image": body.get("Image"), "Labels": body.get("Labels") or {}, "Env": body.get("Env") or []},
+                "HostConfig": body.get("HostConfig") or {},
+                "State": dict({"Status": "created", "Running": False, "Paused": False},
+                              **({"Health": {"Status": "starting"}} if body.get("Healthcheck") else {})),
+                "NetworkSettings": {"Ports": {}},
+                "Stats": {"cpu": 0, "rx": 0, "tx": 0},
+            }
+            self.daemon.containers[container_id] = container
+            self.daemon.names[name] = container_id
+        self.daemon.emit(container, "create")
+        self._send(201, {"Id": container_id, "Warnings": []})
+
+    def container_inspect(self, query, ref):
+        self.daemon.delay("inspect")
+        container = self.daemon.find(ref)
+        if not container:
+            return self._error(404, f"No such container: {ref}")
+        self._send(200, container)
+
+    def container_stats(self, query, ref):
+        self.daemon.delay("stats")
+        container = self.daemon.find(ref)
+        if not container:
+            return self._error(404, f"No such container: {ref}")
+        stats = container["Stats"]
+        if container["State"]["Status"] == "running" and random.random() < 0.5:
+            # Some containers see activity between samples
+            stats["cpu"] += random.randint(1, 10 ** 7)
+            stats["rx"] += random.randint(1, 4096)
+        self._send(200, {
+            "cpu_stats": {"cpu_usage": {"total_usage": stats["cpu"]}},
+            "networks": {"eth0": {"rx_bytes": stats["rx"], "tx_bytes": stats["tx"]}},
+        })
+
+    def container_action(self, query, ref, action):
+        self.daemon.delay("start" if action in ("start", "restart") else "stop" if action in ("stop", "kill") else "other")
+        container = self.daemon.find(ref)
+        if not container:
+            return self._error(404, f"No such container: {ref}")
+        if action in ("start", "restart") and self.daemon.should_fail("start"):
+            return self._error(500, "injected start failure")
+        with self.daemon.lock:
+            state = container["State"]
+            if action == "rename":
+                new_name = query.get("name", "")
+                if new_name in self.daemon.names:
+                    return self._error(409, f'Conflict. The container name "/{new_name}" is already in use')
+                del self.daemon.names[container["Name"][1:]]
+                container["Name"] = f"/{new_name}"
+                self.daemon.names[new_name] = container["Id"]
+            elif action in ("start", "restart"):
+                if action == "start" and state["Running"]:
+                    return self._send(304)
+                taken = self._bind_ports(container)
+                if taken:
+                    return self._error(500, f"driver failed programming external connectivity on endpoint {container['Name'][1:]}: "
+                                            f"Bind for 0.0.0.0:{taken} failed: port is already allocated")
+                state.update(Status="running", Running=True, Paused=False)
+                if "Health" in state:
+                    state["Health"]["Status"] = "healthy" # Healthchecks pass right away
+            elif action in ("stop", "kill"):
+                state.update(Status="exited", Running=False, Paused=False)
+            elif action == "pause":
+                if not state["Running"] or state["Paused"]:
+                    reason = "is already paused" if state["Paused"] else "is not running"
+                    return self._error(409, f"Container {container['Id']} {reason}")
+                state.update(Status="paused", Paused=True)
+            elif action == "unpause":
+                if not state["Paused"]:
+                    return self._error(409, f"Container {container['Id']} is not paused")
+                state.update(Status="running", Paused=False)
+        self.daemon.emit(container, {"stop": "die", "kill": "die"}.get(action, action))
+        self._send(204)
+
+    def _bind_ports(self, container):
+        """Binds the requested host ports; returns a port held by another running container, if any."""
+        bindings = container["HostConfig"].get("PortBindings") or {}
+        bound = {
+            binding["HostPort"]
+            for other in self.daemon.containers.values() if other is not container and other["State"]["Running"]
+            for published in (other["NetworkSettings"].get("Ports") or {}).values() for binding in published or []
+        }
+        ports = {}
+        for port_proto, requested in bindings.items():
+            host_port = str((requested or [{}])[0].get("HostPort") or next(self.daemon.ports))
+            if host_port in bound:
+                return host_port
+            ports[port_proto] = [{"HostIp": "0.0.0.0", "HostPort": host_port}]
+        container["NetworkSettings"]["Ports"] = ports
+        return None
+
+    def container_remove(self, query, ref):
+        self.daemon.delay("remove")
+        container = self.daemon.find(ref)
+        if not container:
+            return self._error(404, f"No such container: {ref}")
+        force = query.get("force") in ("1", "true", "True")
+        with self.daemon.lock:
+            if container["State"]["Running"] and not force:
+                return self._error(409, "You cannot remove a running container. Stop the container before attempting removal or force remove")
+            self.daemon.containers.pop(container["Id"], None)
+            self.daemon.names.pop(container["Name"][1:], None)
+            for network in self.daemon.networks.values():
+                network["Containers"].pop(container["Id"], None)
+        if container["State"]["Running"]:
+            self.daemon.emit(container, "die")
+        self.daemon.emit(container, "destroy")
+        self._send(204)
+
+    # --- Networks ---
+
+    def _network(self, ref):
+        return self.daemon.networks.get(ref) or next((n for n in self.daemon.networks.values() if n["Id"] == ref), None)
+
+    def network_list(self, query):
+        self.daemon.delay("list")
+        wanted = _parse_filters(query.get("filters")).get("label", [])
+        with self.daemon.lock:
+            networks = [dict(network, Containers={}) for network in self.daemon.networks.values()
+                        if all(_label_matches(network["Labels"], label) for label in wanted)]
+        self._send(200, networks)
+
+    def network_create(self, query):
+        self.daemon.delay("network")
+        body = self._body()
+        with self.daemon.lock:
+            if body["Name"] in self.daemon.networks:
+                return self._error(409, f"network with name {body['Name']} already exists")
+            network_id = uuid.uuid4().hex + uuid.uuid4().hex
+            self.daemon.networks[body["Name"]] = {"Id": network_id, "Name": body["Name"], "Labels": body.get("Labels") or {}, "Containers": {}}
+        self._send(201, {"Id": network_id, "Warning": ""})
+
+    def network_inspect(self, query, ref):
+        self.daemon.delay("inspect")
+        with self.daemon.lock:
+            network = self._network(ref)
+            network = network and dict(network, Containers=dict(network["Containers"]))
+        if not network:
+            return self._error(404, f"network {ref} not found")
+        self._send(200, network)
+
+    def network_remove(self, query, ref):
+        self.daemon.delay("network")
+        with self.daemon.lock:
+            network = self._network(ref)
+            if not network:
+                return self._error(404, f"network {ref} not found")
+            if network["Containers"]:
+                return self._error(403, f"error while removing network: network {network['Name']} has active endpoints")
+            del self.daemon.networks[network["Name"]]
+        self._send(204)
+
+    def network_prune(self, query):
+        self.daemon.delay("network")
+        wanted = _parse_filters(query.get("filters")).get("label", [])
+        with self.daemon.lock:
+            pruned = [name for name, network in self.daemon.networks.items()
+                      if name != "bridge" and not network["Containers"]
+                      and all(_label_matches(network["Labels"], label) for label in wanted)]
+            for name in pruned:
+                del self.daemon.networks[name]
+        self._send(200, {"NetworksDeleted": pruned})
+
+
+def serve(daemon, host="127.0.0.1", port=0):
+    """Starts the fake daemon in a background thread.
+
+    Returns:
+        tuple: (ThreadingHTTPServer, base URL such as 'tcp://127.0.0.1:40123').
+    """
+    handler = type("BoundFakeDockerHandler", (FakeDockerHandler,), {"daemon": daemon})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-docker", daemon=True).start()
+    return server, f"tcp://{host}:{server.server_address[1]}"
+
+
+def parse_latency(value):
+    """Parses '0.02' (every call) or 'create=0.05,start=0.1' into a latency dict."""
+    if not value:
+        return {}
+    if '=' not in value:
+        return dict.fromkeys(OPERATIONS, float(value))
+    latency = {}
+    for pair in value.split(','):
+        key, seconds = pair.split('=', 1)
+        latency[key.strip()] = float(seconds)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2375)
+    parser.add_argument("--latency", default="", help="Seconds per call, or per operation: create=0.05,start=0.1")
+    parser.add_argument("--pull-time", type=float, default=1.0, help="Seconds an image pull takes")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that create/start/pull fail")
+    args = parser.parse_args()
+
+    daemon = FakeDocker(latency=parse_latency(args.latency), pull_time=args.pull_time, failure_rate=args.failure_rate)
+    server, url = serve(daemon, args.host, args.port)
+    print(f"Fake Docker daemon listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
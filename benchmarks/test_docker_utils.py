@@ -0,0 +1,195 @@
+"""Tests of the docker_utils start/stop path against the fake daemon.
+
+Run from this directory (the repository root is the plugin package itself,
+which needs CTFd):
+    cd benchmarks && python -m pytest -q
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import docker_utils # noqa: E402
+import fake_docker # noqa: E402
+
+IMAGE = "chal/web:1"
+
+
+def wait_until(predicate, timeout=5):
+    """Polls `predicate` until it is true; fails the test after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            pytest.fail("Timed out waiting for the fake daemon")
+        time.sleep(0.02)
+
+
+@pytest.fixture(scope="module")
+def daemon():
+    """One fake daemon for the module, configured as the only Docker host."""
+    fake = fake_docker.FakeDocker(pull_time=0)
+    server, url = fake_docker.serve(fake)
+    docker_utils.configure_docker_hosts([docker_utils.DockerHost(url)])
+    docker_utils.state_index.start(docker_utils.get_docker_hosts())
+    wait_until(lambda: docker_utils.state_index.is_live(url))
+    fake.url = url
+    yield fake
+    server.shutdown()
+
+
+@pytest.fixture
+def client(daemon):
+    return docker_utils.get_docker_client(daemon.url)
+
+
+def start(client, daemon, spec, user_id, team_id=None):
+    return docker_utils.start_challenge_container(
+        client=client,
+        image_name=spec.image_name,
+        user_id=user_id,
+        challenge_id=spec.challenge_id,
+        docker_host=daemon.url,
+        launch_spec=spec,
+        team_id=team_id,
+    )
+
+
+def test_connection_info_has_published_ports(daemon, client):
+    spec = docker_utils.LaunchSpec.from_type_data(1, {"docker_image": IMAGE, "docker_ports": "80/tcp,1337/tcp"})
+    container = start(client, daemon, spec, user_id=1)
+    assert container is not None
+    # Fresh inspect data: bindings only exist once the container runs
+    summary = docker_utils.state_index.put_attrs(container.attrs, daemon.url)
+    assert set(summary["ports"]) == {"80/tcp", "1337/tcp"}
+    assert all(int(port) > 0 for port in summary["ports"].values())
+    assert docker_utils.teardown_container(client, container.id)
+
+
+def test_running_instance_is_reused(daemon, client):
+    spec = docker_utils.LaunchSpec.from_type_data(2, {"docker_image": IMAGE, "docker_ports": "80/tcp"})
+    first = start(client, daemon, spec, user_id=1)
+    # The index follows the daemon's events
+    wait_until(lambda: (docker_utils.state_index.get(first.id) or {}).get("state") == "running")
+    assert docker_utils.is_current_instance(daemon.url, first.id, spec)
+    reused = docker_utils.find_running_instance(client, spec, user_id=1)
+    assert reused is not None and reused.id == first.id
+    assert start(client, daemon, spec, user_id=1).id == first.id
+
+    # A changed spec is not handed back; starting again recreates the instance
+    changed = docker_utils.LaunchSpec.from_type_data(2, {"docker_image": IMAGE, "docker_ports": "80/tcp", "docker_env": "A=1"})
+    assert docker_utils.find_running_instance(client, changed, user_id=1) is None
+    recreated = start(client, daemon, changed, user_id=1)
+    assert recreated.id != first.id
+    assert first.id not in daemon.containers
+    assert docker_utils.teardown_container(client, recreated.id)
+
+
+def test_host_ports_are_allocated_and_released(daemon, client):
+    docker_utils.host_ports.configure((40000, 40001))
+    try:
+        spec = docker_utils.LaunchSpec.from_type_data(3, {"docker_image": IMAGE, "docker_ports": "80/tcp"})
+        first = start(client, daemon, spec, user_id=1)
+        second = start(client, daemon, spec, user_id=2)
+        ports = {
+            int(docker_utils.state_index.put_attrs(container.attrs, daemon.url)["ports"]["80/tcp"])
+            for container in (first, second)
+        }
+        assert ports == {40000, 40001}
+        # The range is full until one of them goes away
+        with pytest.raises(RuntimeError):
+            docker_utils.host_ports.allocate(client, 1)
+        assert docker_utils.teardown_container(client, first.id)
+        assert len(docker_utils.host_ports.allocate(client, 1)) == 1
+        assert docker_utils.teardown_container(client, second.id)
+    finally:
+        docker_utils.host_ports.configure(None)
+
+
+def test_listing_survives_removal_of_the_page_cursor(daemon, client):
+    spec = docker_utils.LaunchSpec.from_type_data(6, {"docker_image": IMAGE, "docker_ports": "80/tcp"})
+    containers = [start(client, daemon, spec, user_id=user_id) for user_id in range(1, 6)]
+    try:
+        listing = docker_utils.iter_managed_containers(client, challenge_id=6, docker_host=daemon.url, page_size=2, strict=True)
+        first_page = [next(listing)["id"], next(listing)["id"]]
+        # Remove the container the next page would be requested "before"
+        docker_utils.teardown_container(client, first_page[-1])
+        rest = [summary["id"] for summary in listing]
+        listed = first_page + rest
+        assert len(listed) == len(set(listed))
+        assert set(listed) == {container.id for container in containers}
+    finally:
+        docker_utils.teardown_containers((daemon.url, container.id) for container in containers)
+
+
+def test_stack_is_torn_down_with_its_entry(daemon, client):
+    stack = {
+        "entry": "web",
+        "services": {
+            "web": {"image": IMAGE, "ports": "80/tcp", "depends_on": ["db"]},
+            "db": {"image": "chal/db:1"},
+        },
+    }
+    spec = docker_utils.LaunchSpec.from_type_data(4, {"docker_image": IMAGE, "docker_stack": json.dumps(stack)})
+    container = start(client, daemon, spec, user_id=1)
+    assert container is not None
+    stack_id = container.labels[docker_utils.STACK_LABEL]
+    members = [c for c in daemon.containers.values() if c["Config"]["Labels"].get(docker_utils.STACK_LABEL) == stack_id]
+    assert len(members) == 2
+
+    # Forget the container, as in a worker that never indexed it or compiled this spec
+    with docker_utils.state_index._lock:
+        docker_utils.state_index._containers.pop(container.id, None)
+    assert docker_utils.teardown_container(client, container.id)
+    assert not [c for c in daemon.containers.values() if c["Config"]["Labels"].get(docker_utils.STACK_LABEL) == stack_id]
+
+
+def test_pooled_network_removed_elsewhere_is_not_handed_out(daemon, client):
+    name = docker_utils.networks.acquire(client)
+    docker_utils.networks.release(client, name)
+    # Another worker's prune removes it while it sits in this worker's pool
+    client.api.remove_network(name)
+    replacement = docker_utils.networks.acquire(client)
+    assert replacement != name
+    client.api.inspect_network(replacement)
+    docker_utils.networks.release(client, replacement)
+
+
+def test_pool_containers_are_claimed_once(daemon, client):
+    spec = docker_utils.LaunchSpec.from_type_data(5, {"docker_image": IMAGE, "docker_ports": "80/tcp", "docker_pool_size": 3})
+    docker_utils.warm_pool.configure(spec)
+    try:
+        for _ in range(3):
+            docker_utils.warm_pool._create(5, spec)
+        wait_until(lambda: docker_utils.warm_pool.idle_counts().get(5) == 3)
+
+        claimed = {}
+
+        def claim(user_id):
+            container = docker_utils.warm_pool.claim(spec, spec.instance_name(user_id))
+            claimed[user_id] = container.id if container else None
+
+        threads = [threading.Thread(target=claim, args=(user_id,)) for user_id in range(1, 7)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        ids = [container_id for container_id in claimed.values() if container_id]
+        assert len(ids) == 3 and len(set(ids)) == 3
+        for user_id, container_id in claimed.items():
+            if container_id:
+                container = daemon.containers[container_id]
+                assert container["Name"] == f"/{spec.instance_name(user_id)}"
+                assert container["State"]["Status"] == "running"
+    finally:
+        docker_utils.warm_pool.remove(5)
+        docker_utils.teardown_containers(
+            (daemon.url, container_id) for container_id, container in list(daemon.containers.items())
+            if container["Config"]["Labels"].get("challenge_id") == "5"
+        )
@@ -1,159 +1,1968 @@
+import bisect
 import docker
+import functools
+import hashlib
+import json
 import logging
+import heapq
+import math
+import os
+import random
+import re
+import requests
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from urllib.parse import urlparse
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger(__name__)
 
+# --- Metrics ---
+#
+# In-process latency histograms (one per hot-path phase) and counters, plus
+# gauges that are computed only when scraped. Recording is a bisect and a dict
+# update under a lock. Values are per worker process; render() produces the
+# Prometheus text exposition format.
+
+METRIC_PREFIX = "ctfd_docker_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120) # Seconds
+
+METRIC_HELP = {
+    "phase_seconds": "Time spent in each phase of the instance start/stop path.",
+    "image_pulls_total": "Images pulled because they were missing or being prefetched.",
+    "container_starts_total": "start_challenge_container() outcomes.",
+    "teardowns_total": "Container teardown outcomes.",
+    "client_failures_total": "Docker clients marked unhealthy after an error.",
+    "start_jobs_total": "Finished background start jobs by final status.",
+    "start_rejections_total": "Start requests refused before queueing, by reason.",
+    "idle_pauses_total": "Instances paused after being idle.",
+    "idle_wakes_total": "Paused instances woken because their player came back.",
+    "solve_releases_total": "Instances released because their challenge was solved.",
+    "cpuset_allocations_total": "Core sets assigned to new containers, by kind (dedicated or shared).",
+    "host_port_conflicts_total": "Container runs retried because an allocated host port was already bound.",
+    "host_port_exhausted_total": "Host port allocations that found the configured range full.",
+    "stack_networks_total": "Stack networks given to new instances, by source (pool or created).",
+    "ready_checks_total": "Readiness checks of new instances' ports, by outcome (ready or timeout).",
+    "image_evictions_total": "Images removed to keep hosts under the image budget, by tier (unreferenced or referenced).",
+    "image_evicted_bytes_total": "Estimated bytes freed by image evictions.",
+}
+
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+
+class Metrics:
+    """Thread-safe histograms, counters and scrape-time gauges."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {} # phase -> [per-bucket counts (last is +Inf), sum]
+        self._counters = {} # (name, sorted label items) -> value
+        self._gauges = {} # name -> (help, callable returning {sorted label items: value})
+
+    def observe(self, phase, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(phase)
+            if histogram is None:
+                histogram = self._histograms[phase] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][index] += 1
+            histogram[1] += seconds
+
+    @contextmanager
+    def timed(self, phase):
+        """Records the duration of the block under `phase`, even if it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - start)
+
+    def timer(self, phase):
+        """Decorator form of timed()."""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timed(phase):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def register_gauge(self, name, help_text, fn):
+        self._gauges[name] = (help_text, fn)
+
+    def render(self):
+        """Returns every metric in Prometheus text format."""
+        with self._lock:
+            histograms = {phase: (list(counts), total) for phase, (counts, total) in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        name = f"{METRIC_PREFIX}phase_seconds"
+        lines += [f"# HELP {name} {METRIC_HELP['phase_seconds']}", f"# TYPE {name} histogram"]
+        for phase, (counts, total) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels((('phase', phase), ('le', bound)))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels((('phase', phase),))} {total}")
+            lines.append(f"{name}_count{_format_labels((('phase', phase),))} {cumulative}")
+        for counter in sorted({key[0] for key in counters}):
+            name = f"{METRIC_PREFIX}{counter}"
+            lines += [f"# HELP {name} {METRIC_HELP.get(counter, counter)}", f"# TYPE {name} counter"]
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == counter:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        for gauge, (help_text, fn) in sorted(self._gauges.items()):
+            name = f"{METRIC_PREFIX}{gauge}"
+            try:
+                values = fn()
+            except Exception as e:
+                log.error(f"Failed to compute metric '{name}': {e}")
+                continue
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
 # --- Docker Client Initialization ---
+#
+# Clients are kept in a process-wide registry keyed by daemon URL so every
+# request reuses the same connection pool instead of building a new
+# DockerClient (and pinging the daemon) each time.
+
+CLIENT_POOL_SIZE = 32 # Max pooled HTTP connections per daemon
+CLIENT_HEALTH_TTL = 60 # Seconds a successful ping is trusted before re-checking
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class _ClientEntry:
+    """A pooled Docker client plus the state needed for lazy health checks."""
+
+    def __init__(self):
+        self.client = None
+        self.healthy = False
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+
+def _connect(docker_host):
+    if docker_host:
+        client = docker.DockerClient(base_url=docker_host, max_pool_size=CLIENT_POOL_SIZE)
+    else:
+        # Connect using environment settings (e.g., DOCKER_HOST or default socket)
+        client = docker.from_env(max_pool_size=CLIENT_POOL_SIZE)
+    if client.api.base_url.startswith("http://"):
+        # The SDK only sizes socket transports; plain TCP daemons would get requests' default of 10
+        client.api.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=CLIENT_POOL_SIZE))
+    return client
+
+
+def _close_quietly(client):
+    try:
+        client.close()
+    except Exception:
+        pass
+
 
 def get_docker_client(docker_host=None):
-    """Initializes and returns a Docker client.
+    """Returns the pooled Docker client for a daemon, connecting if needed.
+
+    The daemon is only pinged when the client is first created, after a
+    failure has been reported, or once CLIENT_HEALTH_TTL has elapsed.
+
+    Args:
+        docker_host (str, optional): The URL or path to the Docker daemon socket.
+                                     Defaults to None, which uses docker.from_env().
+
+    Returns:
+        docker.DockerClient: A shared, initialized Docker client instance.
+        None: If connection to Docker daemon fails.
+    """
+    key = docker_host or ""
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None:
+            entry = _clients[key] = _ClientEntry()
+
+    # Fast path without taking the per-daemon lock
+    client = entry.client
+    if client is not None and entry.healthy and time.monotonic() - entry.checked_at < CLIENT_HEALTH_TTL:
+        return client
+
+    with entry.lock:
+        # Another thread may have re-checked the daemon while we waited
+        if entry.client is not None and entry.healthy and time.monotonic() - entry.checked_at < CLIENT_HEALTH_TTL:
+            return entry.client
+        try:
+            with metrics.timed("client_connect"):
+                if entry.client is None:
+                    entry.client = _connect(docker_host)
+                    log.info(f"Successfully connected to Docker daemon '{key or 'default'}'.")
+                # Test the connection
+                entry.client.ping()
+            entry.healthy = True
+            entry.checked_at = time.monotonic()
+            return entry.client
+        except docker.errors.DockerException as e:
+            log.error(f"Failed to connect to Docker daemon: {e}")
+        except Exception as e:
+            log.error(f"An unexpected error occurred while connecting to Docker: {e}")
+        # Drop the broken client so the next call reconnects from scratch. It is not
+        # closed: threads that got it from the fast path may still be mid-request,
+        # and its connections are released once the last of them lets go.
+        entry.client = None
+        entry.healthy = False
+        return None
+
+
+def pooled_client(docker_host=None):
+    """Returns the daemon's pooled client as is, or None; never connects or pings."""
+    with _clients_lock:
+        entry = _clients.get(docker_host or "")
+    return entry.client if entry else None
+
+
+def mark_client_failed(client):
+    """Flags a pooled client as unhealthy so the next lookup re-pings it.
+
+    Args:
+        client (docker.DockerClient): The client that hit a connection error.
+    """
+    with _clients_lock:
+        entries = list(_clients.values())
+    for entry in entries:
+        if entry.client is client and entry.healthy:
+            entry.healthy = False
+            metrics.inc("client_failures_total")
+
+
+def close_docker_clients():
+    """Closes every pooled client. Used on plugin shutdown."""
+    with _clients_lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    for entry in entries:
+        if entry.client is not None:
+            _close_quietly(entry.client)
+
+
+def _handle_api_error(client, e):
+    # 5xx responses usually mean the daemon is struggling; force a re-check
+    if getattr(e, "is_server_error", None) and e.is_server_error():
+        mark_client_failed(client)
+
+# --- Image Cache ---
+#
+# Remembers which images are known to be present on each daemon (name ->
+# resolved image ID) so the start path can skip the images.get round-trip.
+# Pulls go through the streaming API so callers can report layer progress.
+
+IMAGE_CACHE_TTL = 900 # Seconds an image is trusted to still be on the daemon
+PREFETCH_WORKERS = 2
+PULL_PROGRESS_INTERVAL = 0.5 # Minimum seconds between pull progress reports
+
+# Per-layer statuses in the pull stream; others describe the whole image
+_LAYER_STATUSES = ("Pulling fs layer", "Waiting", "Downloading", "Verifying Checksum", "Download complete",
+                   "Extracting", "Pull complete", "Already exists")
+
+_image_cache = {} # (daemon URL, image name) -> (image ID, expires at)
+_image_cache_lock = threading.Lock()
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="ctfd-docker-prefetch")
+
+
+def _daemon_key(client):
+    return getattr(client.api, "base_url", "")
+
+
+def _cache_image(client, image_name, image_id):
+    with _image_cache_lock:
+        _image_cache[(_daemon_key(client), image_name)] = (image_id, time.monotonic() + IMAGE_CACHE_TTL)
+
+
+def pull_image(client, image_name, progress=None):
+    """Pulls an image through the streaming pull API.
+
+    Args:
+        client (docker.DockerClient): The Docker client instance.
+        image_name (str): The name of the Docker image.
+        progress (callable, optional): Called with {'layers', 'layers_done', 'current', 'total'}
+                                       (byte counts of the layers seen so far) at most every
+                                       PULL_PROGRESS_INTERVAL seconds, and once at the end.
+
+    Returns:
+        docker.models.images.Image: The pulled image.
+
+    Raises:
+        docker.errors.APIError: If the daemon rejects or aborts the pull.
+    """
+    repository, tag = docker.utils.parse_repository_tag(image_name)
+    tag = tag or "latest"
+    layers = {} # layer ID -> [downloaded bytes, size, done]
+    last_report = 0
+
+    def summary():
+        return {
+            "layers": len(layers),
+            "layers_done": sum(1 for layer in layers.values() if layer[2]),
+            "current": sum(layer[0] for layer in layers.values()),
+            "total": sum(layer[1] for layer in layers.values()),
+        }
+
+    for event in client.api.pull(repository, tag=tag, stream=True, decode=True):
+        if event.get("error"):
+            raise docker.errors.APIError(f"Pull of '{image_name}' failed: {event['error']}")
+        status = event.get("status")
+        if not event.get("id") or status not in _LAYER_STATUSES:
+            continue
+        layer = layers.setdefault(event["id"], [0, 0, False])
+        detail = event.get("progressDetail") or {}
+        if status == "Downloading" and detail.get("total"):
+            layer[0], layer[1] = detail.get("current", 0), detail["total"]
+        elif status in ("Download complete", "Extracting", "Pull complete"):
+            layer[0] = layer[1]
+        layer[2] = layer[2] or status in ("Pull complete", "Already exists")
+        if progress and time.monotonic() - last_report >= PULL_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            progress(summary())
+    if progress and layers:
+        progress(summary())
+    return client.images.get(f"{repository}@{tag}" if tag.startswith("sha256:") else f"{repository}:{tag}")
+
+
+def ensure_image(client, image_name, progress=None):
+    """Makes sure an image is present on the client's daemon, pulling it if needed.
+
+    Args:
+        client (docker.DockerClient): The Docker client instance.
+        image_name (str): The name of the Docker image.
+        progress (callable, optional): Receives pull progress; see pull_image().
+
+    Returns:
+        str: The resolved image ID.
+
+    Raises:
+        docker.errors.ImageNotFound: If the image could not be pulled.
+        docker.errors.APIError: On other daemon errors.
+    """
+    key = (_daemon_key(client), image_name)
+    with _image_cache_lock:
+        cached = _image_cache.get(key)
+    if cached and cached[1] > time.monotonic():
+        image_gc.touch(client, image_name, cached[0])
+        return cached[0]
+    try:
+        with metrics.timed("image_lookup"):
+            image = client.images.get(image_name)
+    except docker.errors.ImageNotFound:
+        log.info(f"Image '{image_name}' not found locally. Pulling...")
+        metrics.inc("image_pulls_total", reason="missing")
+        with metrics.timed("image_pull"):
+            image = pull_image(client, image_name, progress)
+        log.info(f"Image '{image_name}' pulled successfully.")
+        image_gc.request_collect()
+    _cache_image(client, image_name, image.id)
+    image_gc.touch(client, image_name, image.id)
+    return image.id
+
+
+def cached_image_id(client, image_name):
+    """Returns the image ID the cache holds for the client's daemon, or None (never calls the daemon)."""
+    with _image_cache_lock:
+        cached = _image_cache.get((_daemon_key(client), image_name))
+    return cached[0] if cached and cached[1] > time.monotonic() else None
+
+
+def invalidate_image(image_name):
+    """Forgets cached presence of an image on every daemon."""
+    with _image_cache_lock:
+        for key in [key for key in _image_cache if key[1] == image_name]:
+            del _image_cache[key]
+
+
+def prefetch_image(image_name, docker_hosts=None):
+    """Pulls an image in the background on each daemon and caches the result.
+
+    Args:
+        image_name (str): The name of the Docker image.
+        docker_hosts (list, optional): Daemon URLs to pull on. Defaults to every configured host.
+    """
+    if not image_name:
+        return
+    for docker_host in docker_hosts or [host.url for host in get_docker_hosts()]:
+        _prefetch_executor.submit(_prefetch_one, image_name, docker_host)
+
+
+def _prefetch_one(image_name, docker_host):
+    client = get_docker_client(docker_host)
+    if not client:
+        return
+    try:
+        # Always pull so an updated tag is picked up, not just a missing one
+        metrics.inc("image_pulls_total", reason="prefetch")
+        image = pull_image(client, image_name)
+        _cache_image(client, image_name, image.id)
+        image_gc.touch(client, image_name, image.id)
+        image_gc.request_collect()
+        log.info(f"Prefetched image '{image_name}' on '{docker_host or 'default'}'.")
+    except docker.errors.APIError as e:
+        log.error(f"Docker API error while prefetching image '{image_name}': {e}")
+        _handle_api_error(client, e)
+    except Exception as e:
+        log.error(f"An unexpected error occurred while prefetching image '{image_name}': {e}")
+        mark_client_failed(client)
+
+# --- Docker Hosts & Placement ---
+#
+# Instances can be spread over several daemons. Each start picks the host with
+# the fewest running managed containers among those with enough memory
+# headroom, preferring hosts that already have the image. Stats come from one
+# raw list call per host and are cached briefly; placements made in between
+# are counted optimistically.
+
+PLACEMENT_STATS_TTL = 10 # Seconds host stats are reused between placements
+IMAGE_PULL_PENALTY = 5 # Running-container equivalent of having to pull the image
+
+HOST_LABEL = "ctfd_docker_host"
+MEM_LABEL = "ctfd_mem_bytes"
+CPU_LABEL = "ctfd_cpus"
+CPUSET_LABEL = "ctfd_cpuset"
+SPEC_HASH_LABEL = "ctfd_spec_hash"
+STACK_LABEL = "ctfd_stack"
+SERVICE_LABEL = "ctfd_service"
+NETWORK_LABEL = "ctfd_network"
+
+
+class DockerHost:
+    """A configured Docker daemon and the address players use to reach it."""
+
+    def __init__(self, url=None, public_address=None):
+        self.url = url or None
+        self.public_address = public_address or None
+
+    @property
+    def name(self):
+        return self.url or "default"
+
+    def __eq__(self, other):
+        return isinstance(other, DockerHost) and (self.url, self.public_address) == (other.url, other.public_address)
+
+    def __hash__(self):
+        return hash((self.url, self.public_address))
+
+
+_docker_hosts = [DockerHost()]
+_memory_budget = 0 # Bytes of docker_mem_limit each host may commit; 0 means MemTotal only
+_host_stats = {} # host URL -> {"running", "committed", "mem_total", "expires"}
+_host_stats_lock = threading.Lock()
+
+
+def parse_docker_hosts(hosts_str):
+    """Parses the docker_hosts setting: one 'url [public_address]' per line.
+
+    Args:
+        hosts_str (str): e.g. 'unix:///var/run/docker.sock ctf.example.com'.
+
+    Returns:
+        list: DockerHost entries; the default daemon if the setting is empty.
+    """
+    hosts = []
+    for line in (hosts_str or '').splitlines():
+        parts = line.split()
+        if not parts or parts[0].startswith('#'): continue
+        hosts.append(DockerHost(parts[0], parts[1] if len(parts) > 1 else None))
+    return hosts or [DockerHost()]
+
+
+def configure_docker_hosts(hosts):
+    """Replaces the set of daemons instances are placed on."""
+    global _docker_hosts
+    hosts = list(hosts) or [DockerHost()]
+    if hosts != _docker_hosts:
+        log.info(f"Docker hosts configured: {', '.join(host.name for host in hosts)}")
+        _docker_hosts = hosts
+
+
+def get_docker_hosts():
+    return list(_docker_hosts)
+
+
+def configure_memory_budget(budget_bytes):
+    """Caps the summed docker_mem_limit of running instances on each host."""
+    global _memory_budget
+    _memory_budget = int(budget_bytes or 0)
+
+
+def get_docker_host(url):
+    """Returns the configured DockerHost for a URL (or a bare one if unknown)."""
+    for host in _docker_hosts:
+        if host.url == (url or None):
+            return host
+    return DockerHost(url)
+
+
+def parse_mem_limit(mem_limit):
+    """Converts a Docker memory limit ('512m', '1g', '1024') to bytes (0 if unset)."""
+    if not mem_limit:
+        return 0
+    value = str(mem_limit).strip().lower().rstrip('b')
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def _get_host_stats(host, client):
+    now = time.monotonic()
+    with _host_stats_lock:
+        stats = _host_stats.get(host.url)
+        if stats and stats["expires"] > now:
+            return stats
+    # Paused (idle) instances hold their memory but no CPU
+    containers = client.api.containers(filters={"label": "ctfd_managed=true", "status": ["running", "paused"]})
+    info = client.info()
+    stats = {
+        "running": sum(1 for c in containers if c.get("State") == "running"),
+        "committed": sum(int((c.get("Labels") or {}).get(MEM_LABEL) or 0) for c in containers),
+        "mem_total": info.get("MemTotal", 0),
+        "expires": now + PLACEMENT_STATS_TTL,
+    }
+    with _host_stats_lock:
+        _host_stats[host.url] = stats
+    return stats
+
+
+def _image_cached_on(client, image_name):
+    with _image_cache_lock:
+        cached = _image_cache.get((_daemon_key(client), image_name))
+    return bool(cached and cached[1] > time.monotonic())
+
+
+def choose_docker_host(image_name, mem_limit=None):
+    """Picks the daemon for a new instance.
+
+    Args:
+        image_name (str): The image to run; hosts that already have it are preferred.
+        mem_limit (str, optional): The instance's memory limit ('512m', or bytes for a whole
+                                   stack), checked against headroom.
+
+    Returns:
+        tuple: (DockerHost, docker.DockerClient), or (None, None) if no host is
+               reachable or every host is out of memory budget.
+    """
+    hosts = get_docker_hosts()
+    mem_bytes = parse_mem_limit(mem_limit)
+    best = None
+    for host in hosts:
+        client = get_docker_client(host.url)
+        if not client:
+            continue
+        if len(hosts) == 1 and not _memory_budget:
+            return host, client
+        try:
+            stats = _get_host_stats(host, client)
+        except Exception as e:
+            log.error(f"Failed to read stats from Docker host '{host.name}': {e}")
+            mark_client_failed(client)
+            continue
+        capacity = min(filter(None, (stats["mem_total"], _memory_budget)), default=0)
+        if capacity and stats["committed"] + mem_bytes > capacity:
+            continue
+        score = stats["running"] + (0 if _image_cached_on(client, image_name) else IMAGE_PULL_PENALTY)
+        if best is None or score < best[0]:
+            best = (score, host, client, stats)
+    if best is None:
+        return None, None
+    _, host, client, stats = best
+    with _host_stats_lock:
+        # Count this placement until the next refresh
+        stats["running"] += 1
+        stats["committed"] += mem_bytes
+    return host, client
+
+# --- Admission Control ---
+#
+# Bounds how many container creates hit each daemon at once. Excess starts
+# wait in a per-host FIFO queue (and can report their position) instead of
+# piling onto a daemon that is already slow. The limit and queue live in one
+# worker process: with several workers, a daemon sees up to the limit times
+# the number of workers.
+
+MAX_CONCURRENT_CREATES = 4 # Per daemon, per worker process
+ADMISSION_TIMEOUT = 300 # Seconds a start may wait for a create slot
+ADMISSION_POLL_INTERVAL = 1 # Seconds between queue position updates
+
+
+class AdmissionController:
+    """Per-daemon concurrency limit for container creates with fair queueing, within this process."""
+
+    def __init__(self, max_concurrent_creates=MAX_CONCURRENT_CREATES):
+        self.max_concurrent_creates = max_concurrent_creates
+        self._cond = threading.Condition()
+        self._waiting = {} # host URL -> deque of tickets
+        self._active = {} # host URL -> creates in flight
+
+    def configure(self, max_concurrent_creates):
+        with self._cond:
+            self.max_concurrent_creates = max(1, int(max_concurrent_creates or MAX_CONCURRENT_CREATES))
+            self._cond.notify_all()
+
+    def queued(self, docker_host=None):
+        with self._cond:
+            return len(self._waiting.get(docker_host, ()))
+
+    def snapshot(self):
+        """Returns {host URL: (creates in flight, starts waiting)}."""
+        with self._cond:
+            hosts = set(self._active) | set(self._waiting)
+            return {host: (self._active.get(host, 0), len(self._waiting.get(host, ()))) for host in hosts}
+
+    @contextmanager
+    def slot(self, docker_host, on_wait=None, timeout=ADMISSION_TIMEOUT):
+        """Waits for a create slot on a daemon.
+
+        Args:
+            docker_host (str): The daemon URL (None for the default daemon).
+            on_wait (callable, optional): Called with the 1-based queue position while waiting.
+            timeout (float, optional): Seconds to wait before giving up.
+
+        Yields:
+            bool: True once admitted, False if the wait timed out.
+        """
+        ticket = object()
+        queued_at = time.monotonic()
+        deadline = queued_at + timeout
+        admitted = False
+        with self._cond:
+            queue = self._waiting.setdefault(docker_host, deque())
+            queue.append(ticket)
+            last_position = None
+            while True:
+                if queue[0] is ticket and self._active.get(docker_host, 0) < self.max_concurrent_creates:
+                    queue.popleft()
+                    self._active[docker_host] = self._active.get(docker_host, 0) + 1
+                    admitted = True
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    queue.remove(ticket)
+                    break
+                position = queue.index(ticket) + 1
+                if on_wait and position != last_position:
+                    last_position = position
+                    self._cond.release()
+                    try:
+                        on_wait(position)
+                    finally:
+                        self._cond.acquire()
+                    continue
+                self._cond.wait(min(remaining, ADMISSION_POLL_INTERVAL))
+            # Let the next waiter re-check whether it is at the front now
+            self._cond.notify_all()
+        metrics.observe("admission_wait", time.monotonic() - queued_at)
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                with self._cond:
+                    self._active[docker_host] -= 1
+                    self._cond.notify_all()
+
+
+admission = AdmissionController()
+
+# --- CPU Pinning ---
+#
+# Optionally pins each instance with a CPU limit to specific cores
+# (cpuset_cpus). Instances allowed one CPU or more get whole cores of their
+# own, on a single NUMA node where they fit; smaller instances share the
+# least loaded core. Per-core load is rebuilt from the CPUSET_LABEL and
+# CPU_LABEL labels of the managed containers on each daemon (one raw list
+# call, cached like placement stats), so cores are released as soon as a
+# container is removed and every worker process sees the same layout.
+# The Docker API does not expose the NUMA topology; nodes are assumed to
+# be equal, contiguous core ranges (see CoreAllocator.configure).
+
+CPUSET_STATS_TTL = 10 # Seconds per-core load is reused between allocations
+
+
+def parse_cpuset(cpuset):
+    """Parses '0-2,5' into [0, 1, 2, 5]."""
+    cores = []
+    for part in filter(None, (cpuset or "").split(",")):
+        start, _, end = part.partition("-")
+        cores.extend(range(int(start), int(end or start) + 1))
+    return cores
+
+
+def format_cpuset(cores):
+    """Formats [0, 1, 2, 5] as '0-2,5'."""
+    ranges = []
+    for core in sorted(cores):
+        if ranges and core == ranges[-1][1] + 1:
+            ranges[-1][1] = core
+        else:
+            ranges.append([core, core])
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+class CoreAllocator:
+    """Assigns core sets to new containers, balancing load across cores and NUMA nodes."""
+
+    def __init__(self):
+        self.enabled = False
+        self.numa_nodes = 1
+        self._hosts = {} # daemon key -> {"load": [per-core CPUs], "expires": monotonic}
+        self._lock = threading.Lock()
+
+    def configure(self, enabled, numa_nodes=1):
+        with self._lock:
+            self.enabled = bool(enabled)
+            self.numa_nodes = max(1, int(numa_nodes or 1))
+
+    def invalidate(self, client):
+        """Forgets a daemon's cached load so the next allocation re-reads it."""
+        with self._lock:
+            self._hosts.pop(_daemon_key(client), None)
+
+    def pin(self, client, spec, container_params):
+        """Adds cpuset_cpus (and its label) to run() parameters if pinning applies.
+
+        Returns:
+            str: The assigned cpuset, or None if the container is left unpinned.
+        """
+        if not self.enabled or not spec.cpu_limit:
+            return None
+        try:
+            cpuset = self.allocate(client, float(spec.cpu_limit))
+        except Exception as e:
+            log.error(f"CPU pinning skipped; failed to read core usage: {e}")
+            return None
+        container_params["cpuset_cpus"] = cpuset
+        container_params["labels"][CPUSET_LABEL] = cpuset
+        return cpuset
+
+    def allocate(self, client, cpus):
+        """Picks cores for a container limited to `cpus` CPUs and counts them as used.
+
+        Returns:
+            str: A cpuset string such as '4-5'.
+        """
+        key = _daemon_key(client)
+        with self._lock:
+            host = self._hosts.get(key)
+        if not host or host["expires"] <= time.monotonic():
+            fresh = {"load": self._read_load(client), "expires": time.monotonic() + CPUSET_STATS_TTL}
+            with self._lock:
+                host = self._hosts.get(key)
+                # Another thread may have refreshed it meanwhile; keep its optimistic counts
+                if not host or host["expires"] <= time.monotonic():
+                    host = self._hosts[key] = fresh
+        with self._lock:
+            load = host["load"]
+            node_size = math.ceil(len(load) / self.numa_nodes)
+            nodes = [range(start, min(start + node_size, len(load))) for start in range(0, len(load), node_size)]
+            node_load = lambda node: sum(load[core] for core in node)
+            if cpus >= 1:
+                # Dedicated whole cores, on the node where the least loaded ones are
+                need = min(math.ceil(cpus), len(load))
+                candidates = [(sorted(node, key=lambda core: load[core])[:need], node) for node in nodes if len(node) >= need]
+                if not candidates:
+                    candidates = [(sorted(range(len(load)), key=lambda core: load[core])[:need], range(len(load)))] # Spans nodes
+                chosen, _ = min(candidates, key=lambda c: (sum(load[core] for core in c[0]), node_load(c[1])))
+                metrics.inc("cpuset_allocations_total", kind="dedicated")
+            else:
+                # A share of the least loaded core, preferring the least loaded node
+                node_of = {core: node for node in nodes for core in node}
+                chosen = [min(range(len(load)), key=lambda core: (load[core], node_load(node_of[core]), core))]
+                metrics.inc("cpuset_allocations_total", kind="shared")
+            for core in chosen:
+                load[core] += cpus / len(chosen)
+        return format_cpuset(chosen)
+
+    def _read_load(self, client):
+        ncpu = client.info().get("NCPU") or 1
+        load = [0.0] * ncpu
+        containers = client.api.containers(filters={"label": ["ctfd_managed=true", CPUSET_LABEL], "status": ["running", "paused", "created"]})
+        for container in containers:
+            labels = container.get("Labels") or {}
+            cores = [core for core in parse_cpuset(labels.get(CPUSET_LABEL)) if core < ncpu]
+            if not cores:
+                continue
+            try:
+                cpus = float(labels.get(CPU_LABEL) or len(cores))
+            except ValueError:
+                cpus = len(cores)
+            for core in cores:
+                load[core] += cpus / len(cores)
+        return load
+
+
+cores = CoreAllocator()
+
+# --- Host Ports ---
+#
+# With a host port range configured, every published port of a player
+# instance is picked by the plugin before containers.run() instead of by
+# Docker's ephemeral allocator. Connection info is then known without
+# inspecting the container, players sharing a challenge never collide on a
+# fixed docker_ports host port, and firewalls only need to open the range.
+# Each daemon has a free list over the range, rebuilt from the PORTS_LABEL
+# label (and published ports) of its managed containers on first use, on
+# reconcile and whenever it runs dry. Workers allocate independently, in a
+# different random order; a port another worker took first shows up as a
+# bind conflict and is retried with the next free one.
+
+PORT_CONFLICT_RETRIES = 3 # Retries of containers.run() after a host port bind conflict
+
+PORTS_LABEL = "ctfd_host_ports"
+
+_PORT_CONFLICT_RE = re.compile(r'Bind for \S*:(\d+) failed: port is already allocated')
+
+
+def parse_port_range(value):
+    """Parses '30000-39999' into (30000, 39999); empty disables the allocator.
+
+    Raises:
+        ValueError: If the range is malformed or outside 1-65535.
+    """
+    if not (value or "").strip():
+        return None
+    start, sep, end = value.strip().partition("-")
+    first, last = int(start), int(end if sep else start)
+    if not 1 <= first <= last <= 65535:
+        raise ValueError(f"Invalid host port range: {value}")
+    return first, last
+
+
+class _PortPool:
+    """Free list and owners of one daemon's host ports."""
+
+    def __init__(self, port_range, used, owners, pending=()):
+        used = set(used) | set(pending)
+        free = [port for port in range(port_range[0], port_range[1] + 1) if port not in used]
+        random.shuffle(free) # Keeps workers from racing for the same ports
+        self.free = deque(free)
+        self.used = used
+        self.pending = set(pending) # Taken but not bound to a container yet
+        self.owners = owners # container ID -> [host ports]
+
+
+class PortAllocator:
+    """Hands out host ports from the configured range, per daemon."""
+
+    def __init__(self):
+        self.port_range = None
+        self._hosts = {} # daemon key -> _PortPool
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.port_range is not None
+
+    def configure(self, port_range):
+        with self._lock:
+            if port_range != self.port_range:
+                self.port_range = port_range
+                self._hosts.clear()
+
+    def assign(self, client, spec):
+        """Picks host ports for every port a new container of `spec` publishes.
+
+        Fixed host ports from docker_ports are kept for global instances only;
+        everywhere else two players would collide on them.
+
+        Returns:
+            dict: 'port/proto' -> host port, for containers.run(ports=...).
+            None: If the allocator is disabled or the spec publishes nothing.
+
+        Raises:
+            RuntimeError: If the range has no free port left.
+        """
+        if not self.enabled or not spec.ports_config:
+            return None
+        ports_config = {}
+        wanted = []
+        for container_port, host_port in spec.ports_config.items():
+            if host_port and spec.scope == SCOPE_GLOBAL:
+                ports_config[container_port] = host_port
+            else:
+                wanted.append(container_port)
+        allocated = self.allocate(client, len(wanted))
+        ports_config.update(zip(wanted, allocated))
+        return ports_config
+
+    def allocate(self, client, count):
+        """Takes `count` free host ports off the daemon's free list.
+
+        Raises:
+            RuntimeError: If fewer than `count` ports are free, even after a rebuild.
+        """
+        if count <= 0:
+            return []
+        key = _daemon_key(client)
+        with self._lock:
+            pool = self._hosts.get(key)
+            ports = self._take(pool, count) if pool else None
+        if ports is None:
+            # Ports freed by other workers only show up in a rebuild
+            self.rebuild(client)
+            with self._lock:
+                pool = self._hosts.get(key)
+                ports = self._take(pool, count) if pool else None
+        if ports is None:
+            metrics.inc("host_port_exhausted_total")
+            raise RuntimeError(f"No free host ports left in {self.port_range[0]}-{self.port_range[1]}.")
+        return ports
+
+    def _take(self, pool, count):
+        ports = []
+        while pool.free and len(ports) < count:
+            port = pool.free.popleft()
+            if port not in pool.used: # Released and re-marked ports may be listed twice
+                pool.used.add(port)
+                pool.pending.add(port)
+                ports.append(port)
+        if len(ports) < count:
+            self._give_back(pool, ports)
+            return None
+        return ports
+
+    def _give_back(self, pool, ports):
+        for port in ports:
+            pool.pending.discard(port)
+            if port in pool.used:
+                pool.used.discard(port)
+                pool.free.append(port)
+
+    def bind(self, client, container_id, ports):
+        """Records which container holds `ports`, so release() can free them."""
+        with self._lock:
+            pool = self._hosts.get(_daemon_key(client))
+            if pool:
+                pool.owners[container_id] = list(ports)
+                pool.pending.difference_update(ports)
+
+    def release(self, client, container_id=None, ports=()):
+        """Returns a container's ports (and/or `ports`) to the free list."""
+        with self._lock:
+            pool = self._hosts.get(_daemon_key(client))
+            if not pool:
+                return
+            ports = list(ports) + (pool.owners.pop(container_id, None) or [])
+            self._give_back(pool, [port for port in ports if self._in_range(port)])
+
+    def mark_used(self, client, port):
+        """Records a port found taken outside this process."""
+        with self._lock:
+            pool = self._hosts.get(_daemon_key(client))
+            if pool:
+                pool.used.add(port)
+
+    def rebuild(self, client):
+        """Rebuilds a daemon's free list from all of its containers (one raw list call).
+
+        Ports published by containers the plugin does not manage count as used too.
+        """
+        if not self.enabled:
+            return
+        used, owners = set(), {}
+        for entry in client.api.containers(all=True):
+            held = {port["PublicPort"] for port in entry.get("Ports") or [] if port.get("PublicPort")}
+            labels = entry.get("Labels") or {}
+            held.update(int(port) for port in (labels.get(PORTS_LABEL) or "").split(",") if port.isdigit())
+            held = [port for port in held if self._in_range(port)]
+            if held:
+                used.update(held)
+                owners[entry["Id"]] = held
+        key = _daemon_key(client)
+        with self._lock:
+            if self.port_range:
+                # Ports handed out for containers that do not exist yet stay taken
+                previous = self._hosts.get(key)
+                self._hosts[key] = _PortPool(self.port_range, used, owners, previous.pending if previous else ())
+        log.info(f"Host port allocator rebuilt: {len(used)} port(s) in use.")
+
+    def _in_range(self, port):
+        return self.port_range is not None and self.port_range[0] <= port <= self.port_range[1]
+
+
+host_ports = PortAllocator()
+
+
+def _run_container(client, container_params, spec):
+    """containers.run() with host ports from the allocator, when it is enabled.
+
+    Returns:
+        tuple: (container, whether host ports were assigned up front).
+    """
+    for attempt in range(PORT_CONFLICT_RETRIES + 1):
+        ports_config = host_ports.assign(client, spec)
+        if ports_config:
+            container_params["ports"] = ports_config
+            container_params["labels"][PORTS_LABEL] = ",".join(str(port) for port in ports_config.values())
+        try:
+            with metrics.timed("container_run"):
+                container = client.containers.run(**container_params)
+        except docker.errors.APIError as e:
+            if not ports_config:
+                raise
+            host_ports.release(client, ports=ports_config.values())
+            conflict = _PORT_CONFLICT_RE.search(str(e))
+            if not conflict:
+                raise
+            # Taken by another worker or process; the container was created but not started
+            host_ports.mark_used(client, int(conflict.group(1)))
+            metrics.inc("host_port_conflicts_total")
+            try:
+                client.api.remove_container(container_params["name"], force=True)
+            except docker.errors.NotFound:
+                pass
+            if attempt == PORT_CONFLICT_RETRIES:
+                raise
+            continue
+        if not ports_config:
+            return container, False
+        host_ports.bind(client, container.id, ports_config.values())
+        # start() succeeded, so the bindings are the ones requested; no inspect needed
+        state = container.attrs.setdefault("State", {})
+        state.update(Status="running", Running=True)
+        container.attrs.setdefault("NetworkSettings", {})["Ports"] = {
+            container_port: [{"HostIp": "0.0.0.0", "HostPort": str(host_port)}]
+            for container_port, host_port in ports_config.items()
+        }
+        return container, True
+
+# --- Stack Networks ---
+#
+# Every stack instance gets a private bridge network. Creating and removing
+# networks is slow on a busy daemon, so emptied networks are kept per
+# daemon (up to NETWORK_POOL_SIZE) and handed to the next stack.
+
+NETWORK_POOL_SIZE = 8 # Idle networks kept per daemon
+NETWORK_PREFIX = "ctfd-net-"
+
+
+class NetworkPool:
+    """Recycles per-instance bridge networks."""
+
+    def __init__(self, size=NETWORK_POOL_SIZE):
+        self.size = size
+        self._idle = {} # daemon key -> deque of network names
+        self._lock = threading.Lock()
+
+    def acquire(self, client):
+        """Returns the name of an empty managed network, creating one if none is idle."""
+        while True:
+            with self._lock:
+                idle = self._idle.get(_daemon_key(client))
+                name = idle.popleft() if idle else None
+            if not name:
+                break
+            try:
+                # The leader's prune() may have removed it from under this worker's pool
+                client.api.inspect_network(name)
+            except docker.errors.NotFound:
+                continue
+            metrics.inc("stack_networks_total", source="pool")
+            return name
+        name = f"{NETWORK_PREFIX}{uuid.uuid4().hex[:12]}"
+        with metrics.timed("network_create"):
+            client.api.create_network(name, driver="bridge", labels={"ctfd_managed": "true"})
+        metrics.inc("stack_networks_total", source="created")
+        return name
+
+    def release(self, client, name):
+        """Takes back a network whose containers are gone; removes it if the pool is full."""
+        try:
+            if not client.api.inspect_network(name).get("Containers"):
+                with self._lock:
+                    idle = self._idle.setdefault(_daemon_key(client), deque())
+                    if len(idle) < self.size and name not in idle:
+                        idle.append(name)
+                        return
+            with metrics.timed("network_remove"):
+                client.api.remove_network(name)
+        except docker.errors.NotFound:
+            pass
+        except docker.errors.APIError as e:
+            # Usually a container still attached; prune() picks it up later
+            log.warning(f"Could not recycle network '{name}': {e}")
+
+    def prune(self, client):
+        """Removes every unused managed network on a daemon, including idle pooled ones.
+
+        Networks pooled by other worker processes go too; acquire() skips them.
+        """
+        with self._lock:
+            self._idle.pop(_daemon_key(client), None)
+        deleted = client.api.prune_networks(filters={"label": "ctfd_managed=true"}).get("NetworksDeleted") or []
+        if deleted:
+            log.info(f"Pruned {len(deleted)} unused network(s).")
+
+
+networks = NetworkPool()
+
+# --- Stacks ---
+#
+# A challenge may define a stack (docker_stack): several services on the
+# instance's private network, where each is reachable by its service name.
+# The entry service is the one players connect to; it carries the instance
+# name, the published ports and the instances table row. The other services
+# are labeled with the stack ID and network, and go away with the entry
+# (see teardown_container). Services start concurrently as soon as the
+# services they depend on are ready: running, and healthy if they define a
+# healthcheck.
+
+STACK_WORKERS = 8 # Services of one stack started at the same time
+STACK_HEALTH_TIMEOUT = 120 # Seconds a service may take to pass its healthcheck
+
+SERVICE_NAME_RE = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9_.-]*$')
+_HEALTHCHECK_DURATIONS = ("interval", "timeout", "start_period") # Seconds in docker_stack, nanoseconds for Docker
+
+
+def parse_stack(stack_str):
+    """Parses a docker_stack definition.
+
+    The definition is JSON: {"entry": "web", "services": {"web": {...}, "db": {...}}}.
+    Each service may set image, ports and env (in the docker_ports/docker_env
+    formats, or as objects), cpu_limit, mem_limit, depends_on (service names)
+    and healthcheck (Docker healthcheck options, durations in seconds). Only
+    the entry service may publish ports; it defaults to the service that
+    does, else the first one.
+
+    Returns:
+        tuple: (entry service name, {service name: service dict}), or (None, {}) if empty.
+
+    Raises:
+        ValueError: If the definition is malformed or its dependencies form a cycle.
+    """
+    if not (stack_str or "").strip():
+        return None, {}
+    try:
+        stack = json.loads(stack_str)
+    except ValueError:
+        raise ValueError("Stack definition is not valid JSON.")
+    services = stack.get("services") if isinstance(stack, dict) else None
+    if not isinstance(services, dict) or not services:
+        raise ValueError("Stack definition needs a non-empty 'services' object.")
+    for name, service in services.items():
+        if not SERVICE_NAME_RE.match(name) or not isinstance(service, dict):
+            raise ValueError(f"Invalid stack service: {name}")
+        unknown = set(service.get("depends_on") or []) - set(services)
+        if unknown:
+            raise ValueError(f"Service '{name}' depends on unknown service(s): {', '.join(sorted(unknown))}")
+    entry = stack.get("entry") or next((name for name, service in services.items() if service.get("ports")), next(iter(services)))
+    if entry not in services:
+        raise ValueError(f"Entry service '{entry}' is not defined.")
+    if any(service.get("ports") for name, service in services.items() if name != entry):
+        raise ValueError("Only the entry service may publish ports.")
+    # Every service must be startable once its dependencies are
+    started = set()
+    while len(started) < len(services):
+        startable = [name for name, service in services.items()
+                     if name not in started and set(service.get("depends_on") or []) <= started]
+        if not startable:
+            raise ValueError("Stack services have circular dependencies.")
+        started.update(startable)
+    return entry, services
+
+
+def _service_ports(value):
+    return {str(port): host_port for port, host_port in value.items()} if isinstance(value, dict) else parse_ports_config(value)
+
+
+def _service_env(value):
+    return {str(key): str(val) for key, val in value.items()} if isinstance(value, dict) else parse_env_vars(value)
+
+
+def _service_healthcheck(value):
+    if not value:
+        return None
+    if not isinstance(value, dict) or not value.get("test"):
+        raise ValueError("A healthcheck needs a 'test'.")
+    return {key: int(float(val) * 1e9) if key in _HEALTHCHECK_DURATIONS else val for key, val in value.items()}
+
+
+class StackService:
+    """One container of a challenge stack, besides the entry service."""
+
+    def __init__(self, name, image_name, env_vars=None, cpu_limit=None, mem_limit=None, depends_on=(), healthcheck=None):
+        if not image_name:
+            raise ValueError(f"Service '{name}' has no image.")
+        self.name = name
+        self.image_name = image_name
+        self.env_vars = dict(env_vars or {})
+        self.cpu_limit = cpu_limit or None
+        self.mem_limit = mem_limit or None
+        self.nano_cpus = int(float(cpu_limit) * 1e9) if cpu_limit else None
+        self.mem_bytes = parse_mem_limit(mem_limit)
+        self.depends_on = tuple(depends_on or ())
+        self.healthcheck = healthcheck
+
+    @classmethod
+    def from_dict(cls, name, service):
+        return cls(
+            name,
+            service.get("image"),
+            env_vars=_service_env(service.get("env")),
+            cpu_limit=service.get("cpu_limit"),
+            mem_limit=service.get("mem_limit"),
+            depends_on=service.get("depends_on"),
+            healthcheck=_service_healthcheck(service.get("healthcheck")),
+        )
+
+    def fingerprint(self):
+        return [self.name, self.image_name, sorted(self.env_vars.items()), self.nano_cpus, self.mem_limit,
+                sorted(self.depends_on), json.dumps(self.healthcheck, sort_keys=True)]
+
+    def container_params(self, name, labels):
+        """Returns keyword arguments for client.containers.run(), minus the network."""
+        params = {
+            "image": self.image_name,
+            "name": name,
+            "hostname": self.name,
+            "detach": True,
+            "environment": self.env_vars,
+            "labels": dict(labels, **{SERVICE_LABEL: self.name, MEM_LABEL: str(self.mem_bytes)}),
+        }
+        if self.nano_cpus:
+            params['nano_cpus'] = self.nano_cpus
+            params['labels'][CPU_LABEL] = str(self.cpu_limit)
+        if self.mem_limit:
+            params['mem_limit'] = self.mem_limit
+        if self.healthcheck:
+            params['healthcheck'] = self.healthcheck
+        return params
+
+
+def _launch(client, container_params, spec, progress=None):
+    """Runs a spec's container, or its whole stack.
+
+    Returns:
+        tuple: (entry container, whether host ports were assigned up front).
+    """
+    if not spec.services:
+        return _run_container(client, container_params, spec)
+    return _run_stack(client, container_params, spec, progress)
+
+
+def _run_stack(client, container_params, spec, progress=None):
+    stack_id = uuid.uuid4().hex[:12]
+    network = networks.acquire(client)
+    shared = {key: value for key, value in container_params["labels"].items()
+              if key in ("ctfd_managed", "challenge_id", "user_id", "team_id", HOST_LABEL)}
+    shared.update({STACK_LABEL: stack_id, NETWORK_LABEL: network})
+    container_params["labels"].update(shared)
+    container_params["network"] = network
+    container_params["networking_config"] = {network: client.api.create_endpoint_config(aliases=[spec.service_name])}
+    services = {service.name: service for service in spec.services}
+    entry = {}
+
+    def start(name):
+        if name == spec.service_name:
+            entry["result"] = _run_container(client, container_params, spec)
+            return
+        service = services[name]
+        if progress:
+            progress("service", f"Starting service '{name}'...", service=name)
+        ensure_image(client, service.image_name)
+        params = service.container_params(f"{container_params['name']}-{name}", shared)
+        params["network"] = network
+        params["networking_config"] = {network: client.api.create_endpoint_config(aliases=[name])}
+        cores.pin(client, service, params)
+        with metrics.timed("container_run"):
+            container = client.containers.run(**params)
+        if service.healthcheck:
+            _wait_healthy(client, container.id, name)
+
+    depends_on = {service.name: service.depends_on for service in spec.services}
+    depends_on[spec.service_name] = spec.depends_on
+    try:
+        with metrics.timed("stack_start"):
+            _run_in_dependency_order(depends_on, start)
+    except Exception:
+        if entry.get("result"):
+            host_ports.release(client, entry["result"][0].id)
+        try:
+            client.api.remove_container(container_params["name"], force=True, v=True)
+        except docker.errors.NotFound:
+            pass
+        _remove_stack_members(client, stack_id, network)
+        raise
+    return entry["result"]
+
+
+def _run_in_dependency_order(depends_on, fn, max_workers=STACK_WORKERS):
+    """Calls fn(name) for every name in `depends_on` once fn has returned for all of its dependencies.
+
+    Independent names run concurrently. The first exception is re-raised
+    after calls already running have finished; later names are not started.
+    """
+    done, futures = set(), {}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(depends_on)), thread_name_prefix="ctfd-docker-stack") as executor:
+        while len(done) < len(depends_on):
+            for name, prerequisites in depends_on.items():
+                if name not in futures and set(prerequisites) <= done:
+                    futures[name] = executor.submit(fn, name)
+            running = {future: name for name, future in futures.items() if name not in done}
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                future.result()
+                done.add(running[future])
+
+
+def _wait_healthy(client, container_id, name, timeout=STACK_HEALTH_TIMEOUT):
+    """Waits for a service's healthcheck to pass, backing off between inspects.
+
+    Raises:
+        RuntimeError: If the service exits, turns unhealthy or times out.
+    """
+    deadline = time.monotonic() + timeout
+    delay = READY_BACKOFF[0]
+    while True:
+        state = client.api.inspect_container(container_id).get("State") or {}
+        health = (state.get("Health") or {}).get("Status")
+        if health == "healthy":
+            return
+        if health == "unhealthy" or state.get("Status") in ("exited", "dead"):
+            raise RuntimeError(f"Stack service '{name}' failed to become healthy ({health or state.get('Status')}).")
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError(f"Stack service '{name}' did not become healthy within {timeout}s.")
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, READY_BACKOFF[1])
+
+
+def _stack_of(client, container_id):
+    """Returns (stack ID, network) of the stack whose entry is `container_id`, or None.
+
+    Decided from the container's own labels (indexed, or one filtered list
+    call), so it works in workers that never compiled the stack's spec.
+    """
+    summary = state_index.get(container_id)
+    if summary is not None:
+        labels = summary["labels"]
+    else:
+        entries = client.api.containers(all=True, filters={"id": [container_id]})
+        labels = (entries[0].get("Labels") or {}) if entries else {}
+    if not labels.get(STACK_LABEL) or labels.get(SERVICE_LABEL):
+        return None
+    return labels[STACK_LABEL], labels.get(NETWORK_LABEL)
+
+
+def _remove_stack_members(client, stack_id, network=None):
+    """Removes a stack's non-entry services and recycles its network."""
+    members = client.api.containers(all=True, filters={"label": [f"{STACK_LABEL}={stack_id}", SERVICE_LABEL]})
+    for member in members:
+        try:
+            client.api.remove_container(member["Id"], force=True, v=True)
+        except docker.errors.NotFound:
+            pass
+    if members:
+        cores.invalidate(client)
+    if network:
+        networks.release(client, network)
+
+# --- Launch Specs ---
+#
+# A LaunchSpec is a challenge's container configuration parsed once (ports,
+# env, limits, labels) and cached by challenge ID, so the start path does no
+# string parsing. Specs are rebuilt on challenge create/update and dropped on
+# update/delete. Other worker processes pick up changes after LAUNCH_SPEC_TTL.
+
+LAUNCH_SPEC_TTL = 60 # Seconds a cached spec is trusted
+
+# Who shares one instance of a challenge
+SCOPE_USER = "user" # Every player gets their own
+SCOPE_TEAM = "team" # Teammates share one (per player outside team mode)
+SCOPE_GLOBAL = "global" # Everyone shares one, with a read-only root filesystem
+INSTANCE_SCOPES = (SCOPE_USER, SCOPE_TEAM, SCOPE_GLOBAL)
+
+# ctfd-{user_id}-{challenge_id}, ctfd-team{team_id}-{challenge_id} or ctfd-global-{challenge_id}
+INSTANCE_NAME_RE = re.compile(r'^ctfd-(?:(\d+)|team(\d+)|global)-(\d+)$')
+
+_launch_specs = {} # challenge_id -> (LaunchSpec, expires at)
+_launch_specs_lock = threading.Lock()
+
+
+class LaunchSpec:
+    """Pre-parsed container configuration for one docker challenge."""
+
+    def __init__(self, challenge_id, image_name, ports_config=None, env_vars=None, cpu_limit=None, mem_limit=None, timeout=3600, pool_size=0, scope=SCOPE_USER, stop_on_solve=False, services=None, depends_on=(), service_name=None):
+        if scope not in INSTANCE_SCOPES:
+            raise ValueError(f"Invalid instance scope: {scope}")
+        self.challenge_id = challenge_id
+        self.image_name = image_name
+        self.ports_config = dict(ports_config or {})
+        self.env_vars = dict(env_vars or {})
+        self.cpu_limit = cpu_limit or None
+        self.mem_limit = mem_limit or None
+        self.nano_cpus = int(float(cpu_limit) * 1e9) if cpu_limit else None
+        self.mem_bytes = parse_mem_limit(mem_limit)
+        self.timeout = int(timeout or 3600)
+        self.scope = scope
+        # A single shared instance has nothing to pre-start
+        self.pool_size = 0 if scope == SCOPE_GLOBAL else int(pool_size or 0)
+        self.stop_on_solve = bool(stop_on_solve)
+        # Stack: the other services, what the entry service waits for, and its name on the network
+        self.services = list(services or ())
+        self.depends_on = tuple(depends_on or ())
+        self.service_name = service_name or "app"
+        self.total_mem_bytes = self.mem_bytes + sum(service.mem_bytes for service in self.services)
+        self.labels = {
+            "ctfd_managed": "true",
+            "challenge_id": str(challenge_id),
+            MEM_LABEL: str(self.mem_bytes),
+        }
+        if self.cpu_limit:
+            self.labels[CPU_LABEL] = str(self.cpu_limit)
+
+    @classmethod
+    def from_type_data(cls, challenge_id, type_data):
+        """Builds a spec from a challenge's type_data.
+
+        With a docker_stack, the entry service's settings take precedence over
+        the challenge's docker_image, docker_ports, docker_env and limits.
+
+        Raises:
+            ValueError: If the image is missing or ports/env/limits/stack are malformed.
+        """
+        entry, stack = parse_stack(type_data.get('docker_stack'))
+        entry_service = stack.get(entry, {})
+        image_name = entry_service.get('image') or type_data.get('docker_image')
+        if not image_name:
+            raise ValueError("Docker image not configured for this challenge.")
+        ports = entry_service.get('ports', type_data.get('docker_ports'))
+        try:
+            ports_config = _service_ports(ports)
+        except ValueError:
+            raise ValueError(f"Invalid port mapping format: {ports}")
+        env = entry_service.get('env', type_data.get('docker_env'))
+        try:
+            env_vars = _service_env(env)
+        except ValueError:
+            raise ValueError(f"Invalid environment variable format: {env}")
+        try:
+            services = [StackService.from_dict(name, service) for name, service in stack.items() if name != entry]
+        except ValueError as e:
+            raise ValueError(f"Invalid stack service: {e}")
+        scope = type_data.get('docker_scope') or SCOPE_USER
+        if scope not in INSTANCE_SCOPES:
+            raise ValueError(f"Invalid instance scope: {scope}")
+        try:
+            return cls(
+                challenge_id,
+                image_name,
+                ports_config=ports_config,
+                env_vars=env_vars,
+                cpu_limit=entry_service.get('cpu_limit', type_data.get('docker_cpu_limit')),
+                mem_limit=entry_service.get('mem_limit', type_data.get('docker_mem_limit')),
+                timeout=type_data.get('docker_timeout'),
+                pool_size=type_data.get('docker_pool_size'),
+                scope=scope,
+                stop_on_solve=str(type_data.get('docker_stop_on_solve') or '').lower() in ('1', 'true', 'on', 'yes'),
+                services=services,
+                depends_on=entry_service.get('depends_on'),
+                service_name=entry,
+            )
+        except ValueError:
+            raise ValueError("Invalid CPU, memory, timeout or pool size setting.")
+
+    def spec_hash(self, image_id):
+        """Fingerprint of everything that requires a recreate when it changes."""
+        payload = json.dumps([
+            image_id,
+            sorted(self.ports_config.items()),
+            sorted(self.env_vars.items()),
+            self.nano_cpus,
+            self.mem_limit,
+        ] + (["read_only"] if self.scope == SCOPE_GLOBAL else [])
+          + ([self.service_name, sorted(self.depends_on)] + [service.fingerprint() for service in self.services] if self.services else []))
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    @property
+    def has_fixed_ports(self):
+        return any(host_port for host_port in self.ports_config.values())
+
+    def owner(self, user_id, team_id=None):
+        """Returns (scope, owner ID) of the instance a player uses; owner ID is None for global."""
+        if self.scope == SCOPE_GLOBAL:
+            return SCOPE_GLOBAL, None
+        if self.scope == SCOPE_TEAM and team_id is not None:
+            return SCOPE_TEAM, team_id
+        return SCOPE_USER, user_id
+
+    def instance_name(self, user_id, team_id=None):
+        """Container name of the instance a player uses (see INSTANCE_NAME_RE)."""
+        scope, owner_id = self.owner(user_id, team_id)
+        if scope == SCOPE_GLOBAL:
+            return f"ctfd-global-{self.challenge_id}"
+        if scope == SCOPE_TEAM:
+            return f"ctfd-team{owner_id}-{self.challenge_id}"
+        return f"ctfd-{owner_id}-{self.challenge_id}"
+
+    def container_params(self, name, labels=None, ports_config=None):
+        """Returns keyword arguments for client.containers.run()."""
+        params = {
+            "image": self.image_name,
+            "name": name,
+            "detach": True,
+            "ports": self.ports_config if ports_config is None else ports_config, # e.g., {'container_port/tcp': host_port}
+            "environment": self.env_vars,
+            "labels": dict(self.labels, **(labels or {})),
+        }
+        if self.nano_cpus:
+            params['nano_cpus'] = self.nano_cpus
+        if self.mem_limit:
+            params['mem_limit'] = self.mem_limit
+        if self.scope == SCOPE_GLOBAL:
+            # Shared by every player; nobody may leave changes behind for the others
+            params['read_only'] = True
+            params['tmpfs'] = {"/tmp": "", "/run": ""}
+        return params
+
+
+def cache_launch_spec(spec):
+    with _launch_specs_lock:
+        _launch_specs[spec.challenge_id] = (spec, time.monotonic() + LAUNCH_SPEC_TTL)
+
+
+def get_cached_launch_spec(challenge_id):
+    with _launch_specs_lock:
+        cached = _launch_specs.get(challenge_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def invalidate_launch_spec(challenge_id):
+    with _launch_specs_lock:
+        _launch_specs.pop(challenge_id, None)
+
+# --- Container Management Functions ---
+
+@metrics.timer("start_container")
+def start_challenge_container(client, image_name, user_id, challenge_id, ports_config=None, env_vars=None, cpu_limit=None, mem_limit=None, docker_host=None, launch_spec=None, reuse_existing=True, team_id=None, progress=None):
+    """Starts a Docker container for a specific challenge and user.
+
+    The container is the one named by the spec's instance scope (see
+    LaunchSpec.instance_name), so teammates or all players may share it.
+    If that container already exists and was built from the same spec
+    (image ID, ports, env, limits; see SPEC_HASH_LABEL), it is returned as is
+    when healthy or restarted in place when stopped. Otherwise it is replaced.
+    The daemon the container was placed on is recorded in its HOST_LABEL label.
+
+    Args:
+        client (docker.DockerClient): The Docker client instance. None places the
+                                      container on a host with choose_docker_host().
+        image_name (str): The name of the Docker image to use.
+        user_id (int): The ID of the user starting the challenge.
+        challenge_id (int): The ID of the challenge.
+        ports_config (dict, optional): Dictionary for port mapping (e.g., {'80/tcp': 8080}). Defaults to None.
+        env_vars (dict, optional): Dictionary of environment variables. Defaults to None.
+        cpu_limit (str, optional): CPU limit (e.g., '1'). Defaults to None.
+        mem_limit (str, optional): Memory limit (e.g., '512m'). Defaults to None.
+        docker_host (str, optional): URL of the daemon `client` talks to. Ignored when placing.
+        launch_spec (LaunchSpec, optional): Pre-parsed configuration; replaces image_name,
+                                            ports_config, env_vars and the limits.
+        reuse_existing (bool, optional): Set to False to always recreate. Defaults to True.
+        team_id (int, optional): The user's team; names team-scoped instances and is recorded
+                                 as a label for filtering. Defaults to None.
+        progress (callable, optional): Called as progress(stage, message, **detail) when the
+                                       image is pulled ('pull', with pull_image() detail),
+                                       the container is created ('create') and started ('start').
+
+    Returns:
+        docker.models.containers.Container: The started container object.
+        None: If container startup fails.
+    """
+    spec = launch_spec or LaunchSpec(challenge_id, image_name, ports_config, env_vars, cpu_limit, mem_limit)
+    image_name = spec.image_name
+    container_name = spec.instance_name(user_id, team_id)
+    if not client:
+        host, client = choose_docker_host(image_name, spec.total_mem_bytes)
+        if not client:
+            log.error(f"No Docker host available to start container '{container_name}'.")
+            return None
+        docker_host = host.url
+    try:
+        log.info(f"Attempting to start container '{container_name}' from image '{image_name}'...")
+
+        # Pull image if not present (skipped when the image cache knows it's there)
+        pull_progress = (lambda detail: progress("pull", "Pulling image...", **detail)) if progress else None
+        with metrics.timed("image"):
+            image_id = ensure_image(client, image_name, pull_progress)
+        spec_hash = spec.spec_hash(image_id)
+
+        # Reuse an existing container built from the same spec; recreate it otherwise
+        try:
+            with metrics.timed("container_lookup"):
+                existing_container = client.containers.get(container_name)
+            stack = existing_container.labels.get(STACK_LABEL)
+            # A stack is only reused while it runs; its other services are not restarted in place
+            if reuse_existing and existing_container.labels.get(SPEC_HASH_LABEL) == spec_hash and (
+                    not stack or existing_container.status in ("running", "paused")):
+                with metrics.timed("container_reuse"):
+                    reused = _reuse_container(existing_container)
+                if reused:
+                    metrics.inc("container_starts_total", outcome="reused")
+                    return reused
+            log.info(f"Container '{container_name}' is outdated or unhealthy. Recreating...")
+            with metrics.timed("container_remove"):
+                existing_container.remove(force=True) # Kill and remove in one call; no graceful wait
+                if stack:
+                    _remove_stack_members(client, stack, existing_container.labels.get(NETWORK_LABEL))
+        except docker.errors.NotFound:
+            pass # Container doesn't exist, proceed
+
+        # Prepare container configuration (resource limits come precomputed from the spec)
+        container_labels = {
+            "user_id": str(user_id),
+            HOST_LABEL: docker_host or "",
+            SPEC_HASH_LABEL: spec_hash,
+        }
+        if team_id is not None:
+            container_labels["team_id"] = str(team_id)
+        container_params = spec.container_params(container_name, labels=container_labels)
+        cores.pin(client, spec, container_params)
+
+        if progress:
+            progress("create", "Creating container...")
+        # containers.run() itself pulls and retries if the cached image was removed behind our back
+        container, ports_known = _launch(client, container_params, spec, progress)
+        if not ports_known:
+            # run() returns the pre-start inspect data; port bindings only exist once it runs
+            with metrics.timed("container_reload"):
+                container.reload()
+        log.info(f"Container '{container.name}' (ID: {container.short_id}) started successfully.")
+        metrics.inc("container_starts_total", outcome="created")
+        if progress:
+            progress("start", "Container started.")
+        return container
+
+    except docker.errors.ImageNotFound:
+        log.error(f"Image '{image_name}' not found and could not be pulled.")
+        invalidate_image(image_name)
+        metrics.inc("container_starts_total", outcome="failed")
+        return None
+    except docker.errors.APIError as e:
+        log.error(f"Docker API error while starting container '{container_name}': {e}")
+        metrics.inc("container_starts_total", outcome="failed")
+        _handle_api_error(client, e)
+        return None
+    except RuntimeError as e:
+        log.error(f"Cannot start container '{container_name}': {e}")
+        metrics.inc("container_starts_total", outcome="failed")
+        return None
+    except Exception as e:
+        log.error(f"An unexpected error occurred while starting container '{container_name}': {e}")
+        metrics.inc("container_starts_total", outcome="failed")
+        mark_client_failed(client)
+        return None
+
+def is_current_instance(docker_host, container_id, spec):
+    """True if the state index shows the container running (or paused) and built from the current spec.
+
+    Reads only in-memory state (the index and the image cache), so request handlers
+    can call it; returns False whenever either of them cannot tell.
+    """
+    if not state_index.is_live(docker_host):
+        return False
+    summary = state_index.get(container_id)
+    if not summary or summary["state"] not in ("running", "paused"):
+        return False
+    client = pooled_client(docker_host)
+    image_id = client and cached_image_id(client, spec.image_name)
+    return bool(image_id) and summary["labels"].get(SPEC_HASH_LABEL) == spec.spec_hash(image_id)
+
+
+def find_running_instance(client, spec, user_id, team_id=None):
+    """Returns the player's instance if it runs (or is paused) and was built from the current spec.
+
+    Unlike start_challenge_container() this never pulls, creates, restarts or
+    replaces a container, so a live instance can be handed back without an
+    admission slot. An image missing from the image cache counts as outdated.
+
+    Args:
+        client (docker.DockerClient): Client for the daemon the instance was placed on.
+        spec (LaunchSpec): The challenge's launch spec.
+        user_id (int): The ID of the user starting the challenge.
+        team_id (int, optional): The user's team.
+
+    Returns:
+        docker.models.containers.Container: The running instance.
+        None: If there is none, it is stopped, unhealthy or outdated, or the lookup failed.
+    """
+    container_name = spec.instance_name(user_id, team_id)
+    try:
+        with metrics.timed("container_lookup"):
+            container = client.containers.get(container_name)
+        if container.status not in ("running", "paused"):
+            return None
+        image_id = cached_image_id(client, spec.image_name)
+        if not image_id or container.labels.get(SPEC_HASH_LABEL) != spec.spec_hash(image_id):
+            return None
+        with metrics.timed("container_reuse"):
+            reused = _reuse_container(container)
+    except docker.errors.NotFound:
+        return None
+    except docker.errors.APIError as e:
+        log.error(f"Docker API error while looking up container '{container_name}': {e}")
+        _handle_api_error(client, e)
+        return None
+    except (docker.errors.DockerException, requests.exceptions.RequestException) as e:
+        log.error(f"Could not look up container '{container_name}': {e}")
+        mark_client_failed(client)
+        return None
+    if reused:
+        metrics.inc("container_starts_total", outcome="reused")
+    return reused
+
+
+def _reuse_container(container):
+    """Returns `container` ready to serve if it can be reused in place, else None."""
+    state = container.attrs.get("State", {})
+    if container.status == "running":
+        if state.get("Health", {}).get("Status") == "unhealthy":
+            return None
+        log.info(f"Reusing running container '{container.name}' (ID: {container.short_id}).")
+        return container
+    if container.status == "paused":
+        container.unpause()
+    elif container.status in ("exited", "created"):
+        log.info(f"Restarting stopped container '{container.name}' (ID: {container.short_id}) in place.")
+        container.start()
+    else:
+        return None
+    container.reload() # Port bindings are only known once it runs again
+    return container
+
+# --- Readiness ---
+#
+# A started container is not necessarily serving yet. When an admin sets a
+# probe address, its published TCP ports are probed from the CTFd server
+# until they accept connections, with exponential backoff between rounds,
+# before the instance is reported ready. Probes run on a small pool of their
+# own so waiting services don't hold start job workers.
+
+READY_TIMEOUT = 30 # Seconds to wait for published ports to accept connections
+READY_BACKOFF = (0.1, 2.0) # First and longest delay between probe rounds
+READY_CONNECT_TIMEOUT = 1 # Seconds per connection attempt
+READY_EOF_WAIT = 0.2 # Seconds to watch a fresh connection for an immediate close
+READY_WORKERS = 16 # Concurrent readiness probes (mostly sleeping between rounds)
+READY_PROBE_DAEMON = "daemon" # Probe address setting: each daemon's TCP hostname
+
+
+class ReadinessChecker:
+    """Probes the published ports of started instances, if enabled."""
+
+    def __init__(self, max_workers=READY_WORKERS):
+        self.address = None # None disables probing; see configure()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ctfd-docker-ready")
+
+    def configure(self, address):
+        """Sets where published ports are probed.
+
+        Args:
+            address (str): A host or IP the CTFd server reaches every daemon's
+                published ports at, READY_PROBE_DAEMON to use each daemon's
+                TCP hostname, or empty to disable probing.
+        """
+        self.address = (address or "").strip() or None
+
+    def address_for(self, docker_host):
+        """Address to probe a daemon's published ports at, or None to skip probing."""
+        if self.address != READY_PROBE_DAEMON:
+            return self.address
+        parsed = urlparse(docker_host or os.environ.get("DOCKER_HOST") or "")
+        if parsed.scheme in ("tcp", "http", "https", "ssh") and parsed.hostname:
+            return parsed.hostname
+        return None # Local socket: where CTFd reaches its ports (host, container, ...) is unknown
+
+    def submit(self, callback, address, ports, on_retry=None):
+        """Runs wait_for_ports() on the probe pool, then `callback(ready)`.
+
+        Returns:
+            Future: Done once the callback has run.
+        """
+        return self._executor.submit(lambda: callback(wait_for_ports(address, ports, on_retry=on_retry)))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+readiness = ReadinessChecker()
+
+
+def _port_accepts(address, port):
+    try:
+        with socket.create_connection((address, port), timeout=READY_CONNECT_TIMEOUT) as conn:
+            # Docker's userland proxy accepts even when nothing listens inside, then hangs up
+            conn.settimeout(READY_EOF_WAIT)
+            try:
+                return conn.recv(1, socket.MSG_PEEK) != b""
+            except socket.timeout:
+                return True # Open and waiting for the client to speak first
+    except OSError:
+        return False
+
+
+def wait_for_ports(address, ports, timeout=READY_TIMEOUT, on_retry=None):
+    """Waits until every TCP port in `ports` accepts connections on `address`.
 
     Args:
-        docker_host (str, optional): The URL or path to the Docker daemon socket.
-                                     Defaults to None, which uses docker.from_env().
+        address (str): Host to connect to (see ReadinessChecker.address_for()).
+        ports (iterable): Host port numbers.
+        timeout (float, optional): Seconds to keep trying.
+        on_retry (callable, optional): Called as on_retry(attempt, pending ports) before each backoff.
 
     Returns:
-        docker.DockerClient: An initialized Docker client instance.
-        None: If connection to Docker daemon fails.
+        bool: True once all ports accepted a connection, False on timeout.
     """
-    try:
-        if docker_host:
-            client = docker.DockerClient(base_url=docker_host)
-        else:
-            # Connect using environment settings (e.g., DOCKER_HOST or default socket)
-            client = docker.from_env()
-        # Test the connection
-        client.ping()
-        log.info("Successfully connected to Docker daemon.")
-        return client
-    except docker.errors.DockerException as e:
-        log.error(f"Failed to connect to Docker daemon: {e}")
-        return None
-    except Exception as e:
-        log.error(f"An unexpected error occurred while connecting to Docker: {e}")
-        return None
+    pending = sorted({int(port) for port in ports})
+    deadline = time.monotonic() + timeout
+    delay = READY_BACKOFF[0]
+    attempt = 0
+    with metrics.timed("ready_wait"):
+        while True:
+            attempt += 1
+            pending = [port for port in pending if not _port_accepts(address, port)]
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                metrics.inc("ready_checks_total", outcome="timeout" if pending else "ready")
+                return not pending
+            if on_retry:
+                on_retry(attempt, pending)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, READY_BACKOFF[1])
 
-# --- Container Management Functions ---
+STOP_GRACE = 0 # Default seconds to wait for a graceful stop; 0 kills immediately
+TEARDOWN_WORKERS = 16 # Concurrent teardowns in teardown_containers()
 
-def start_challenge_container(client, image_name, user_id, challenge_id, ports_config=None, env_vars=None, cpu_limit=None, mem_limit=None):
-    """Starts a new Docker container for a specific challenge and user.
+@metrics.timer("teardown")
+def teardown_container(client, container_id, grace=STOP_GRACE):
+    """Stops and removes a container in as few daemon calls as possible.
 
     Args:
-        client (docker.DockerClient): The Docker client instance.
-        image_name (str): The name of the Docker image to use.
-        user_id (int): The ID of the user starting the challenge.
-        challenge_id (int): The ID of the challenge.
-        ports_config (dict, optional): Dictionary for port mapping (e.g., {'80/tcp': 8080}). Defaults to None.
-        env_vars (dict, optional): Dictionary of environment variables. Defaults to None.
-        cpu_limit (str, optional): CPU limit (e.g., '1'). Defaults to None.
-        mem_limit (str, optional): Memory limit (e.g., '512m'). Defaults to None.
+        client (docker.DockerClient): The Docker client instance. None uses the pooled default client.
+        container_id (str): The ID or name of the container.
+        grace (int, optional): Seconds to wait for a graceful stop before killing.
+                               0 kills and removes in a single forced remove call.
 
     Returns:
-        docker.models.containers.Container: The started container object.
-        None: If container startup fails.
+        bool: True if the container is gone (including if it never existed), False on error.
     """
-    container_name = f"ctfd-{user_id}-{challenge_id}" # Basic naming convention
+    client = client or get_docker_client()
+    if not client:
+        return False
     try:
-        log.info(f"Attempting to start container '{container_name}' from image '{image_name}'...")
-
-        # Check if container already exists (optional, depends on desired behavior)
-        try:
-            existing_container = client.containers.get(container_name)
-            log.warning(f"Container '{container_name}' already exists. Reusing or error handling needed? Stopping for now.")
-            # Decide policy: reuse, error, or remove and recreate. For now, remove.
-            existing_container.stop()
-            existing_container.remove()
-        except docker.errors.NotFound:
-            pass # Container doesn't exist, proceed
+        stack = _stack_of(client, container_id)
+        if grace:
+            client.api.stop(container_id, timeout=grace)
+        # Forced removal kills the container if it is still running
+        client.api.remove_container(container_id, force=True, v=True)
+        cores.invalidate(client) # Its cores are free again
+        host_ports.release(client, container_id)
+        if stack:
+            _remove_stack_members(client, *stack) # The rest of its stack goes with it
+        log.info(f"Container '{container_id}' torn down.")
+        metrics.inc("teardowns_total", outcome="removed")
+        return True
+    except docker.errors.NotFound:
+        host_ports.release(client, container_id)
+        metrics.inc("teardowns_total", outcome="missing")
+        return True
+    except docker.errors.APIError as e:
+        if e.status_code == 409:
+            # Removal already in progress (e.g. a concurrent teardown)
+            metrics.inc("teardowns_total", outcome="in_progress")
+            return True
+        log.error(f"Docker API error while tearing down container '{container_id}': {e}")
+        metrics.inc("teardowns_total", outcome="failed")
+        _handle_api_error(client, e)
+        return False
+    except Exception as e:
+        log.error(f"An unexpected error occurred while tearing down container '{container_id}': {e}")
+        metrics.inc("teardowns_total", outcome="failed")
+        mark_client_failed(client)
+        return False
 
-        # Pull image if not present
-        try:
-            client.images.get(image_name)
-        except docker.errors.ImageNotFound:
-            log.info(f"Image '{image_name}' not found locally. Pulling...")
-            client.images.pull(image_name)
-            log.info(f"Image '{image_name}' pulled successfully.")
+def teardown_containers(targets, grace=STOP_GRACE, max_workers=TEARDOWN_WORKERS):
+    """Tears down many containers concurrently.
 
-        # Prepare container configuration
-        container_params = {
-            "image": image_name,
-            "name": container_name,
-            "detach": True,
-            "ports": ports_config, # e.g., {'container_port/tcp': host_port}
-            "environment": env_vars,
-            "labels": {
-                "ctfd_managed": "true",
-                "user_id": str(user_id),
-                "challenge_id": str(challenge_id)
-            }
-            # Add resource limits if specified
-            # Note: Exact parameter names might vary slightly based on Docker SDK version
-            # "cpu_shares": ..., "mem_limit": ... need careful mapping
-        }
+    Args:
+        targets (iterable): (docker_host, container_id) pairs; docker_host None is the default daemon.
+        grace (int, optional): Graceful stop timeout passed to teardown_container().
+        max_workers (int, optional): Maximum concurrent teardowns.
 
-        # Add resource limits (adjust parameter names as needed for your Docker SDK version)
-        # Example using common parameters, verify with SDK docs
-        nano_cpus = int(float(cpu_limit) * 1e9) if cpu_limit else None
-        if nano_cpus:
-             container_params['nano_cpus'] = nano_cpus
-        if mem_limit:
-             container_params['mem_limit'] = mem_limit
+    Returns:
+        dict: container_id -> bool, as returned by teardown_container().
+    """
+    targets = list(targets)
+    if not targets:
+        return {}
 
-        container = client.containers.run(**container_params)
-        log.info(f"Container '{container.name}' (ID: {container.short_id}) started successfully.")
-        return container
+    def _teardown(target):
+        docker_host, container_id = target
+        return container_id, teardown_container(get_docker_client(docker_host), container_id, grace)
 
-    except docker.errors.ImageNotFound:
-        log.error(f"Image '{image_name}' not found and could not be pulled.")
-        return None
-    except docker.errors.APIError as e:
-        log.error(f"Docker API error while starting container '{container_name}': {e}")
-        return None
-    except Exception as e:
-        log.error(f"An unexpected error occurred while starting container '{container_name}': {e}")
-        return None
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets)), thread_name_prefix="ctfd-docker-teardown") as executor:
+        results = dict(executor.map(_teardown, targets))
+    failed = sum(1 for ok in results.values() if not ok)
+    log.info(f"Tore down {len(results) - failed}/{len(results)} container(s).")
+    return results
 
-def stop_container(client, container_id):
+def stop_container(client, container_id, grace=STOP_GRACE):
     """Stops and removes a Docker container.
 
     Args:
-        client (docker.DockerClient): The Docker client instance.
+        client (docker.DockerClient): The Docker client instance. None uses the pooled default client.
         container_id (str): The ID or name of the container to stop.
+        grace (int, optional): Seconds to wait for a graceful stop. Defaults to STOP_GRACE.
 
     Returns:
-        bool: True if stopped and removed successfully, False otherwise.
+        bool: True if stopped and removed successfully (or already gone), False otherwise.
     """
-    try:
-        container = client.containers.get(container_id)
-        log.info(f"Stopping container '{container.name}' (ID: {container.short_id})...")
-        container.stop()
-        log.info(f"Removing container '{container.name}' (ID: {container.short_id})...")
-        container.remove()
-        log.info(f"Container '{container.name}' stopped and removed successfully.")
-        return True
-    except docker.errors.NotFound:
-        log.warning(f"Container '{container_id}' not found. Cannot stop or remove.")
-        return False
-    except docker.errors.APIError as e:
-        log.error(f"Docker API error while stopping/removing container '{container_id}': {e}")
-        return False
-    except Exception as e:
-        log.error(f"An unexpected error occurred while stopping/removing container '{container_id}': {e}")
-        return False
+    return teardown_container(client, container_id, grace)
 
 def get_container_details(client, container_id):
     """Gets details about a specific container.
 
     Args:
-        client (docker.DockerClient): The Docker client instance.
+        client (docker.DockerClient): The Docker client instance. None uses the pooled default client.
         container_id (str): The ID or name of the container.
 
     Returns:
         dict: A dictionary containing container attributes.
         None: If the container is not found or an error occurs.
     """
+    client = client or get_docker_client()
+    if not client:
+        return None
     try:
         container = client.containers.get(container_id)
         return container.attrs
@@ -162,43 +1971,1304 @@ def get_container_details(client, container_id):
         return None
     except docker.errors.APIError as e:
         log.error(f"Docker API error while getting details for container '{container_id}': {e}")
+        _handle_api_error(client, e)
         return None
     except Exception as e:
         log.error(f"An unexpected error occurred while getting details for container '{container_id}': {e}")
+        mark_client_failed(client)
         return None
 
-def list_managed_containers(client, user_id=None, challenge_id=None):
+LIST_PAGE_SIZE = 500 # Containers fetched per list call when paginating
+
+def _managed_filters(user_id=None, team_id=None, challenge_id=None, state=None, labels=None):
+    # All label constraints are ANDed by the daemon, so they must be sent together
+    label_filters = ["ctfd_managed=true"]
+    if user_id is not None:
+        label_filters.append(f"user_id={user_id}")
+    if team_id is not None:
+        label_filters.append(f"team_id={team_id}")
+    if challenge_id is not None:
+        label_filters.append(f"challenge_id={challenge_id}")
+    label_filters.extend(f"{key}={value}" for key, value in (labels or {}).items())
+    filters = {"label": label_filters}
+    if state:
+        filters["status"] = state
+    return filters
+
+def iter_managed_containers(client, user_id=None, team_id=None, challenge_id=None, state=None, labels=None, docker_host=None, page_size=LIST_PAGE_SIZE, strict=False):
+    """Yields summaries of managed containers, fetched page by page.
+
+    Uses the raw list endpoint, so no container is inspected. Pages are
+    walked newest first with `limit` plus a `before` filter on the last ID seen.
+    If that container is removed in between (the daemon answers 404), the
+    walk continues from the one before it on the page, or starts over
+    skipping containers already yielded.
+
+    Args:
+        client (docker.DockerClient): The Docker client instance. None uses the pooled default client.
+        user_id (int, optional): Filter by user ID.
+        team_id (int, optional): Filter by team ID.
+        challenge_id (int, optional): Filter by challenge ID.
+        state (str, optional): Filter by state (e.g., 'running', 'exited', 'paused').
+        labels (dict, optional): Additional label constraints.
+        docker_host (str, optional): Daemon URL recorded in the summaries.
+        page_size (int, optional): Containers per list call.
+        strict (bool, optional): Raise on daemon errors instead of logging and stopping,
+                                 for callers that must tell "no containers" from "unknown".
+
+    Yields:
+        dict: {'id', 'name', 'labels', 'state', 'ports', 'created', 'docker_host'}.
+    """
+    client = client or get_docker_client(docker_host)
+    if not client:
+        if strict:
+            raise docker.errors.DockerException(f"Docker host '{docker_host or 'default'}' is unreachable.")
+        return
+    base_filters = filters = _managed_filters(user_id, team_id, challenge_id, state, labels)
+    seen = set()
+    cursors = [] # IDs of the last page, oldest first; the last one is the current cursor
+    while True:
+        try:
+            entries = client.api.containers(all=True, limit=page_size, filters=filters)
+        except docker.errors.APIError as e:
+            if e.status_code == 404 and cursors:
+                # The cursor container was removed; fall back to the previous one on the page
+                cursors.pop()
+                filters = dict(base_filters, before=cursors[-1]) if cursors else base_filters
+                continue
+            log.error(f"Docker API error while listing managed containers: {e}")
+            _handle_api_error(client, e)
+            if strict:
+                raise
+            return
+        except Exception as e:
+            log.error(f"An unexpected error occurred while listing managed containers: {e}")
+            mark_client_failed(client)
+            if strict:
+                raise
+            return
+        for entry in entries:
+            if entry["Id"] not in seen:
+                seen.add(entry["Id"])
+                yield _summarize_container(entry, docker_host)
+        if len(entries) < page_size:
+            return
+        cursors = [entry["Id"] for entry in entries]
+        filters = dict(base_filters, before=cursors[-1])
+
+def list_managed_containers(client, user_id=None, challenge_id=None, team_id=None, state=None, docker_host=None):
     """Lists containers managed by this plugin, optionally filtered.
 
     Args:
-        client (docker.DockerClient): The Docker client instance.
+        client (docker.DockerClient): The Docker client instance. None uses the pooled default client.
         user_id (int, optional): Filter by user ID. Defaults to None.
         challenge_id (int, optional): Filter by challenge ID. Defaults to None.
+        team_id (int, optional): Filter by team ID. Defaults to None.
+        state (str, optional): Filter by state (e.g., 'running'). Defaults to None.
+        docker_host (str, optional): Daemon URL recorded in the summaries. Defaults to None.
 
     Returns:
-        list: A list of container objects managed by the plugin.
+        list: Lightweight summaries (see iter_managed_containers) of the matching containers.
     """
-    filters = {"label": "ctfd_managed=true"}
-    if user_id:
-        filters["label"] = f"user_id={user_id}"
-    if challenge_id:
-        filters["label"] = f"challenge_id={challenge_id}"
-    # Combine filters if both are provided
-    if user_id and challenge_id:
-         filters["label"] = [f"ctfd_managed=true", f"user_id={user_id}", f"challenge_id={challenge_id}"]
+    return list(iter_managed_containers(client, user_id=user_id, team_id=team_id, challenge_id=challenge_id, state=state, docker_host=docker_host))
+
+# --- Leader Election ---
+#
+# Background duties that must run once per deployment rather than once per
+# worker process (warm pool refills, idle sampling, image eviction, the
+# startup sweep) only run in the process holding the leader lease. The plugin
+# supplies the acquire function, backed by its database, through start(). A
+# thread renews the lease every LEADER_RENEW_INTERVAL seconds, and another
+# process takes over once the holder has not renewed it for LEADER_LEASE_TTL.
+# Without start() (a single process, the benchmarks) this process always leads.
+
+LEADER_LEASE_TTL = 30 # Seconds a lease stays valid without renewal
+LEADER_RENEW_INTERVAL = 10 # Seconds between renewals
+
+
+class LeaderElection:
+    """Tracks whether this worker process holds the deployment-wide leader lease."""
+
+    def __init__(self):
+        self.holder = None # "hostname:pid" of this process once started
+        self._acquire = None # callable(holder, ttl) -> bool
+        self._on_elected = None
+        self._leading = False
+        self._thread = None
+
+    def start(self, acquire, on_elected=None):
+        """Starts competing for the lease (idempotent).
+
+        Args:
+            acquire (callable): acquire(holder, ttl) takes or renews the lease for `holder`
+                                for `ttl` seconds and returns True if `holder` now holds it.
+            on_elected (callable, optional): Run in its own thread each time this process
+                                             becomes the leader.
+        """
+        if self._thread and self._thread.is_alive():
+            return
+        # Computed here rather than at import so forked workers get their own
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self._acquire = acquire
+        self._on_elected = on_elected
+        self._thread = threading.Thread(target=self._run, name="ctfd-docker-leader", daemon=True)
+        self._thread.start()
+
+    def is_leader(self):
+        return self._acquire is None or self._leading
+
+    def _run(self):
+        while True:
+            try:
+                leading = bool(self._acquire(self.holder, LEADER_LEASE_TTL))
+            except Exception as e:
+                log.error(f"Could not renew the leader lease: {e}")
+                leading = False
+            elected = leading and not self._leading
+            if leading != self._leading:
+                log.info(f"Worker {self.holder} {'is now' if leading else 'is no longer'} the leader.")
+            self._leading = leading
+            if elected and self._on_elected:
+                threading.Thread(target=self._on_elected, name="ctfd-docker-elected", daemon=True).start()
+            time.sleep(LEADER_RENEW_INTERVAL)
+
+
+leader = LeaderElection()
+
+# --- Warm Pool ---
+#
+# A warm pool keeps a few already-running, unassigned containers per challenge
+# so a start request only has to rename one and hand it over. Docker labels are
+# immutable, so claimed containers keep their pool labels; ownership is carried
+# by the container name (ctfd-{user_id}-{challenge_id}).
+#
+# Only the leader creates and removes pool containers, so a deployment keeps
+# pool_size containers per challenge rather than pool_size per worker. Any
+# worker can claim one; candidates come from the state index. Pausing the
+# container is the claim lock: a second claimer's pause fails with 409, and a
+# claimer that gets in after the rename sees the new name and lets go.
+
+POOL_REFILL_INTERVAL = 5 # Seconds between refill passes
+POOL_DEMAND_WINDOW = 300 # Seconds of claim history used to size the pool
+POOL_SPEC_RELOAD = 30 # Seconds between reloads of pool specs (picks up edits made in other workers)
+POOL_STALE_CLAIM = 30 # Seconds a pool container may stay paused (claim in flight) before it is removed
+POOL_SPEC_LABEL = "ctfd_pool_spec"
+
+
+class WarmPoolManager:
+    """Maintains per-challenge pools of pre-started containers."""
+
+    def __init__(self):
+        self._specs = {} # challenge_id -> LaunchSpec
+        self._claims = {} # challenge_id -> deque of claim timestamps (seen by the leader)
+        self._last_idle = {} # challenge_id -> idle container IDs at the previous pass
+        self._paused_since = {} # container ID -> when a pause (claim lock) was first seen
+        self._load_specs = None
+        self._specs_loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def configure(self, spec):
+        """Registers (or updates) the pool for a challenge.
+
+        Containers built from an earlier version of the spec are removed by the
+        leader's next refill pass and are never handed out meanwhile.
+
+        Args:
+            spec (LaunchSpec): The challenge's launch spec; spec.pool_size is the
+                               maximum number of idle containers. 0 disables the pool.
+        """
+        if spec.pool_size and spec.has_fixed_ports:
+            log.warning(f"Challenge {spec.challenge_id} uses fixed host ports; warm pool disabled.")
+        with self._lock:
+            self._specs[spec.challenge_id] = spec
+            self._claims.setdefault(spec.challenge_id, deque())
+        self._wakeup.set()
+
+    @staticmethod
+    def _fingerprint(spec):
+        # Same inputs as spec_hash(), with the image name standing in for the resolved ID
+        return spec.spec_hash(spec.image_name)
+
+    def remove(self, challenge_id):
+        """Drops the pool for a challenge; the leader removes its idle containers."""
+        with self._lock:
+            self._specs.pop(challenge_id, None)
+            self._claims.pop(challenge_id, None)
+            self._last_idle.pop(challenge_id, None)
+        self._wakeup.set()
+
+    def _idle_summaries(self):
+        # Unclaimed pool containers across every host, as the state index sees them
+        return [
+            summary for summary in state_index.summaries()
+            if summary["name"].startswith("ctfd-pool-") and summary["labels"].get("ctfd_pool") == "true"
+            and not summary["labels"].get(SERVICE_LABEL)
+        ]
+
+    def claim(self, spec, container_name):
+        """Hands an idle pooled container over to a player (or team).
 
+        Args:
+            spec (LaunchSpec): The challenge's launch spec; only containers built from it are handed out.
+            container_name (str): The instance name to give it (see LaunchSpec.instance_name).
+
+        Returns:
+            docker.models.containers.Container: The claimed, running container. Its
+                HOST_LABEL label names the daemon it runs on.
+            None: If the pool is empty or disabled.
+        """
+        if not spec.pool_size or spec.has_fixed_ports:
+            return None
+        prefix = f"ctfd-pool-{spec.challenge_id}-"
+        fingerprint = self._fingerprint(spec)
+        candidates = [
+            summary for summary in self._idle_summaries()
+            if summary["name"].startswith(prefix) and summary["state"] == "running"
+            and summary["labels"].get(POOL_SPEC_LABEL) == fingerprint
+        ]
+        random.shuffle(candidates) # Spread concurrent claimers over different containers
+        for summary in candidates:
+            container_id = summary["id"]
+            client = get_docker_client(summary["docker_host"])
+            if not client:
+                continue
+            try:
+                client.api.pause(container_id) # Claim lock
+            except docker.errors.NotFound:
+                continue
+            except docker.errors.APIError as e:
+                if e.status_code == 409: # Another worker is claiming it, or it stopped
+                    continue
+                log.error(f"Docker API error while claiming pooled container '{container_id}': {e}")
+                _handle_api_error(client, e)
+                return None
+            try:
+                container = client.containers.get(container_id)
+                if not container.name.startswith(prefix):
+                    # Claimed by another worker after the index saw it
+                    client.api.unpause(container_id)
+                    continue
+                try:
+                    container.rename(container_name)
+                except docker.errors.APIError as e:
+                    if e.status_code != 409:
+                        raise
+                    # The user still has an old instance; replace it
+                    client.containers.get(container_name).remove(force=True)
+                    container.rename(container_name)
+                client.api.unpause(container_id)
+                # Keep the fetched attrs in line with the rename and unpause
+                container.attrs["Name"] = f"/{container_name}"
+                container.attrs["State"].update(Status="running", Paused=False)
+                log.info(f"Claimed pooled container {container.short_id} as '{container_name}'.")
+                self._wakeup.set()
+                return container
+            except docker.errors.NotFound:
+                continue
+            except docker.errors.APIError as e:
+                log.error(f"Docker API error while claiming pooled container '{container_id}': {e}")
+                _handle_api_error(client, e)
+            except Exception as e:
+                log.error(f"An unexpected error occurred while claiming pooled container '{container_id}': {e}")
+                mark_client_failed(client)
+            _unpause_quietly(client, container_id)
+            return None
+        return None
+
+    def request_refill(self):
+        """Runs a refill pass now instead of at the next interval (e.g. after capacity was freed)."""
+        self._wakeup.set()
+
+    def idle_counts(self):
+        """Returns {challenge_id: idle pooled containers}."""
+        counts = {}
+        for summary in self._idle_summaries():
+            if summary["state"] == "running" and summary["labels"].get("challenge_id", "").isdigit():
+                challenge_id = int(summary["labels"]["challenge_id"])
+                counts[challenge_id] = counts.get(challenge_id, 0) + 1
+        return counts
+
+    def start(self, load_specs=None):
+        """Starts the background refiller thread (idempotent).
+
+        Args:
+            load_specs (callable, optional): Returns the launch specs of every docker
+                challenge. The leader reloads its pools from it every POOL_SPEC_RELOAD
+                seconds, so edits made through other workers reach it.
+        """
+        self._load_specs = load_specs
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="ctfd-docker-warm-pool", daemon=True)
+        self._thread.start()
+
+    def _target_size(self, challenge_id, now):
+        # Keep one container warm when idle, grow towards the configured size with demand
+        spec = self._specs[challenge_id]
+        size = 0 if spec.has_fixed_ports else spec.pool_size
+        claims = self._claims[challenge_id]
+        while claims and now - claims[0] > POOL_DEMAND_WINDOW:
+            claims.popleft()
+        return min(size, max(1, len(claims))) if size else 0
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(POOL_REFILL_INTERVAL)
+            self._wakeup.clear()
+            if not leader.is_leader():
+                continue
+            try:
+                self._refill()
+            except Exception as e:
+                log.error(f"Warm pool refill failed: {e}")
+
+    def _reload_specs(self, now):
+        if not self._load_specs or now - self._specs_loaded_at < POOL_SPEC_RELOAD:
+            return
+        specs = {spec.challenge_id: spec for spec in self._load_specs() if spec.pool_size}
+        with self._lock:
+            self._specs = specs
+            for challenge_id in specs:
+                self._claims.setdefault(challenge_id, deque())
+        self._specs_loaded_at = now
+
+    def _refill(self):
+        # The index is the only view of what other workers claimed; don't act on a stale one
+        if not all(state_index.is_live(host.url) for host in get_docker_hosts()):
+            return
+        now = time.monotonic()
+        self._reload_specs(now)
+        idle = {} # challenge_id -> [(host URL, container ID)]
+        doomed = [] # Not claimable any more; removed outright
+        retire = [] # Running and still claimable; removed under the claim lock
+        paused = set()
+        for summary in self._idle_summaries():
+            entry = (summary["docker_host"], summary["id"])
+            if summary["state"] == "paused":
+                # A claim in flight; a claimer that died leaves it paused for good
+                paused.add(summary["id"])
+                if now - self._paused_since.setdefault(summary["id"], now) > POOL_STALE_CLAIM:
+                    doomed.append(entry)
+                continue
+            try:
+                challenge_id = int(summary["labels"].get("challenge_id"))
+            except (TypeError, ValueError):
+                continue
+            with self._lock:
+                spec = self._specs.get(challenge_id)
+            if summary["state"] != "running":
+                doomed.append(entry)
+            elif spec is None or summary["labels"].get(POOL_SPEC_LABEL) != self._fingerprint(spec):
+                retire.append(entry) # Challenge gone or pool disabled, or built from an older spec
+            else:
+                idle.setdefault(challenge_id, []).append(entry)
+        self._paused_since = {cid: since for cid, since in self._paused_since.items() if cid in paused}
+
+        with self._lock:
+            plan = {}
+            for challenge_id in self._specs:
+                # Containers that left the pool since the last pass were claimed (by any worker)
+                current = {container_id for _, container_id in idle.get(challenge_id, ())}
+                for container_id in self._last_idle.get(challenge_id, set()) - current:
+                    summary = state_index.get(container_id)
+                    if summary and not summary["name"].startswith("ctfd-pool-"):
+                        self._claims[challenge_id].append(now)
+                plan[challenge_id] = (self._specs[challenge_id], self._target_size(challenge_id, now))
+        self._remove_containers(doomed)
+        self._retire(retire)
+
+        for challenge_id, (spec, target) in plan.items():
+            entries = idle.get(challenge_id, [])
+            excess = entries[target:]
+            entries = entries[:target]
+            self._retire(excess)
+            for _ in range(max(0, target - len(entries))):
+                entry = self._create(challenge_id, spec)
+                if not entry:
+                    break
+                entries.append(entry)
+            with self._lock:
+                if challenge_id in self._specs:
+                    self._last_idle[challenge_id] = {container_id for _, container_id in entries}
+
+    def _create(self, challenge_id, spec):
+        container_name = f"ctfd-pool-{challenge_id}-{uuid.uuid4().hex[:8]}"
+        host, client = choose_docker_host(spec.image_name, spec.total_mem_bytes)
+        if not client:
+            return None
+        try:
+            image_id = ensure_image(client, spec.image_name)
+            container_params = spec.container_params(container_name, labels={
+                "ctfd_pool": "true",
+                HOST_LABEL: host.url or "",
+                SPEC_HASH_LABEL: spec.spec_hash(image_id),
+                POOL_SPEC_LABEL: self._fingerprint(spec),
+            })
+            cores.pin(client, spec, container_params)
+            # Refills share the per-daemon create limit with player starts
+            with admission.slot(host.url) as admitted:
+                if not admitted:
+                    return None
+                container, _ = _launch(client, container_params, spec)
+            # Claimers find pool containers in the index; don't wait for the start event
+            state_index.refresh(client, container.id, host.url)
+            log.info(f"Warm pool container '{container_name}' started on '{host.name}' for challenge {challenge_id}.")
+            return host.url, container.id
+        except docker.errors.APIError as e:
+            log.error(f"Docker API error while starting pooled container '{container_name}': {e}")
+            _handle_api_error(client, e)
+        except RuntimeError as e:
+            log.error(f"Cannot start pooled container '{container_name}': {e}")
+        except Exception as e:
+            log.error(f"An unexpected error occurred while starting pooled container '{container_name}': {e}")
+            mark_client_failed(client)
+        return None
+
+    def _remove_containers(self, entries):
+        if entries:
+            teardown_containers(entries, grace=0) # Nothing in an idle pool container needs a graceful stop
+
+    def _retire(self, entries):
+        # Take the claim lock first so a container a worker is claiming right now is left alone
+        locked = []
+        for docker_host, container_id in entries:
+            client = get_docker_client(docker_host)
+            if not client:
+                continue
+            try:
+                client.api.pause(container_id)
+            except docker.errors.APIError: # Includes NotFound; 409: being claimed
+                continue
+            try:
+                if client.api.inspect_container(container_id)["Name"].lstrip("/").startswith("ctfd-pool-"):
+                    locked.append((docker_host, container_id))
+                    continue
+            except docker.errors.APIError:
+                pass
+            _unpause_quietly(client, container_id)
+        self._remove_containers(locked)
+
+    def drain(self):
+        """Removes every idle pooled container if this process leads. Used on plugin shutdown."""
+        if not leader.is_leader():
+            return
+        self._retire([
+            (summary["docker_host"], summary["id"]) for summary in self._idle_summaries() if summary["state"] == "running"
+        ])
+
+
+def _unpause_quietly(client, container_id):
     try:
-        managed_containers = client.containers.list(all=True, filters=filters)
-        return managed_containers
-    except docker.errors.APIError as e:
-        log.error(f"Docker API error while listing managed containers: {e}")
-        return []
-    except Exception as e:
-        log.error(f"An unexpected error occurred while listing managed containers: {e}")
-        return []
+        client.api.unpause(container_id)
+    except Exception:
+        pass
+
+
+warm_pool = WarmPoolManager()
+
+# --- Background Start Jobs ---
+#
+# Starting an instance can take seconds (minutes on a cold pull), so the web
+# request only enqueues a job on a bounded executor and returns its ID. Jobs are
+# keyed by owner and challenge so repeated clicks attach to the running job.
+# Job state lives in this process only.
+
+START_WORKERS = 8 # Concurrent start jobs per process
+START_QUEUE_LIMIT = 256 # Jobs allowed to wait for a worker before rejecting
+JOB_RESULT_TTL = 600 # Seconds a finished job stays queryable
+
+JOB_QUEUED = "queued"
+JOB_STARTING = "starting"
+JOB_READY = "ready"
+JOB_FAILED = "failed"
+
+
+class StartJob:
+    """Progress and result of one asynchronous instance start."""
+
+    def __init__(self, key):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.status = JOB_QUEUED
+        self.message = "Waiting for a free worker..."
+        self.result = None
+        self.position = None # 1-based place in line while queued
+        self.progress = None # Detail of the current step, e.g. pull progress
+        self.version = 0
+        self.created = self.updated = time.monotonic()
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in (JOB_READY, JOB_FAILED)
+
+    def update(self, status, message, result=None, position=None, progress=None):
+        with self._changed:
+            self.status = status
+            self.message = message
+            self.position = position
+            self.progress = progress
+            if result is not None:
+                self.result = result
+            self.version += 1
+            self.updated = time.monotonic()
+            self._changed.notify_all()
+
+    def wait(self, version, timeout):
+        """Blocks until the job changes past `version` or `timeout` seconds pass."""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version or self.finished, timeout)
+
+    def follow(self, keepalive, max_duration):
+        """Yields to_dict() now and after every change, until the job finishes.
+
+        Yields None after `keepalive` seconds without a change, and stops
+        after `max_duration` seconds even if the job is still running.
+        """
+        deadline = time.monotonic() + max_duration
+        version = None
+        while True:
+            with self._changed:
+                if version is not None:
+                    remaining = max(0, deadline - time.monotonic())
+                    self._changed.wait_for(lambda: self.version != version, min(keepalive, remaining))
+                changed = self.version != version
+                version = self.version
+                snapshot = self.to_dict() if changed else None
+                finished = self.finished
+            yield snapshot
+            if (changed and finished) or time.monotonic() >= deadline:
+                return
+
+    def to_dict(self):
+        data = {
+            "success": self.status != JOB_FAILED,
+            "job_id": self.id,
+            "status": self.status,
+            "message": self.message,
+            "version": self.version,
+        }
+        if self.position is not None:
+            data["position"] = self.position
+        if self.progress:
+            data["progress"] = self.progress
+        if self.result:
+            data.update(self.result)
+        return data
+
+
+class StartJobQueue:
+    """Runs start jobs on a bounded thread pool and tracks them by key."""
+
+    def __init__(self, max_workers=START_WORKERS, max_pending=START_QUEUE_LIMIT):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ctfd-docker-start")
+        self._max_pending = max_pending
+        self._waiting = deque() # Jobs not yet picked up by a worker, in order
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, fn, *args):
+        """Enqueues `fn(job, *args)` unless a job for `key` is still in flight.
+
+        `fn` may return a Future for a last step it handed to another pool
+        (e.g. a readiness probe); the job then counts as in flight until it is done.
+
+        Returns:
+            StartJob: The new or already-running job.
+            None: If the queue is full.
+        """
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(key)
+            if job and not job.finished:
+                return job
+            if len(self._waiting) >= self._max_pending:
+                return None
+            job = self._jobs[key] = StartJob(key)
+            self._waiting.append(job)
+            job.position = len(self._waiting)
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job, fn, args):
+        with self._lock:
+            self._waiting.remove(job)
+            job.position = None
+            for position, waiting in enumerate(self._waiting, 1):
+                waiting.position = position
+        picked_up = time.monotonic()
+        metrics.observe("start_queue_wait", picked_up - job.created)
+        follow_up = None
+        try:
+            follow_up = fn(job, *args)
+        except Exception as e:
+            log.exception(f"Start job {job.id} crashed: {e}")
+            job.update(JOB_FAILED, "Failed to start challenge instance. Please try again or contact an admin.")
+        if follow_up is not None:
+            follow_up.add_done_callback(lambda future: self._finish(job, picked_up, future.exception()))
+        else:
+            self._finish(job, picked_up)
+
+    def _finish(self, job, picked_up, error=None):
+        if error:
+            log.error(f"Start job {job.id} failed after starting: {error}")
+        if not job.finished:
+            job.update(JOB_FAILED, "Instance start did not complete.")
+        metrics.observe("start_job", time.monotonic() - picked_up)
+        metrics.inc("start_jobs_total", status=job.status)
+
+    def pending(self):
+        with self._lock:
+            return len(self._waiting)
+
+    def _prune(self):
+        now = time.monotonic()
+        expired = [key for key, job in self._jobs.items() if job.finished and now - job.updated > JOB_RESULT_TTL]
+        for key in expired:
+            del self._jobs[key]
+
+
+start_jobs = StartJobQueue()
+
+# --- Expiry Reaper ---
+#
+# Instance deadlines sit in a min-heap; the reaper thread sleeps until the
+# earliest one is due, then hands due instances to a bounded thread pool in
+# batches. Rescheduling or cancelling leaves the old heap entry in place and
+# it is skipped when popped.
+
+REAPER_WORKERS = 8 # Concurrent teardowns
+REAPER_BATCH_SIZE = 64 # Max instances handled per wake-up
+
+
+class ExpiryReaper:
+    """Calls a handler for each key once its deadline (epoch seconds) passes."""
+
+    def __init__(self, max_workers=REAPER_WORKERS, batch_size=REAPER_BATCH_SIZE):
+        self._heap = []
+        self._deadlines = {} # key -> current deadline
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ctfd-docker-reaper")
+        self._batch_size = batch_size
+        self._handler = None
+        self._thread = None
+
+    def schedule(self, key, deadline):
+        """Sets (or moves) the deadline for `key`."""
+        with self._cond:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, str(key), key))
+            # Only wake the thread if this is now the earliest deadline
+            if self._heap[0][2] == key:
+                self._cond.notify()
+
+    def cancel(self, key):
+        with self._cond:
+            self._deadlines.pop(key, None)
+
+    def deadline(self, key):
+        with self._cond:
+            return self._deadlines.get(key)
+
+    def start(self, handler):
+        """Starts the reaper thread; `handler(key)` tears down one expired instance."""
+        self._handler = handler
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name="ctfd-docker-reaper", daemon=True)
+        self._thread.start()
+
+    def _next_batch(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                batch = []
+                while self._heap and self._heap[0][0] <= now and len(batch) < self._batch_size:
+                    deadline, _, key = heapq.heappop(self._heap)
+                    if self._deadlines.get(key) == deadline:
+                        del self._deadlines[key]
+                        batch.append(key)
+                if batch:
+                    return batch
+                timeout = self._heap[0][0] - now if self._heap else None
+                self._cond.wait(timeout)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            log.info(f"Reaping {len(batch)} expired instance(s).")
+            # Wait for the batch so at most max_workers teardowns hit the daemon at once
+            list(self._executor.map(self._safe_handle, batch))
+
+    def _safe_handle(self, key):
+        try:
+            self._handler(key)
+        except Exception as e:
+            log.error(f"Failed to reap instance '{key}': {e}")
+
+
+reaper = ExpiryReaper()
+
+# --- Container State Index ---
+#
+# One thread per daemon follows the event stream for managed containers and
+# keeps an in-memory index (id, name, labels, state, published ports), so
+# status and connection-info reads don't need an inspect per request. Each
+# (re)connect subscribes first and then does a full resync from one raw list
+# call, so no event falls in between.
+
+EVENTS_RECONNECT_DELAY = 5 # Seconds to wait before resubscribing after an error
+
+
+class ContainerStateIndex:
+    """Event-driven in-memory view of managed containers across daemons."""
+
+    def __init__(self):
+        self._containers = {} # container ID -> summary (see _summarize_container)
+        self._lock = threading.Lock()
+        self._watchers = {} # host URL -> thread
+        self._wanted = set() # host URLs that should be watched
+        self._live = set() # host URLs with a synced, open event stream
+
+    def start(self, hosts):
+        """Watches every host in `hosts` (idempotent); other hosts are dropped."""
+        with self._lock:
+            self._wanted = {host.url for host in hosts}
+            for url in self._wanted:
+                thread = self._watchers.get(url)
+                if thread and thread.is_alive():
+                    continue
+                thread = threading.Thread(target=self._watch, args=(url,), name="ctfd-docker-events", daemon=True)
+                self._watchers[url] = thread
+                thread.start()
+
+    def is_live(self, docker_host):
+        """True if reads for this host reflect the daemon's current state."""
+        return (docker_host or None) in self._live
+
+    def get(self, container_id):
+        with self._lock:
+            summary = self._containers.get(container_id)
+            return dict(summary) if summary else None
+
+    def put(self, summary):
+        with self._lock:
+            self._containers[summary["id"]] = summary
+
+    def summaries(self):
+        with self._lock:
+            return list(self._containers.values())
+
+    def put_attrs(self, attrs, docker_host):
+        """Indexes a container from inspect data already at hand. Returns the summary."""
+        summary = _summary_from_attrs(attrs, docker_host)
+        self.put(summary)
+        return summary
+
+    def refresh(self, client, container_id, docker_host):
+        """Re-reads one container with a raw list call. Returns its summary or None."""
+        entries = client.api.containers(all=True, filters={"id": container_id})
+        with self._lock:
+            if not entries:
+                self._containers.pop(container_id, None)
+                return None
+            summary = self._containers[container_id] = _summarize_container(entries[0], docker_host)
+            return dict(summary)
+
+    def _resync(self, client, docker_host):
+        fresh = {summary["id"]: summary for summary in iter_managed_containers(client, docker_host=docker_host, strict=True)}
+        with self._lock:
+            for container_id in [cid for cid, summary in self._containers.items() if summary["docker_host"] == docker_host]:
+                if container_id not in fresh:
+                    del self._containers[container_id]
+            self._containers.update(fresh)
+
+    def _watch(self, docker_host):
+        while docker_host in self._wanted:
+            client = get_docker_client(docker_host)
+            if not client:
+                time.sleep(EVENTS_RECONNECT_DELAY)
+                continue
+            try:
+                events = client.events(decode=True, filters={"type": "container", "label": "ctfd_managed=true"})
+                self._resync(client, docker_host)
+                self._live.add(docker_host)
+                for event in events:
+                    if docker_host not in self._wanted:
+                        events.close()
+                        break
+                    self._handle_event(client, docker_host, event)
+            except Exception as e:
+                log.error(f"Docker event stream for '{docker_host or 'default'}' failed: {e}")
+                mark_client_failed(client)
+            self._live.discard(docker_host)
+            time.sleep(EVENTS_RECONNECT_DELAY)
+
+    def _handle_event(self, client, docker_host, event):
+        container_id = event.get("id") or event.get("Actor", {}).get("ID")
+        action = (event.get("Action") or event.get("status") or "").split(":")[0]
+        if not container_id:
+            return
+        if action == "destroy":
+            with self._lock:
+                self._containers.pop(container_id, None)
+        elif action in ("die", "stop", "kill", "oom"):
+            self.set_state(container_id, "exited")
+        elif action == "pause":
+            self.set_state(container_id, "paused")
+        elif action == "unpause":
+            self.set_state(container_id, "running")
+        elif action in ("create", "start", "restart", "rename"):
+            # Port bindings and names are not part of the event; one cheap list call
+            self.refresh(client, container_id, docker_host)
+
+    def set_state(self, container_id, state):
+        """Records a state change this process made itself, ahead of its event.
+
+        Args:
+            container_id (str): The container ID; unknown containers are ignored.
+            state (str): The new state, e.g. "running" or "paused".
+        """
+        with self._lock:
+            summary = self._containers.get(container_id)
+            if summary:
+                summary["state"] = state
+
+
+state_index = ContainerStateIndex()
+
+# --- Idle Detector ---
+#
+# Samples the CPU and network counters of running player instances every
+# IDLE_SAMPLE_INTERVAL seconds (one-shot stats calls, fanned out over a small
+# thread pool) and pauses containers whose counters have not moved for the
+# configured idle time. Only the leader samples; wake() works in any worker.
+# Paused containers use no CPU and are not counted as running load when
+# placing new instances; their memory stays committed. wake() unpauses an
+# instance when its player comes back.
+
+IDLE_SAMPLE_INTERVAL = 60 # Seconds between sampling passes
+IDLE_SAMPLE_WORKERS = 8 # Concurrent stats calls per pass
+IDLE_CPU_NS = 10 ** 8 # CPU time per interval (ns) below which a container counts as idle
+IDLE_NET_BYTES = 4096 # Network traffic per interval below which a container counts as idle
+
+
+class IdleDetector:
+    """Pauses player instances that have been idle and wakes them on demand."""
+
+    def __init__(self, max_workers=IDLE_SAMPLE_WORKERS, interval=IDLE_SAMPLE_INTERVAL):
+        self.idle_after = 0 # Seconds; 0 disables pausing
+        self.interval = interval
+        self._samples = {} # container ID -> (cpu ns, network bytes, last active monotonic)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ctfd-docker-idle")
+        self._thread = None
+
+    def configure(self, idle_after):
+        """Sets the idle time before pausing (0 disables) and starts sampling if enabled."""
+        self.idle_after = max(0, int(idle_after or 0))
+        if self.idle_after and not (self._thread and self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name="ctfd-docker-idle", daemon=True)
+            self._thread.start()
+
+    def touch(self, container_id):
+        """Counts the instance as active now."""
+        with self._lock:
+            cpu, net, _ = self._samples.get(container_id, (None, None, 0))
+            self._samples[container_id] = (cpu, net, time.monotonic())
+
+    def wake(self, container_id, docker_host):
+        """Unpauses an instance if the state index has it paused.
+
+        Returns:
+            bool: True if the container was unpaused.
+        """
+        self.touch(container_id)
+        summary = state_index.get(container_id)
+        if not summary or summary["state"] != "paused":
+            return False
+        client = get_docker_client(docker_host)
+        if not client:
+            return False
+        try:
+            with metrics.timed("idle_wake"):
+                client.api.unpause(container_id)
+        except docker.errors.NotFound:
+            return False
+        except docker.errors.APIError as e:
+            if e.status_code != 409: # 409: not paused (woken by another worker)
+                log.error(f"Docker API error while unpausing container '{container_id}': {e}")
+                _handle_api_error(client, e)
+                return False
+        state_index.set_state(container_id, "running")
+        metrics.inc("idle_wakes_total")
+        log.info(f"Woke idle container '{container_id}'.")
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.idle_after:
+                continue
+            if not leader.is_leader():
+                # Counters are per container, not per worker; one sampler per deployment is enough
+                with self._lock:
+                    self._samples.clear()
+                continue
+            try:
+                self._sample_all()
+            except Exception as e:
+                log.exception(f"Idle detection pass failed: {e}")
+
+    def _sample_all(self):
+        candidates = [
+            summary for summary in state_index.summaries()
+            if summary["state"] == "running" and INSTANCE_NAME_RE.match(summary["name"])
+        ]
+        with self._lock:
+            # Forget containers that stopped or went away
+            live = {summary["id"] for summary in candidates}
+            for container_id in [cid for cid in self._samples if cid not in live]:
+                del self._samples[container_id]
+        list(self._executor.map(self._check, candidates))
+
+    def _check(self, summary):
+        container_id = summary["id"]
+        client = get_docker_client(summary["docker_host"])
+        if not client:
+            return
+        try:
+            stats = client.api.stats(container_id, stream=False, one_shot=True)
+        except docker.errors.NotFound:
+            return
+        except Exception as e:
+            log.error(f"Failed to read stats for container '{container_id}': {e}")
+            return
+        cpu = (stats.get("cpu_stats") or {}).get("cpu_usage", {}).get("total_usage", 0)
+        net = sum(n.get("rx_bytes", 0) + n.get("tx_bytes", 0) for n in (stats.get("networks") or {}).values())
+        now = time.monotonic()
+        with self._lock:
+            previous = self._samples.get(container_id)
+            if previous is None:
+                self._samples[container_id] = (cpu, net, now)
+                return
+            prev_cpu, prev_net, last_active = previous
+            active = prev_cpu is None or cpu - prev_cpu >= IDLE_CPU_NS or net - prev_net >= IDLE_NET_BYTES
+            if active:
+                last_active = now
+            self._samples[container_id] = (cpu, net, last_active)
+        if not active and now - last_active >= self.idle_after:
+            self._pause(client, container_id)
+
+    def _pause(self, client, container_id):
+        try:
+            client.api.pause(container_id)
+        except docker.errors.NotFound:
+            return
+        except docker.errors.APIError as e:
+            if e.status_code != 409: # 409: not running any more
+                log.error(f"Docker API error while pausing container '{container_id}': {e}")
+                _handle_api_error(client, e)
+            return
+        state_index.set_state(container_id, "paused")
+        metrics.inc("idle_pauses_total")
+        log.info(f"Paused idle container '{container_id}'.")
+
+
+idle = IdleDetector()
+
+# --- Image Eviction ---
+#
+# Lazy pulls and tag updates leave old challenge images behind on every host.
+# Every IMAGE_GC_INTERVAL seconds (and after each pull) the collector reads
+# /system/df on each host and, while the image layers take more than the
+# configured budget, removes images down to IMAGE_GC_LOW_WATERMARK of it.
+# Only images of repositories this plugin has run are considered. Images no
+# docker challenge references go first, then ones referenced by challenges
+# with nothing running; each group is removed least recently used first.
+# Images used by any container, images of challenges with a warm pool and
+# images used in the last IMAGE_GC_GRACE seconds are never removed.
+
+IMAGE_GC_INTERVAL = 300 # Seconds between collection passes
+IMAGE_GC_LOW_WATERMARK = 0.9 # Fraction of the budget a pass evicts down to
+IMAGE_GC_GRACE = 600 # Seconds an image is kept after it was last used
+
+_DEFAULT_REGISTRY_PREFIXES = ("docker.io/library/", "index.docker.io/library/", "docker.io/", "index.docker.io/")
+
+
+def _image_repository(reference):
+    """Returns the repository of an image reference as the daemon lists it ('nginx', 'registry:5000/ctf/web')."""
+    repository, _ = docker.utils.parse_repository_tag(reference)
+    for prefix in _DEFAULT_REGISTRY_PREFIXES:
+        if repository.startswith(prefix):
+            return repository[len(prefix):]
+    return repository
+
+
+def _image_reference(reference):
+    """Normalizes an image name the way RepoTags/RepoDigests spell it ('nginx' -> 'nginx:latest')."""
+    _, tag = docker.utils.parse_repository_tag(reference)
+    tag = tag or "latest"
+    return f"{_image_repository(reference)}{'@' if tag.startswith('sha256:') else ':'}{tag}"
+
+
+class ImageCollector:
+    """Evicts unused challenge images once a host's image storage passes the budget."""
+
+    def __init__(self, interval=IMAGE_GC_INTERVAL):
+        self.budget = 0 # Bytes of image layers per host; 0 disables eviction
+        self.interval = interval
+        self._images = {} # challenge ID -> (image references, pinned by a warm pool)
+        self._repositories = set() # Repositories pulled or run through this plugin
+        self._last_used = {} # (daemon URL, image ID) -> last use (epoch seconds)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def configure(self, budget_bytes):
+        """Sets the per-host image budget in bytes (0 disables) and starts collecting if enabled."""
+        self.budget = max(0, int(budget_bytes or 0))
+        if self.budget and not (self._thread and self._thread.is_alive()):
+            self._thread = threading.Thread(target=self._run, name="ctfd-docker-image-gc", daemon=True)
+            self._thread.start()
+
+    def track(self, spec):
+        """Records the images a docker challenge runs and whether its warm pool pins them."""
+        images = {_image_reference(spec.image_name)}
+        images.update(_image_reference(service.image_name) for service in spec.services)
+        with self._lock:
+            self._images[spec.challenge_id] = (images, bool(spec.pool_size))
+            self._repositories.update(_image_repository(image) for image in images)
+
+    def untrack(self, challenge_id):
+        """Forgets a deleted (or misconfigured) challenge; its images become unreferenced."""
+        with self._lock:
+            self._images.pop(challenge_id, None)
+
+    def touch(self, client, image_name, image_id):
+        """Marks an image as used on the client's daemon now."""
+        with self._lock:
+            self._last_used[(_daemon_key(client), image_id)] = time.time()
+            self._repositories.add(_image_repository(image_name))
+
+    def request_collect(self):
+        """Runs a pass soon, e.g. after a pull added to the image storage."""
+        if self.budget:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self.budget:
+                continue
+            for host in get_docker_hosts():
+                client = get_docker_client(host.url)
+                if not client:
+                    continue
+                try:
+                    self.collect(client)
+                except Exception as e:
+                    log.exception(f"Image eviction pass on '{host.name}' failed: {e}")
+
+    def collect(self, client):
+        """Removes images from the client's daemon until its image layers fit the budget.
+
+        Args:
+            client (docker.DockerClient): The Docker client instance.
+
+        Returns:
+            int: The estimated number of bytes freed.
+        """
+        if not self.budget:
+            return 0
+        with metrics.timed("image_gc_df"):
+            df = client.api.df()
+        usage = df.get("LayersSize") or 0
+        if usage <= self.budget:
+            return 0
+        daemon = _daemon_key(client)
+        now = time.time()
+        in_use = {container.get("ImageID") for container in df.get("Containers") or []}
+        with self._lock:
+            referenced = set().union(*(images for images, _ in self._images.values()))
+            pinned = set().union(*(images for images, pooled in self._images.values() if pooled))
+            repositories = set(self._repositories)
+            last_used = {image_id: used for (key, image_id), used in self._last_used.items() if key == daemon}
+
+        candidates = []
+        for image in df.get("Images") or []:
+            tags = [tag for tag in image.get("RepoTags") or [] if tag != "<none>:<none>"]
+            references = tags + [digest for digest in image.get("RepoDigests") or [] if not digest.endswith("@<none>")]
+            if (not references or image["Id"] in in_use or image.get("Containers", 0) > 0
+                    or now - last_used.get(image["Id"], 0) < IMAGE_GC_GRACE):
+                continue
+            # Leave images other tools put on a shared daemon alone
+            if any(_image_repository(reference) not in repositories for reference in references):
+                continue
+            if any(reference in pinned for reference in references):
+                continue
+            tier = "referenced" if any(reference in referenced for reference in references) else "unreferenced"
+            shared = image.get("SharedSize", -1)
+            size = image.get("Size", 0) - (shared if shared > 0 else 0)
+            candidates.append((tier == "referenced", last_used.get(image["Id"], image.get("Created", 0)), tier, size, tags, image["Id"]))
+        candidates.sort(key=lambda candidate: candidate[:2])
+
+        target = self.budget * IMAGE_GC_LOW_WATERMARK
+        freed = 0
+        for _, _, tier, size, tags, image_id in candidates:
+            if usage - freed <= target:
+                break
+            if self._remove(client, tags, image_id):
+                freed += size
+                metrics.inc("image_evictions_total", tier=tier)
+                metrics.inc("image_evicted_bytes_total", amount=size)
+        if freed:
+            log.info(f"Evicted {freed / 1024 ** 2:.0f} MiB of images on '{daemon or 'default'}' "
+                     f"({usage / 1024 ** 2:.0f} MiB used, budget {self.budget / 1024 ** 2:.0f} MiB).")
+        return freed
+
+    def _remove(self, client, tags, image_id):
+        try:
+            with metrics.timed("image_remove"):
+                # Untagging the last tag deletes the image; dangling images go by ID
+                for reference in tags or [image_id]:
+                    client.api.remove_image(reference)
+        except docker.errors.NotFound:
+            pass # Removed by another worker process
+        except docker.errors.APIError as e:
+            if e.status_code != 409: # 409: a container started from it since df, or it has child images
+                log.error(f"Docker API error while removing image '{image_id}': {e}")
+                _handle_api_error(client, e)
+            return False
+        daemon = _daemon_key(client)
+        with _image_cache_lock:
+            for key in [key for key, cached in _image_cache.items() if key[0] == daemon and cached[0] == image_id]:
+                del _image_cache[key]
+        with self._lock:
+            self._last_used.pop((daemon, image_id), None)
+        log.info(f"Evicted image {', '.join(tags) or image_id} from '{daemon or 'default'}'.")
+        return True
+
+
+image_gc = ImageCollector()
+
+# --- Gauges --- (Computed from in-memory state when the metrics endpoint is scraped)
+
+def _host_label(docker_host):
+    return docker_host or "default"
+
+
+def _running_instances_gauge():
+    counts = {}
+    for summary in state_index.summaries():
+        labels = summary["labels"]
+        if summary["state"] != "running" or not INSTANCE_NAME_RE.match(summary["name"]) or not labels.get("challenge_id"):
+            continue
+        key = (("challenge_id", labels["challenge_id"]), ("docker_host", _host_label(summary["docker_host"])))
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def _admission_gauge(index):
+    return {(("docker_host", _host_label(host)),): values[index] for host, values in admission.snapshot().items()}
+
+
+metrics.register_gauge("running_instances", "Running player instances by challenge and host (from the state index).", _running_instances_gauge)
+metrics.register_gauge("paused_instances", "Player instances paused by the idle detector (from the state index).",
+                       lambda: {(): sum(1 for summary in state_index.summaries() if summary["state"] == "paused")})
+metrics.register_gauge("warm_pool_idle", "Idle pre-started containers by challenge.",
+                       lambda: {(("challenge_id", cid),): n for cid, n in warm_pool.idle_counts().items()})
+metrics.register_gauge("creates_in_flight", "Container creates holding an admission slot.", lambda: _admission_gauge(0))
+metrics.register_gauge("admission_queued", "Starts waiting for an admission slot.", lambda: _admission_gauge(1))
+metrics.register_gauge("start_queue_pending", "Start jobs waiting for a worker.", lambda: {(): start_jobs.pending()})
 
 # --- Helper Functions ---
 
+def _summarize_container(entry, docker_host=None):
+    """Builds a lightweight summary from one entry of the raw container list."""
+    ports = {}
+    for port in entry.get("Ports") or []:
+        if port.get("PublicPort"):
+            ports.setdefault(f"{port['PrivatePort']}/{port.get('Type', 'tcp')}", str(port["PublicPort"]))
+    return {
+        "id": entry["Id"],
+        "name": (entry.get("Names") or ["/"])[0].lstrip("/"),
+        "labels": entry.get("Labels") or {},
+        "state": entry.get("State"),
+        "ports": ports,
+        "created": entry.get("Created"), # Epoch seconds
+        "docker_host": docker_host or None,
+    }
+
+def _summary_from_attrs(attrs, docker_host=None):
+    """Builds the same summary from full inspect data (container.attrs)."""
+    ports = {}
+    for container_port in (attrs.get('NetworkSettings', {}).get('Ports') or {}):
+        host_ip, host_port = get_container_ip_port(attrs, container_port)
+        if host_port:
+            ports[container_port] = host_port
+    return {
+        "id": attrs["Id"],
+        "name": attrs.get("Name", "/").lstrip("/"),
+        "labels": attrs.get("Config", {}).get("Labels") or {},
+        "state": attrs.get("State", {}).get("Status"),
+        "ports": ports,
+        "created": None,
+        "docker_host": docker_host or None,
+    }
+
+def parse_ports_config(ports_str):
+    """Parses a docker_ports string into a Docker SDK port mapping.
+
+    Args:
+        ports_str (str): Comma-separated mappings, e.g. '80/tcp:8080, 22/tcp'.
+
+    Returns:
+        dict: Mapping of 'port/proto' to host port (None for dynamic assignment).
+
+    Raises:
+        ValueError: If a host port is not a valid integer.
+    """
+    ports_config = {}
+    for port_map in (ports_str or '').split(','):
+        if not port_map.strip(): continue
+        parts = port_map.strip().split(':')
+        container_port_proto = parts[0]
+        host_port = int(parts[1]) if len(parts) > 1 and parts[1] else None # None for dynamic assignment
+        if '/' not in container_port_proto:
+            container_port_proto += '/tcp' # Default to TCP
+        ports_config[container_port_proto] = host_port
+    return ports_config
+
+def parse_env_vars(env_str):
+    """Parses a docker_env string into a dictionary.
+
+    Args:
+        env_str (str): Comma-separated pairs, e.g. 'KEY1=VALUE1,KEY2=VALUE2'.
+
+    Returns:
+        dict: The environment variables.
+
+    Raises:
+        ValueError: If a pair has no '=' separator.
+    """
+    env_vars = {}
+    for env_pair in (env_str or '').split(','):
+        if not env_pair.strip(): continue
+        key, value = env_pair.strip().split('=', 1)
+        env_vars[key] = value
+    return env_vars
+
 def get_container_ip_port(container_attrs, container_port):
     """Extracts the host IP and port for a specific container port.
 